@@ -0,0 +1,281 @@
+import os
+import struct
+import tarfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+from typing import Callable, Iterator, Optional, Tuple
+
+from constants import CONTENT_PATH, CHUNKS_DIR_NAME, ENCRYPTED_FILE_PREFIX, CRYPTO_WORKERS, DECRYPT_READ_AHEAD, \
+    ARCHIVE_READ_AHEAD_FILES, ARCHIVE_SMALL_FILE_SIZE, ENCODING, CHUNK_SIZE
+from encrypter import BinaryIOBytesInStream, decrypt_name, decrypt_chunks, read_header, empty
+
+ZIP = 'zip'
+TAR = 'tar'
+FORMATS = (ZIP, TAR)
+
+MAX_UINT32 = 0xFFFFFFFF
+MAX_UINT16 = 0xFFFF
+ZIP64_LIMIT = MAX_UINT32
+ZIP_COUNT_LIMIT = MAX_UINT16
+ZIP_FLAGS = 0x0808  # sizes and CRC in a data descriptor after the data, UTF-8 names
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+ZIP_MADE_BY = 3 << 8 | ZIP64_VERSION  # Unix
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+DATA_DESCRIPTOR = struct.Struct('<IIII')
+DATA_DESCRIPTOR64 = struct.Struct('<IIQQ')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+ZIP64_EXTRA = struct.Struct('<HH')
+END_RECORD = struct.Struct('<IHHHHIIH')
+END_RECORD64 = struct.Struct('<IQHHIIQQQQ')
+END_LOCATOR64 = struct.Struct('<IIQI')
+
+ERRORS_NAME = 'archive_errors.txt'
+ZEROS = memoryview(bytes(CHUNK_SIZE))
+
+ARCHIVE_EXECUTOR = ThreadPoolExecutor(max_workers=CRYPTO_WORKERS, thread_name_prefix='archive')
+
+
+class ArchiveEntry:
+    __slots__ = ('name', 'path', 'mtime', 'is_dir')
+
+    def __init__(self, name: str, path: str, mtime: float, is_dir: bool):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.is_dir = is_dir
+
+
+class ZipWriter:
+    def __init__(self):
+        self.offset = 0
+        # name, crc, size, local header offset, dos time, dos date, is_dir
+        self.entries: list[Tuple[bytes, int, int, int, int, int, bool]] = []
+
+    def add(self, name: str, mtime: float, size: int, chunks: Iterator[bytes | memoryview],
+            is_dir: bool = False) -> Iterator[bytes | memoryview]:
+        encoded = (name + '/' if is_dir else name).encode(ENCODING)
+        (dos_time, dos_date) = dos_date_time(mtime)
+        zip64 = size >= ZIP64_LIMIT
+        extra = ZIP64_EXTRA.pack(1, 16) + struct.pack('<QQ', 0, 0) if zip64 else b''
+        header = LOCAL_HEADER.pack(0x04034b50, ZIP64_VERSION if zip64 else ZIP_VERSION, ZIP_FLAGS, 0, dos_time,
+                                   dos_date, 0, MAX_UINT32 if zip64 else 0, MAX_UINT32 if zip64 else 0,
+                                   len(encoded), len(extra))
+        self.entries.append((encoded, 0, size, self.offset, dos_time, dos_date, is_dir))
+        yield self.write(header + encoded + extra)
+
+        crc = 0
+        written = 0
+        for buf in chunks:
+            crc = zlib.crc32(buf, crc)
+            written += len(buf)
+            yield self.write(buf)
+        if written != size:
+            raise ValueError(f'{name} has {written} bytes instead of {size}')
+
+        self.entries[-1] = (encoded, crc, size, *self.entries[-1][3:])
+        if zip64:
+            yield self.write(DATA_DESCRIPTOR64.pack(0x08074b50, crc, size, size))
+        else:
+            yield self.write(DATA_DESCRIPTOR.pack(0x08074b50, crc, size, size))
+
+    def close(self) -> Iterator[bytes]:
+        start = self.offset
+        for (encoded, crc, size, offset, dos_time, dos_date, is_dir) in self.entries:
+            fields = [x for x in (size, size, offset) if x >= ZIP64_LIMIT]
+            zip64 = size >= ZIP64_LIMIT
+            extra = ZIP64_EXTRA.pack(1, 8 * len(fields)) + struct.pack(f'<{len(fields)}Q', *fields) if fields else b''
+            attributes = (0o40755 << 16 | 0x10) if is_dir else 0o100644 << 16
+            yield self.write(CENTRAL_HEADER.pack(0x02014b50, ZIP_MADE_BY, ZIP64_VERSION if fields else ZIP_VERSION,
+                                                 ZIP_FLAGS, 0, dos_time, dos_date, crc,
+                                                 MAX_UINT32 if zip64 else size, MAX_UINT32 if zip64 else size,
+                                                 len(encoded), len(extra), 0, 0, 0, attributes,
+                                                 MAX_UINT32 if offset >= ZIP64_LIMIT else offset) + encoded + extra)
+
+        count = len(self.entries)
+        size = self.offset - start
+        if count >= ZIP_COUNT_LIMIT or size >= ZIP64_LIMIT or start >= ZIP64_LIMIT:
+            end64 = self.offset
+            yield self.write(END_RECORD64.pack(0x06064b50, END_RECORD64.size - 12, ZIP_MADE_BY, ZIP64_VERSION, 0, 0,
+                                               count, count, size, start))
+            yield self.write(END_LOCATOR64.pack(0x07064b50, 0, end64, 1))
+            count = MAX_UINT16 if count >= ZIP_COUNT_LIMIT else count
+            size = MAX_UINT32 if size >= ZIP64_LIMIT else size
+            start = MAX_UINT32 if start >= ZIP64_LIMIT else start
+        yield self.write(END_RECORD.pack(0x06054b50, 0, 0, count, count, size, start, 0))
+
+    def write(self, data: bytes | memoryview) -> bytes | memoryview:
+        self.offset += len(data)
+        return data
+
+
+class TarWriter:
+    def __init__(self):
+        self.offset = 0
+
+    def add(self, name: str, mtime: float, size: int, chunks: Iterator[bytes | memoryview],
+            is_dir: bool = False) -> Iterator[bytes | memoryview]:
+        info = tarfile.TarInfo(name)
+        info.mtime = int(mtime)
+        if is_dir:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+        else:
+            info.size = size
+            info.mode = 0o644
+        # PAX headers carry names over 100 bytes and sizes over 8 GB
+        yield self.write(info.tobuf(tarfile.PAX_FORMAT, ENCODING, 'surrogateescape'))
+
+        written = 0
+        for buf in chunks:
+            written += len(buf)
+            yield self.write(buf)
+        if written != size:
+            raise ValueError(f'{name} has {written} bytes instead of {size}')
+        if size % tarfile.BLOCKSIZE:
+            yield self.write(tarfile.NUL * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE))
+
+    def close(self) -> Iterator[bytes]:
+        yield self.write(tarfile.NUL * 2 * tarfile.BLOCKSIZE)
+        if self.offset % tarfile.RECORDSIZE:
+            yield self.write(tarfile.NUL * (tarfile.RECORDSIZE - self.offset % tarfile.RECORDSIZE))
+
+    def write(self, data: bytes | memoryview) -> bytes | memoryview:
+        self.offset += len(data)
+        return data
+
+
+def dos_date_time(mtime: float) -> Tuple[int, int]:
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2,
+            (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday)
+
+
+def member_name(name: str) -> Optional[str]:
+    # A stored name is only one path component, separators or dot names in it would escape the archive folder
+    name = name.replace('/', '_').replace('\\', '_').replace('\0', '_')
+    return None if name in ('', '.', '..') else name
+
+
+def walk(key: bytes, path: str | Path, prefix: str) -> Iterator[ArchiveEntry]:
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name == CHUNKS_DIR_NAME and Path(path) == Path(CONTENT_PATH):
+                continue
+            if not entry.name.startswith(ENCRYPTED_FILE_PREFIX):
+                continue
+            try:
+                name = member_name(decrypt_name(key, entry.name))
+                if name is None:
+                    continue
+                entries.append(ArchiveEntry(prefix + '/' + name, entry.path, entry.stat().st_mtime, entry.is_dir()))
+            except (OSError, ValueError):
+                continue
+
+    for entry in sorted(entries, key=lambda x: x.name):
+        yield entry
+        if entry.is_dir:
+            yield from walk(key, entry.path, entry.name)
+
+
+def load(key: bytes, path: str) -> Optional[Tuple[int, Optional[bytearray]]]:
+    # Small files are decrypted whole ahead of the writer, larger ones only get their size and are streamed
+    try:
+        with open(path, 'rb') as f:
+            in_stream = BinaryIOBytesInStream(f)
+            header = read_header(key, in_stream)
+            if header.size > ARCHIVE_SMALL_FILE_SIZE:
+                return header.size, None
+            # The chunks are views into buffers that decrypt_chunks reuses, each is copied out before the next
+            data = bytearray(header.size)
+            position = 0
+            with closing(decrypt_chunks(key, in_stream, header, 0)) as chunks:
+                for buf in chunks:
+                    data[position:position + len(buf)] = buf
+                    position += len(buf)
+            return position, data
+    except FileNotFoundError:
+        return None
+
+
+def stream_file(key: bytes, path: str, callback: Callable) -> Iterator[memoryview]:
+    with open(path, 'rb') as f:
+        in_stream = BinaryIOBytesInStream(f)
+        header = read_header(key, in_stream)
+        with closing(decrypt_chunks(key, in_stream, header, 0, read_ahead=DECRYPT_READ_AHEAD)) as chunks:
+            for buf in chunks:
+                callback()
+                yield buf
+
+
+def zero_filled(chunks: Iterator[memoryview], size: int, failed: Callable) -> Iterator[memoryview]:
+    # Once the member header is out the entry can't be skipped, a file that fails partway is padded to its size
+    written = 0
+    try:
+        for buf in chunks:
+            written += len(buf)
+            yield buf
+    except (OSError, ValueError):
+        failed()
+        while written < size:
+            buf = ZEROS[:size - written]
+            written += len(buf)
+            yield buf
+
+
+def archive(key: bytes, path: str | Path, name: str, archive_format: str,
+            callback: Callable = empty) -> Iterator[bytes | memoryview]:
+    writer = ZipWriter() if archive_format == ZIP else TarWriter()
+    entries = walk(key, path, name)
+    pending: deque[Tuple[ArchiveEntry, Optional[Future]]] = deque()
+    failed: list[str] = []
+
+    def fill():
+        while len(pending) < ARCHIVE_READ_AHEAD_FILES:
+            entry = next(entries, None)
+            if entry is None:
+                return
+            pending.append((entry, None if entry.is_dir else ARCHIVE_EXECUTOR.submit(load, key, entry.path)))
+
+    try:
+        yield from writer.add(name, os.stat(path).st_mtime, 0, iter(()), True)
+        fill()
+        while pending:
+            (entry, future) = pending.popleft()
+            fill()
+            if future is None:
+                yield from writer.add(entry.name, entry.mtime, 0, iter(()), True)
+                continue
+
+            try:
+                loaded = future.result()
+            except (OSError, ValueError):
+                # Files that can't be read or decrypted are left out and listed at the end of the archive
+                failed.append(entry.name)
+                continue
+            if loaded is None:
+                continue
+            (size, data) = loaded
+            callback()
+            if data is not None:
+                chunks = iter((data,))
+            else:
+                chunks = zero_filled(stream_file(key, entry.path, callback), size,
+                                     lambda: failed.append(entry.name + ' (zero filled)'))
+            yield from writer.add(entry.name, entry.mtime, size, chunks)
+
+        if failed:
+            report = ('\n'.join(failed) + '\n').encode(ENCODING)
+            yield from writer.add(name + '/' + ERRORS_NAME, time.time(), len(report), iter((report,)))
+        yield from writer.close()
+    finally:
+        for (_, future) in pending:
+            if future is not None:
+                future.cancel()
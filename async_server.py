@@ -0,0 +1,162 @@
+import asyncio
+import io
+import socket
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from typing import Tuple, Type
+
+from constants import ASYNC_WORKERS, HTTP_MAX_HEADER_SIZE, KEEP_ALIVE_TIMEOUT_SECONDS, WRITE_TIMEOUT_SECONDS
+
+HEAD_END = b'\r\n\r\n'
+
+
+class StreamReaderFile(io.RawIOBase):
+    def __init__(self, head: bytes, reader: asyncio.StreamReader, loop: asyncio.AbstractEventLoop):
+        self.head = io.BytesIO(head)
+        self.reader = reader
+        self.loop = loop
+        self.body_read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readline(self, size: int = -1) -> bytes:
+        # The request head is read by the event loop, handlers only read lines from it
+        return self.head.readline(size)
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            raise ValueError('Unbounded reads are not supported')
+        buf = self.head.read(size)
+        if len(buf) < size:
+            buf += asyncio.run_coroutine_threadsafe(self.read_body(size - len(buf)), self.loop).result()
+        return buf
+
+    def readinto(self, buf: bytearray | memoryview) -> int:
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    async def read_body(self, size: int) -> bytes:
+        result = bytearray()
+        while len(result) < size:
+            data = await self.reader.read(size - len(result))
+            if not data:
+                break
+            result += data
+        self.body_read += len(result)
+        return bytes(result)
+
+
+class StreamWriterFile(io.RawIOBase):
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+        self.writer = writer
+        self.loop = loop
+        self.written = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, buf: bytes | memoryview) -> int:
+        if not buf:
+            return 0
+        # Copy, the caller may reuse the buffer as soon as write returns
+        data = bytes(buf)
+        try:
+            asyncio.run_coroutine_threadsafe(self.send(data), self.loop).result()
+        except asyncio.TimeoutError as e:
+            raise ConnectionError('Client is not reading the response') from e
+        self.written += len(data)
+        return len(data)
+
+    async def send(self, data: bytes):
+        self.writer.write(data)
+        # Blocks the handler thread while the client is slower than the transport buffer drains
+        await asyncio.wait_for(self.writer.drain(), WRITE_TIMEOUT_SECONDS)
+
+
+def bridge(handler_class: Type[BaseHTTPRequestHandler]) -> Type[BaseHTTPRequestHandler]:
+    class BridgedRequestHandler(handler_class):
+        protocol_version = 'HTTP/1.1'
+
+        def __init__(self, rfile: StreamReaderFile, wfile: StreamWriterFile, client_address: Tuple, server):
+            self.rfile = rfile
+            self.wfile = wfile
+            super().__init__(None, client_address, server)
+
+        def setup(self):
+            pass
+
+        def handle(self):
+            self.close_connection = True
+            self.handle_one_request()
+
+        def finish(self):
+            pass
+
+    return BridgedRequestHandler
+
+
+class AsyncHTTPServer:
+    def __init__(self, server_address: Tuple[str, int], handler_class: Type[BaseHTTPRequestHandler],
+                 workers: int = ASYNC_WORKERS):
+        self.socket = socket.create_server(server_address)
+        self.server_address = self.socket.getsockname()
+        self.handler_class = bridge(handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='http')
+        self.loop = None
+        self.server = None
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle_connection, sock=self.socket, limit=HTTP_MAX_HEADER_SIZE)
+        async with self.server:
+            await self.server.serve_forever()
+
+    def server_close(self):
+        # After Ctrl+C asyncio.run has already closed the loop, and the server with it
+        if self.loop and self.server and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.server.close)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.socket.close()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client_address = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(HEAD_END), KEEP_ALIVE_TIMEOUT_SECONDS)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    return
+                except asyncio.LimitOverrunError:
+                    writer.write(b'HTTP/1.1 431 Request Header Fields Too Large\r\n'
+                                 b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+                    await writer.drain()
+                    return
+
+                rfile = StreamReaderFile(head, reader, self.loop)
+                wfile = StreamWriterFile(writer, self.loop)
+                handler = await self.loop.run_in_executor(self.executor, self.handler_class, rfile, wfile,
+                                                          client_address, self)
+                if handler.close_connection or not wfile.written or not self.body_consumed(handler, rfile):
+                    return
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            writer.close()
+
+    @staticmethod
+    def body_consumed(handler: BaseHTTPRequestHandler, rfile: StreamReaderFile) -> bool:
+        headers = getattr(handler, 'headers', None)
+        if headers is None or headers.get('Transfer-Encoding'):
+            return False
+        try:
+            return rfile.body_read >= int(headers.get('Content-Length') or 0)
+        except ValueError:
+            return False
@@ -0,0 +1,62 @@
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from encrypter import BinaryIOBytesInStream, BinaryIOBytesOutStream, encrypt_stream, decrypt_stream  # noqa: E402
+
+
+def measure(chunk_size: int, data: bytes, key: bytes, probes: int, probe_size: int) -> dict:
+    out = io.BytesIO()
+    started = time.perf_counter()
+    encrypt_stream(key, BinaryIOBytesInStream(io.BytesIO(data)), BinaryIOBytesOutStream(out), size=len(data),
+                   chunk_size=chunk_size)
+    encrypt_time = time.perf_counter() - started
+    encrypted = out.getvalue()
+
+    started = time.perf_counter()
+    decrypt_stream(key, BinaryIOBytesInStream(io.BytesIO(encrypted)), BinaryIOBytesOutStream(io.BytesIO()))
+    decrypt_time = time.perf_counter() - started
+
+    generator = random.Random(0)
+    started = time.perf_counter()
+    for _ in range(probes):
+        start = generator.randrange(0, max(1, len(data) - probe_size))
+        decrypt_stream(key, BinaryIOBytesInStream(io.BytesIO(encrypted)), BinaryIOBytesOutStream(io.BytesIO()),
+                       start, end=start + probe_size)
+    probe_time = time.perf_counter() - started
+
+    mb = len(data) / 1024 / 1024
+    return {
+        'chunk_size': chunk_size,
+        'encrypt_mb_s': mb / encrypt_time,
+        'decrypt_mb_s': mb / decrypt_time,
+        'range_ms': probe_time / probes * 1000,
+        'overhead_bytes': len(encrypted) - len(data),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare container chunk sizes')
+    parser.add_argument('--size', type=int, default=64, help='plaintext size in MB')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[64, 128, 1024, 4096], help='chunk sizes in KB')
+    parser.add_argument('--probes', type=int, default=200, help='number of random range reads')
+    parser.add_argument('--probe-size', type=int, default=64, help='size of a range read in KB')
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    data = os.urandom(args.size * 1024 * 1024)
+
+    print(f'{"chunk":>8} {"encrypt MB/s":>13} {"decrypt MB/s":>13} {"range ms":>9} {"overhead":>9}')
+    for chunk_size in args.chunk_sizes:
+        result = measure(chunk_size * 1024, data, key, args.probes, args.probe_size * 1024)
+        print(f'{chunk_size:>6}KB {result["encrypt_mb_s"]:>13.1f} {result["decrypt_mb_s"]:>13.1f} '
+              f'{result["range_ms"]:>9.2f} {result["overhead_bytes"]:>9}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import json
+import sys
+
+# Metrics where a larger value is better, the rest regress when they grow
+HIGHER_IS_BETTER = ('mb_s', 'ops_s')
+METRICS = ('mb_s', 'ops_s', 'p50_ms', 'p99_ms')
+RSS_KEYS = ('peak_rss_kb', 'server_peak_rss_kb', 'client_peak_rss_kb')
+
+
+def change(old: float, new: float) -> float:
+    return (new - old) / old * 100 if old else 0.0
+
+
+def regressed(metric: str, delta: float, threshold: float) -> bool:
+    return -delta > threshold if metric in HIGHER_IS_BETTER else delta > threshold
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark reports written by micro.py or load.py')
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=10.0, help='percent change counted as a regression')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline.get('suite') != current.get('suite'):
+        raise SystemExit(f'Reports are from different suites: {baseline.get("suite")} and {current.get("suite")}')
+
+    old_results = {x['name']: x for x in baseline['results']}
+    regressions = []
+    print(f'{"":<40} {"metric":>7} {"baseline":>12} {"current":>12} {"change":>8}')
+    for result in current['results']:
+        old = old_results.get(result['name'])
+        if old is None:
+            print(f'{result["name"]:<40} (new)')
+            continue
+        for metric in METRICS:
+            if not old[metric] and not result[metric]:
+                continue
+            delta = change(old[metric], result[metric])
+            mark = ''
+            if regressed(metric, delta, args.threshold):
+                regressions.append(f'{result["name"]} {metric}')
+                mark = ' !'
+            print(f'{result["name"]:<40} {metric:>7} {old[metric]:>12.3f} {result[metric]:>12.3f} '
+                  f'{delta:>+7.1f}%{mark}')
+
+    for key in RSS_KEYS:
+        if key in baseline and key in current:
+            delta = change(baseline[key], current[key])
+            mark = ''
+            if delta > args.threshold:
+                regressions.append(key)
+                mark = ' !'
+            print(f'{key:<48} {baseline[key]:>12} {current[key]:>12} {delta:>+7.1f}%{mark}')
+
+    if regressions:
+        print(f'{len(regressions)} regressions over {args.threshold}%', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
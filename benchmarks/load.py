@@ -0,0 +1,285 @@
+import argparse
+import html
+import http.client
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from encrypter import BytesInStream, BinaryIOBytesOutStream, encrypt_name, encrypt_stream, unlock_key, \
+    chunk_size_for  # noqa: E402
+from report import summarize, peak_rss_kb, write_report  # noqa: E402
+
+PASSWORD = 'benchmark'
+BOUNDARY = 'benchmarkboundary'
+PATTERN_SIZE = 1024 * 1024
+NEXT_LINK = re.compile(r'<a id="next"[^>]*href="([^"]+)"')
+PREV_LINK = re.compile(r'<a id="prev"[^>]*href="([^"]+)"')
+
+
+class PatternBytesInStream(BytesInStream):
+    def __init__(self, size: int, pattern: bytes):
+        self.remaining = size
+        self.pattern = pattern
+
+    def readinto(self, buf: bytearray | memoryview) -> int:
+        size = min(len(buf), self.remaining, len(self.pattern))
+        buf[:size] = self.pattern[:size]
+        self.remaining -= size
+        return size
+
+
+def write_file(key: bytes, path: str, name: str, size: int, pattern: bytes) -> str:
+    encrypted_name = encrypt_name(key, name)
+    with open(os.path.join(path, encrypted_name), 'wb') as f:
+        encrypt_stream(key, PatternBytesInStream(size, pattern), BinaryIOBytesOutStream(f), size=size,
+                       chunk_size=chunk_size_for(name))
+    return encrypted_name
+
+
+def prepare(work: str, args: argparse.Namespace) -> dict:
+    for name in ('Meta', 'Content', 'Temp'):
+        os.makedirs(os.path.join(work, name))
+    key = unlock_key(PASSWORD, os.path.join(work, 'Meta', 'key'))
+    content = os.path.join(work, 'Content')
+    pattern = os.urandom(PATTERN_SIZE)
+
+    folder = encrypt_name(key, 'folder')
+    os.makedirs(os.path.join(content, folder))
+    for i in range(args.entries):
+        write_file(key, os.path.join(content, folder), f'file{i:06}.txt', 0, pattern)
+
+    photos = encrypt_name(key, 'photos')
+    os.makedirs(os.path.join(content, photos))
+    images = [write_file(key, os.path.join(content, photos), f'img{i:05}.jpg', args.image_kb * 1024, pattern)
+              for i in range(args.images)]
+
+    video = write_file(key, content, 'video.mp4', args.video_mb * 1024 * 1024, pattern)
+    return {'folder': folder, 'photos': photos, 'images': images, 'video': video}
+
+
+def serve(engine: str, ports: multiprocessing.Queue, stop: multiprocessing.Event):
+    import main
+
+    if engine == 'async':
+        httpd = main.AsyncHTTPServer(('127.0.0.1', 0), main.CustomRequestHandler)
+    else:
+        httpd = main.ThreadedHTTPServer(('127.0.0.1', 0), main.CustomRequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    ports.put(httpd.server_address[1])
+    stop.wait()
+    ports.put(peak_rss_kb())
+
+
+class Client:
+    def __init__(self, port: int):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+
+    def request(self, method: str, path: str, body=None, headers: Optional[dict] = None) -> Tuple[int, int, float]:
+        started = time.perf_counter()
+        self.connection.request(method, path, body, headers or {})
+        response = self.connection.getresponse()
+        size = 0
+        while True:
+            data = response.read(PATTERN_SIZE)
+            if not data:
+                break
+            size += len(data)
+        return response.status, size, time.perf_counter() - started
+
+    def page(self, path: str) -> Tuple[int, str, float]:
+        started = time.perf_counter()
+        self.connection.request('GET', path, headers={'Accept': 'text/html'})
+        response = self.connection.getresponse()
+        text = response.read().decode()
+        return response.status, text, time.perf_counter() - started
+
+    def close(self):
+        self.connection.close()
+
+
+def run_listing(client: Client, files: dict, args: argparse.Namespace) -> list[dict]:
+    path = '/' + files['folder'] + '/'
+    (status, _, cold) = client.request('GET', path, headers={'Accept': 'text/html'})
+    latencies = []
+    errors = int(status != 200)
+    for _ in range(args.listings):
+        (status, _, elapsed) = client.request('GET', path, headers={'Accept': 'text/html'})
+        latencies.append(elapsed)
+        errors += status != 200
+    return [summarize(f'listing {args.entries} entries (cold)', [cold]),
+            summarize(f'listing {args.entries} entries', latencies, errors=errors)]
+
+
+def run_gallery(client: Client, files: dict, args: argparse.Namespace) -> list[dict]:
+    base = '/' + files['photos'] + '/'
+    (status, _, elapsed) = client.request('GET', base + 'gallery', headers={'Accept': 'text/html'})
+    pages = [elapsed]
+    images = []
+    errors = int(status != 200)
+    # Walk forward through the folder following each page's Next link and back following Prev, loading the page and
+    # its image each time
+    name = files['images'][0]
+    visited = 0
+    for link in (NEXT_LINK, PREV_LINK):
+        for _ in files['images']:
+            (status, text, elapsed) = client.page(base + name)
+            pages.append(elapsed)
+            errors += status != 200
+            (status, _, elapsed) = client.request('GET', base + name, headers={'Accept': 'image/*'})
+            images.append(elapsed)
+            errors += status != 200
+            visited += 1
+            match = link.search(text)
+            if not match:
+                break
+            name = html.unescape(match.group(1))
+    # A walk cut short means the links skipped or lost images
+    errors += visited != 2 * len(files['images'])
+    return [summarize('gallery pages', pages, errors=errors),
+            summarize(f'gallery images {args.image_kb}KB', images, args.image_kb * 1024)]
+
+
+def run_video_seeks(port: int, files: dict, args: argparse.Namespace) -> list[dict]:
+    size = args.video_mb * 1024 * 1024
+    length = args.range_kb * 1024
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def seek(seed: int):
+        nonlocal errors
+        generator = random.Random(seed)
+        client = Client(port)
+        try:
+            for _ in range(args.seeks):
+                start = generator.randrange(0, max(1, size - length))
+                (status, read, elapsed) = client.request('GET', '/' + files['video'],
+                                                         headers={'Range': f'bytes={start}-{start + length - 1}'})
+                with lock:
+                    latencies.append(elapsed)
+                    errors += status != 206 or read != length
+        finally:
+            client.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        for future in [executor.submit(seek, x) for x in range(args.clients)]:
+            future.result()
+    return [summarize(f'video seeks {args.clients} clients', latencies, length, errors,
+                      time.perf_counter() - started)]
+
+
+def upload_body(size: int) -> Tuple[Iterator[bytes], int]:
+    head = (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="upload.bin"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode()
+    tail = f'\r\n--{BOUNDARY}--\r\n'.encode()
+    pattern = os.urandom(PATTERN_SIZE)
+
+    def body() -> Iterator[bytes]:
+        yield head
+        remaining = size
+        while remaining:
+            yield pattern[:min(remaining, len(pattern))]
+            remaining -= min(remaining, len(pattern))
+        yield tail
+
+    return body(), len(head) + size + len(tail)
+
+
+def run_upload(client: Client, args: argparse.Namespace) -> list[dict]:
+    size = args.upload_mb * 1024 * 1024
+    latencies = []
+    errors = 0
+    for _ in range(args.uploads):
+        (body, length) = upload_body(size)
+        (status, _, elapsed) = client.request('POST', '/save', body, {
+            'Content-Type': f'multipart/form-data; boundary={BOUNDARY}',
+            'Content-Length': str(length),
+        })
+        latencies.append(elapsed)
+        errors += status != 302
+    return [summarize(f'upload {args.upload_mb}MB', latencies, size, errors)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay request mixes against a throwaway server on a temp Content')
+    parser.add_argument('--server', choices=('threaded', 'async'), default='threaded')
+    parser.add_argument('--entries', type=int, default=50000, help='files in the listed folder')
+    parser.add_argument('--listings', type=int, default=20, help='warm listing requests')
+    parser.add_argument('--images', type=int, default=100, help='images walked with next and prev')
+    parser.add_argument('--image-kb', type=int, default=512)
+    parser.add_argument('--video-mb', type=int, default=512)
+    parser.add_argument('--clients', type=int, default=8, help='concurrent video clients')
+    parser.add_argument('--seeks', type=int, default=50, help='range requests per video client')
+    parser.add_argument('--range-kb', type=int, default=1024, help='size of a video range request')
+    parser.add_argument('--upload-mb', type=int, default=2048)
+    parser.add_argument('--uploads', type=int, default=1)
+    parser.add_argument('--scenarios', nargs='+', default=['listing', 'gallery', 'video', 'upload'],
+                        choices=('listing', 'gallery', 'video', 'upload'))
+    parser.add_argument('--keep', action='store_true', help='keep the temp directory')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix='aes_load_')
+    context = multiprocessing.get_context('spawn')
+    ports = context.Queue()
+    stop = context.Event()
+    server = None
+    try:
+        started = time.perf_counter()
+        files = prepare(work, args)
+        print(f'Prepared {work} in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+        server = context.Process(target=serve, args=(args.server, ports, stop), daemon=True)
+        # constants.py resolves Content, Meta and Temp against the working directory the server starts in
+        previous = os.getcwd()
+        os.chdir(work)
+        try:
+            server.start()
+        finally:
+            os.chdir(previous)
+        port = ports.get(timeout=60)
+
+        client = Client(port)
+        (status, _, _) = client.request('POST', '/login', f'password={PASSWORD}',
+                                        {'Content-Type': 'application/x-www-form-urlencoded'})
+        if status != 302:
+            raise SystemExit(f'Login failed with {status}')
+
+        results = []
+        if 'listing' in args.scenarios:
+            results += run_listing(client, files, args)
+        if 'gallery' in args.scenarios:
+            results += run_gallery(client, files, args)
+        if 'video' in args.scenarios:
+            results += run_video_seeks(port, files, args)
+        if 'upload' in args.scenarios:
+            results += run_upload(client, args)
+        client.close()
+
+        stop.set()
+        server_rss = ports.get(timeout=60)
+        write_report('load', args, results, args.output, server_peak_rss_kb=server_rss,
+                     client_peak_rss_kb=peak_rss_kb())
+    finally:
+        if server is not None:
+            stop.set()
+            server.join(10)
+            if server.is_alive():
+                server.terminate()
+        if not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
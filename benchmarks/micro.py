@@ -0,0 +1,93 @@
+import argparse
+import io
+import os
+import random
+import sys
+import time
+from typing import Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants import CHUNK_SIZE, LARGE_CHUNK_SIZE  # noqa: E402
+from encrypter import BinaryIOBytesInStream, BinaryIOBytesOutStream, encrypt, decrypt, encrypt_stream, \
+    decrypt_stream, encrypt_name, decrypt_name, convert_size_of_encrypted_to_real_size  # noqa: E402
+from report import summarize, peak_rss_kb, write_report  # noqa: E402
+
+
+class NullWriter(io.RawIOBase):
+    def writable(self) -> bool:
+        return True
+
+    def write(self, buf) -> int:
+        return len(buf)
+
+
+def measure(function: Callable[[], object], min_time: float, min_ops: int) -> list[float]:
+    function()
+    latencies = []
+    started = time.perf_counter()
+    while len(latencies) < min_ops or time.perf_counter() - started < min_time:
+        op_started = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - op_started)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the encrypter functions')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 64, 1024, 16 * 1024],
+                        help='plaintext sizes in KB')
+    parser.add_argument('--name-lengths', type=int, nargs='+', default=[8, 64, 200])
+    parser.add_argument('--min-time', type=float, default=0.5, help='seconds per benchmark')
+    parser.add_argument('--min-ops', type=int, default=5, help='operations per benchmark')
+    parser.add_argument('--depth', type=int, default=0, help='encrypt_stream pipeline depth, 0 encrypts inline')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    generator = random.Random(0)
+    results = []
+
+    def run(name: str, function: Callable[[], object], size: int = 0, **extra):
+        results.append(summarize(name, measure(function, args.min_time, args.min_ops), size, **extra))
+
+    for size_kb in args.sizes:
+        size = size_kb * 1024
+        data = os.urandom(size)
+        encrypted = encrypt(key, data)
+        run(f'encrypt {size_kb}KB', lambda: encrypt(key, data), size, bytes=size)
+        run(f'decrypt {size_kb}KB', lambda: decrypt(key, encrypted), size, bytes=size)
+
+        for chunk_size in (CHUNK_SIZE, LARGE_CHUNK_SIZE):
+            out = io.BytesIO()
+            encrypt_stream(key, BinaryIOBytesInStream(io.BytesIO(data)), BinaryIOBytesOutStream(out), args.depth, size,
+                           chunk_size)
+            stream = out.getvalue()
+            label = f'{size_kb}KB/{chunk_size // 1024}KB chunks'
+            run(f'encrypt_stream {label}',
+                lambda: encrypt_stream(key, BinaryIOBytesInStream(io.BytesIO(data)),
+                                       BinaryIOBytesOutStream(NullWriter()), args.depth, size, chunk_size),
+                size, bytes=size, chunk_size=chunk_size)
+            run(f'decrypt_stream {label}',
+                lambda: decrypt_stream(key, BinaryIOBytesInStream(io.BytesIO(stream)),
+                                       BinaryIOBytesOutStream(NullWriter())),
+                size, bytes=size, chunk_size=chunk_size)
+
+    for length in args.name_lengths:
+        name = ''.join(generator.choice('abcdefghijklmnopqrstuvwxyz .') for _ in range(length))
+        encrypted_name = encrypt_name(key, name)
+        run(f'encrypt_name {length} chars', lambda: encrypt_name(key, name), length=length)
+        run(f'decrypt_name {length} chars', lambda: decrypt_name(key, encrypted_name), length=length)
+
+    sizes = [generator.randrange(0, 1 << 40) for _ in range(10000)]
+    latencies = measure(lambda: [convert_size_of_encrypted_to_real_size(x) for x in sizes], args.min_time,
+                        args.min_ops)
+    # One operation above converts the whole list, report per conversion
+    results.append(summarize('convert_size_of_encrypted_to_real_size', [x / len(sizes) for x in latencies],
+                             elapsed=sum(latencies) / len(sizes)))
+
+    write_report('micro', args, results, args.output, peak_rss_kb=peak_rss_kb())
+
+
+if __name__ == '__main__':
+    main()
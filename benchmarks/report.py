@@ -0,0 +1,68 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from typing import Optional
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+def summarize(name: str, latencies: list[float], size: int = 0, errors: int = 0,
+              elapsed: Optional[float] = None, **extra) -> dict:
+    # Throughput over the wall time of the run when it is given (concurrent clients), else over the summed latency
+    elapsed = sum(latencies) if elapsed is None else elapsed
+    result = {
+        'name': name,
+        'ops': len(latencies),
+        'errors': errors,
+        'ops_s': len(latencies) / elapsed if elapsed else 0.0,
+        'mb_s': size * len(latencies) / 1024 / 1024 / elapsed if elapsed and size else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+    result.update(extra)
+    return result
+
+
+def peak_rss_kb(who: int = resource.RUSAGE_SELF) -> int:
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def print_results(results: list[dict]):
+    print(f'{"":<40} {"ops":>7} {"ops/s":>10} {"MB/s":>9} {"p50 ms":>9} {"p99 ms":>9} {"errors":>7}', file=sys.stderr)
+    for result in results:
+        print(f'{result["name"]:<40} {result["ops"]:>7} {result["ops_s"]:>10.1f} {result["mb_s"]:>9.1f} '
+              f'{result["p50_ms"]:>9.3f} {result["p99_ms"]:>9.3f} {result["errors"]:>7}', file=sys.stderr)
+
+
+def write_report(suite: str, args: argparse.Namespace, results: list[dict], output: Optional[str], **extra):
+    report = {
+        'suite': suite,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'args': {k: v for (k, v) in vars(args).items() if k != 'output'},
+        'results': results,
+    }
+    report.update(extra)
+    print_results(results)
+    for (name, value) in extra.items():
+        print(f'{name}: {value}', file=sys.stderr)
+
+    data = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
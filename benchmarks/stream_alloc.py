@@ -0,0 +1,91 @@
+import argparse
+import io
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Crypto import Random  # noqa: E402
+from Crypto.Cipher import AES  # noqa: E402
+
+from constants import CHUNK_SIZE, DECRYPT_CHUNK_SIZE, NONCE_SIZE, TAG_SIZE  # noqa: E402
+from encrypter import BinaryIOBytesInStream, BinaryIOBytesOutStream, encrypt_stream, decrypt_stream  # noqa: E402
+
+
+def copying_encrypt_stream(key: bytes, in_stream: BinaryIOBytesInStream, out_stream: BinaryIOBytesOutStream):
+    while True:
+        buf = in_stream.read(CHUNK_SIZE)
+        if not buf:
+            break
+        nonce = Random.new().read(NONCE_SIZE)
+        encrypted, tag = AES.new(key, AES.MODE_GCM, nonce=nonce).encrypt_and_digest(buf)
+        out_stream.write(nonce + encrypted + tag)
+
+
+def copying_decrypt_stream(key: bytes, in_stream: BinaryIOBytesInStream, out_stream: BinaryIOBytesOutStream):
+    while True:
+        buf = in_stream.read(DECRYPT_CHUNK_SIZE)
+        if not buf:
+            break
+        decrypter = AES.new(key, AES.MODE_GCM, nonce=buf[:NONCE_SIZE])
+        out_stream.write(decrypter.decrypt_and_verify(buf[NONCE_SIZE:-TAG_SIZE], buf[-TAG_SIZE:]))
+
+
+class NullWriter(io.RawIOBase):
+    def writable(self) -> bool:
+        return True
+
+    def write(self, buf) -> int:
+        return len(buf)
+
+
+def run(name: str, function, source: bytes, size: int, repeat: int) -> dict:
+    elapsed = float('inf')
+    faults = 0
+    for _ in range(repeat):
+        minflt = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+        started = time.perf_counter()
+        function(BinaryIOBytesInStream(io.BytesIO(source)), BinaryIOBytesOutStream(NullWriter()))
+        elapsed = min(elapsed, time.perf_counter() - started)
+        faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - minflt
+
+    tracemalloc.start()
+    function(BinaryIOBytesInStream(io.BytesIO(source)), BinaryIOBytesOutStream(NullWriter()))
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'name': name, 'mb_s': size / 1024 / 1024 / elapsed, 'page_faults': faults, 'peak_kb': peak / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare buffer reuse against per-chunk allocation')
+    parser.add_argument('--size', type=int, default=64, help='plaintext size in MB')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per variant, the fastest is reported')
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    data = os.urandom(args.size * 1024 * 1024)
+
+    legacy = io.BytesIO()
+    copying_encrypt_stream(key, BinaryIOBytesInStream(io.BytesIO(data)), BinaryIOBytesOutStream(legacy))
+    current = io.BytesIO()
+    encrypt_stream(key, BinaryIOBytesInStream(io.BytesIO(data)), BinaryIOBytesOutStream(current), size=len(data))
+
+    size = len(data)
+    results = [
+        run('encrypt (copying)', lambda i, o: copying_encrypt_stream(key, i, o), data, size, args.repeat),
+        run('encrypt_stream', lambda i, o: encrypt_stream(key, i, o, size=size), data, size, args.repeat),
+        run('decrypt (copying)', lambda i, o: copying_decrypt_stream(key, i, o), legacy.getvalue(), size, args.repeat),
+        run('decrypt_stream', lambda i, o: decrypt_stream(key, i, o), current.getvalue(), size, args.repeat),
+    ]
+
+    print(f'{"":<20} {"MB/s":>8} {"page faults":>12} {"peak KB":>9}')
+    for result in results:
+        print(f'{result["name"]:<20} {result["mb_s"]:>8.1f} {result["page_faults"]:>12} {result["peak_kb"]:>9.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+def count_one(_: Any) -> int:
+    return 1
+
+
+class LRUCache:
+    def __init__(self, max_size: int, sizeof: Callable[[Any], int] = count_one):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self.lock = threading.RLock()
+        self.entries: OrderedDict[Hashable, Any] = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key: Hashable, value: Any, generation: Optional[int] = None):
+        size = self.sizeof(value)
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.pop(key)
+            if size > self.max_size:
+                return
+            self.entries[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.size -= self.sizeof(value)
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.generation += 1
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'size': self.size}
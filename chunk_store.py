@@ -0,0 +1,206 @@
+import os
+import secrets
+import struct
+import threading
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple
+
+from constants import CONTENT_PATH, CHUNKS_PATH, CHUNK_REFS_PATH, ENCRYPTED_FILE_PREFIX
+from encrypter import FLAG_DEDUP, CHUNK_ID_SIZE, CHUNK_ENTRY_SIZE, BinaryIOBytesInStream, encrypt, decrypt, \
+    encrypt_into, read_header, chunk_id, chunk_id_key, chunk_path
+
+RECORD_HEADER = struct.Struct('>I')
+COUNT = struct.Struct('>I')
+
+ADD = b'+'
+RELEASE = b'-'
+SET = b'='
+
+
+class ChunkWriter:
+    def __init__(self, store: 'ChunkStore'):
+        self.store = store
+        self.ids: list[bytes] = []
+
+    def add(self, key: bytes, source: memoryview, target: memoryview) -> bytes:
+        digest = chunk_id(self.store.id_key, source)
+        self.ids.append(digest)
+        if self.store.acquire(digest):
+            self.store.write_chunk(digest, encrypt_into(key, source, target))
+        return encrypt(key, digest)
+
+    def commit(self):
+        self.store.record(ADD, self.ids)
+
+    def abort(self):
+        self.store.release(self.ids, False)
+
+
+class ChunkStore:
+    def __init__(self, key: bytes, path: str = CHUNKS_PATH, refs_path: str = CHUNK_REFS_PATH):
+        self.key = key
+        self.id_key = chunk_id_key(key)
+        self.path = path
+        self.refs_path = refs_path
+        self.refs: dict[bytes, int] = {}
+        self.lock = threading.Lock()
+        self.journal: Optional[BinaryIO] = None
+
+    def open(self):
+        with self.lock:
+            if os.path.exists(self.refs_path):
+                self.load()
+            elif os.path.isdir(self.path):
+                # Without the journal the counts are rebuilt from the files that reference the chunks
+                self.refs = self.count_references()
+            self.compact()
+            self.journal = open(self.refs_path, 'ab')
+
+    def close(self):
+        with self.lock:
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+
+    def load(self):
+        with open(self.refs_path, 'rb') as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                (size,) = RECORD_HEADER.unpack(header)
+                try:
+                    record = decrypt(self.key, f.read(size))
+                except ValueError:
+                    break
+
+                (op, body) = (record[:1], record[1:])
+                if op == SET:
+                    step = CHUNK_ID_SIZE + COUNT.size
+                    for i in range(0, len(body), step):
+                        (self.refs[body[i:i + CHUNK_ID_SIZE]],) = COUNT.unpack_from(body, i + CHUNK_ID_SIZE)
+                    continue
+                for i in range(0, len(body), CHUNK_ID_SIZE):
+                    digest = body[i:i + CHUNK_ID_SIZE]
+                    count = self.refs.get(digest, 0) + (1 if op == ADD else -1)
+                    if count > 0:
+                        self.refs[digest] = count
+                    else:
+                        self.refs.pop(digest, None)
+
+    def compact(self):
+        temp = self.refs_path + '_compact'
+        with open(temp, 'wb') as f:
+            body = b''.join(digest + COUNT.pack(count) for (digest, count) in self.refs.items())
+            self.write(f, SET + body)
+        os.replace(temp, self.refs_path)
+
+    def write(self, out: BinaryIO, record: bytes):
+        body = encrypt(self.key, record)
+        out.write(RECORD_HEADER.pack(len(body)) + body)
+
+    def append(self, record: bytes):
+        if self.journal:
+            self.write(self.journal, record)
+            self.journal.flush()
+            return
+        # A write that was still running at logout must not lose its references
+        with open(self.refs_path, 'ab') as f:
+            self.write(f, record)
+
+    def record(self, op: bytes, ids: list[bytes]):
+        if not ids:
+            return
+        with self.lock:
+            self.append(op + b''.join(ids))
+
+    def writer(self) -> ChunkWriter:
+        return ChunkWriter(self)
+
+    def acquire(self, digest: bytes) -> bool:
+        with self.lock:
+            count = self.refs.get(digest, 0)
+            self.refs[digest] = count + 1
+        # Two writers of a new chunk may both write it, the copies are interchangeable
+        return count == 0 or not os.path.exists(chunk_path(digest))
+
+    def write_chunk(self, digest: bytes, data: memoryview):
+        target = chunk_path(digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp = target + '_' + secrets.token_hex(8)
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, target)
+
+    def release(self, ids: list[bytes], journal: bool = True):
+        removed = []
+        with self.lock:
+            for digest in ids:
+                count = self.refs.get(digest, 0) - 1
+                if count > 0:
+                    self.refs[digest] = count
+                else:
+                    self.refs.pop(digest, None)
+                    removed.append(digest)
+            if journal:
+                self.append(RELEASE + b''.join(ids))
+            for digest in removed:
+                try:
+                    os.remove(chunk_path(digest))
+                except FileNotFoundError:
+                    pass
+
+    def read_ids(self, path: str | Path) -> Optional[list[bytes]]:
+        with open(path, 'rb') as f:
+            in_stream = BinaryIOBytesInStream(f)
+            header = read_header(self.key, in_stream)
+            if not header.flags & FLAG_DEDUP:
+                return None
+            in_stream.seek(header.header_size)
+            data = in_stream.read(CHUNK_ENTRY_SIZE * header.chunk_count())
+        return [decrypt(self.key, data[i:i + CHUNK_ENTRY_SIZE]) for i in range(0, len(data), CHUNK_ENTRY_SIZE)]
+
+    def remove_file(self, path: str | Path):
+        try:
+            ids = self.read_ids(path)
+        except ValueError:
+            ids = None
+        os.remove(path)
+        if ids:
+            self.release(ids)
+
+    def count_references(self) -> dict[bytes, int]:
+        refs: dict[bytes, int] = {}
+        for (root, directories, files) in os.walk(CONTENT_PATH):
+            directories[:] = [x for x in directories if Path(root, x) != Path(self.path)]
+            for name in files:
+                if not name.startswith(ENCRYPTED_FILE_PREFIX):
+                    continue
+                try:
+                    ids = self.read_ids(os.path.join(root, name))
+                except (OSError, ValueError):
+                    continue
+                for digest in ids or []:
+                    refs[digest] = refs.get(digest, 0) + 1
+        return refs
+
+    def collect_garbage(self) -> Tuple[int, int]:
+        # Recounts references from the files themselves, fixes counts left behind by interrupted writes
+        refs = self.count_references()
+        removed = 0
+        with self.lock:
+            for (root, _, files) in os.walk(self.path):
+                for name in files:
+                    try:
+                        digest = bytes.fromhex(name)
+                    except ValueError:
+                        digest = None
+                    if digest not in refs:
+                        os.remove(os.path.join(root, name))
+                        removed += 1
+            self.refs = refs
+            self.compact()
+            if self.journal:
+                self.journal.close()
+                self.journal = open(self.refs_path, 'ab')
+        return len(refs), removed
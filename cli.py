@@ -0,0 +1,359 @@
+import argparse
+import getpass
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+from constants import CONTENT_PATH, META_PATH, KEY_PATH, TEMP_PATH, ENCRYPTED_FILE_PREFIX, ENCRYPT_FILE_WORKERS, \
+    ENCRYPT_PIPELINE_DEPTH, CLI_PROGRESS_INTERVAL_SECONDS, SCRUB_WORKERS, SCRUB_MAX_MB_PER_SECOND, SCRUB_REPORT_PATH, \
+    SYNC_WORKERS, DEDUP_ENABLED, COMPRESSION_ENABLED
+from encrypter import BinaryIOBytesInStream, BinaryIOBytesOutStream, encrypt_name, decrypt_name, encrypt_copy, \
+    decrypt_stream, decrypt_chunks, read_header, get_header, unlock_key, decrypt_path
+from chunk_store import ChunkStore
+from scrub import scrub
+from sync import sync
+
+
+class Progress:
+    def __init__(self, files: int, size: int):
+        self.files = files
+        self.size = size
+        self.files_done = 0
+        self.bytes_done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.printed = 0.0
+        self.lock = threading.Lock()
+
+    def advance(self, size: int, failed: bool = False):
+        with self.lock:
+            self.files_done += 1
+            self.bytes_done += size
+            self.failed += failed
+            now = time.monotonic()
+            if now - self.printed >= CLI_PROGRESS_INTERVAL_SECONDS or self.files_done == self.files:
+                self.printed = now
+                self.print(now)
+
+    def print(self, now: float):
+        elapsed = max(now - self.started, 1e-9)
+        speed = self.bytes_done / elapsed / 1024 / 1024
+        failed = f', {self.failed} failed' if self.failed else ''
+        print(f'\r{self.files_done}/{self.files} files, {self.bytes_done / 1024 / 1024:.1f}/'
+              f'{self.size / 1024 / 1024:.1f} MB, {speed:.1f} MB/s{failed}',
+              end='\n' if self.files_done == self.files else '', file=sys.stderr, flush=True)
+
+
+def read_password(args: argparse.Namespace) -> str:
+    if args.password_file:
+        with open(args.password_file) as f:
+            return f.readline().rstrip('\r\n')
+    return getpass.getpass()
+
+
+def open_key(args: argparse.Namespace) -> bytes:
+    if not os.path.exists(KEY_PATH) and os.path.exists(CONTENT_PATH) and len(os.listdir(CONTENT_PATH)) > 0:
+        raise SystemExit(f'{KEY_PATH} doesnt exist. Cant open content without it.')
+
+    os.makedirs(META_PATH, exist_ok=True)
+    os.makedirs(CONTENT_PATH, exist_ok=True)
+    os.makedirs(TEMP_PATH, exist_ok=True)
+    try:
+        return unlock_key(read_password(args))
+    except ValueError:
+        raise SystemExit('Wrong password')
+
+
+def list_encrypted(key: bytes, path: Path) -> dict[str, str]:
+    names = {}
+    for name in os.listdir(path):
+        if name.startswith(ENCRYPTED_FILE_PREFIX):
+            try:
+                names[decrypt_name(key, name)] = name
+            except ValueError:
+                pass
+    return names
+
+
+def resolve(key: bytes, path: str) -> Path:
+    result = Path(CONTENT_PATH)
+    for part in Path(path).parts:
+        if part in ('/', '\\', '.'):
+            continue
+        names = list_encrypted(key, result)
+        if part not in names:
+            raise SystemExit(f'{path} not found')
+        result = result.joinpath(names[part])
+    return result
+
+
+def run_parallel(tasks: list[Tuple[Callable, tuple, int]], workers: int) -> Progress:
+    progress = Progress(len(tasks), sum(x[2] for x in tasks))
+
+    def run(task: Callable, args: tuple, size: int):
+        try:
+            task(*args)
+        except (OSError, ValueError) as e:
+            print(f'\n{args[1]}: {e}', file=sys.stderr)
+            progress.advance(size, True)
+            return
+        progress.advance(size)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(run, *x) for x in tasks]:
+            future.result()
+    if not tasks:
+        print('Nothing to do', file=sys.stderr)
+    return progress
+
+
+def import_command(key: bytes, args: argparse.Namespace) -> int:
+    source = Path(args.source)
+    target = resolve(key, args.target)
+    tasks = []
+    skipped = 0
+
+    def walk(path: Path, parent: Path):
+        nonlocal skipped
+        existing = list_encrypted(key, parent)
+        for entry in sorted(os.scandir(path), key=lambda x: x.name):
+            if entry.is_dir():
+                if entry.name in existing:
+                    directory = parent.joinpath(existing[entry.name])
+                else:
+                    directory = parent.joinpath(encrypt_name(key, entry.name))
+                    os.makedirs(directory)
+                walk(Path(entry.path), directory)
+            elif entry.is_file():
+                if entry.name in existing:
+                    skipped += 1
+                    continue
+                tasks.append((encrypt_copy,
+                              (key, Path(entry.path), parent.joinpath(encrypt_name(key, entry.name)), args.depth,
+                               store, args.compress),
+                              entry.stat().st_size))
+
+    store = ChunkStore(key) if args.dedup else None
+    if source.is_dir():
+        walk(source, target)
+    else:
+        tasks.append((encrypt_copy,
+                      (key, source, target.joinpath(encrypt_name(key, source.name)), args.depth, store, args.compress),
+                      source.stat().st_size))
+
+    if skipped:
+        print(f'Skipped {skipped} files that already exist', file=sys.stderr)
+    if store is None:
+        return 1 if run_parallel(tasks, args.workers).failed else 0
+    store.open()
+    try:
+        return 1 if run_parallel(tasks, args.workers).failed else 0
+    finally:
+        store.close()
+
+
+def export_file(key: bytes, source: Path, target: Path):
+    temp = target.with_name(target.name + '.part')
+    with open(source, 'rb') as f_in, open(temp, 'wb') as f_out:
+        decrypt_stream(key, BinaryIOBytesInStream(f_in), BinaryIOBytesOutStream(f_out))
+    os.replace(temp, target)
+
+
+def export_command(key: bytes, args: argparse.Namespace) -> int:
+    source = resolve(key, args.source)
+    target = Path(args.target)
+    tasks = []
+
+    def walk(path: Path, parent: Path):
+        os.makedirs(parent, exist_ok=True)
+        for name, encrypted_name in sorted(list_encrypted(key, path).items()):
+            entry = path.joinpath(encrypted_name)
+            if entry.is_dir():
+                walk(entry, parent.joinpath(name))
+            elif not parent.joinpath(name).exists():
+                tasks.append((export_file, (key, entry, parent.joinpath(name)), entry.stat().st_size))
+
+    if source.is_dir():
+        walk(source, target)
+    else:
+        os.makedirs(target, exist_ok=True)
+        tasks.append((export_file, (key, source, target.joinpath(decrypt_name(key, source.name))),
+                      source.stat().st_size))
+
+    return 1 if run_parallel(tasks, args.workers).failed else 0
+
+
+def ls_command(key: bytes, args: argparse.Namespace) -> int:
+    path = resolve(key, args.path)
+    for name, encrypted_name in sorted(list_encrypted(key, path).items()):
+        entry = path.joinpath(encrypted_name)
+        if entry.is_dir():
+            print(f'{"":>12}  {name}/')
+        else:
+            print(f'{get_header(key, entry).size:>12}  {name}')
+    return 0
+
+
+def cat_command(key: bytes, args: argparse.Namespace) -> int:
+    path = resolve(key, args.path)
+    with open(path, 'rb') as f:
+        decrypt_stream(key, BinaryIOBytesInStream(f), BinaryIOBytesOutStream(sys.stdout.buffer))
+    sys.stdout.buffer.flush()
+    return 0
+
+
+def verify_file(key: bytes, path: Path):
+    with open(path, 'rb') as f:
+        in_stream = BinaryIOBytesInStream(f)
+        with closing(decrypt_chunks(key, in_stream, read_header(key, in_stream), 0)) as chunks:
+            for _ in chunks:
+                pass
+
+
+def verify_command(key: bytes, args: argparse.Namespace) -> int:
+    path = resolve(key, args.path)
+    tasks = []
+
+    def walk(directory: Path):
+        for entry in os.scandir(directory):
+            if not entry.name.startswith(ENCRYPTED_FILE_PREFIX):
+                continue
+            if entry.is_dir():
+                walk(Path(entry.path))
+            else:
+                tasks.append((verify_file, (key, Path(entry.path)), entry.stat().st_size))
+
+    if path.is_dir():
+        walk(path)
+    else:
+        tasks.append((verify_file, (key, path), path.stat().st_size))
+
+    progress = run_parallel(tasks, args.workers)
+    print(f'{progress.files_done - progress.failed} ok, {progress.failed} failed')
+    return 1 if progress.failed else 0
+
+
+def display_path(key: bytes, relative_path: str) -> str:
+    try:
+        return decrypt_path(key, relative_path)
+    except ValueError:
+        return relative_path
+
+
+def scrub_command(key: bytes, args: argparse.Namespace) -> int:
+    progress: Optional[Progress] = None
+
+    def planned(files: int, size: int):
+        nonlocal progress
+        progress = Progress(files, size)
+
+    def scrubbed(relative_path: str, size: int, errors: list[dict]):
+        if errors:
+            print(f'\n{display_path(key, relative_path)}: {len(errors)} damaged chunks', file=sys.stderr)
+        progress.advance(size, bool(errors))
+
+    report = scrub(key, args.workers, args.rate * 1024 * 1024, scrubbed, args.restart, planned)
+    for name in report['damaged_names']:
+        print(f'Damaged name: {name}')
+    for damaged in report['damaged_files']:
+        name = display_path(key, damaged['path'])
+        for error in damaged['errors']:
+            print(f'{name}: chunk {error["chunk"]} at offset {error["offset"]}: {error["error"]}')
+    print(f'{report["files"]} files, {len(report["damaged_files"])} damaged, {len(report["damaged_names"])} damaged '
+          f'names, report saved to {SCRUB_REPORT_PATH}')
+    return 1 if report['damaged_files'] or report['damaged_names'] else 0
+
+
+def gc_command(key: bytes, _: argparse.Namespace) -> int:
+    store = ChunkStore(key)
+    store.open()
+    try:
+        (chunks, removed) = store.collect_garbage()
+    finally:
+        store.close()
+    print(f'{chunks} chunks referenced, {removed} unreferenced chunks removed')
+    return 0
+
+
+def sync_command(key: bytes, args: argparse.Namespace) -> int:
+    progress: Optional[Progress] = None
+
+    def planned(files: int, size: int):
+        nonlocal progress
+        progress = Progress(files, size)
+
+    def synced(relative_path: str, size: int, state: Optional[str], error: Optional[Exception]):
+        if error:
+            print(f'\n{display_path(key, relative_path)}: {error}', file=sys.stderr)
+        progress.advance(size, error is not None)
+
+    if os.path.abspath(args.target) == os.getcwd():
+        raise SystemExit('Target is the current store')
+    report = sync(key, args.target, args.workers, synced, args.delete, planned)
+    print(f'{report["copied"]} copied, {report["patched"]} patched, {report["unchanged"]} unchanged, '
+          f'{report["failed"]} failed, {report["removed"]} removed, '
+          f'{report["bytes_copied"] / 1024 / 1024:.1f} MB written')
+    return 1 if report['failed'] else 0
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Work with the encrypted Content folder without the web server')
+    parser.add_argument('--password-file', help='read the password from the first line of this file')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('import', help='encrypt files from the filesystem into Content')
+    command.add_argument('source')
+    command.add_argument('target', nargs='?', default='/', help='directory in Content')
+    command.add_argument('--workers', type=int, default=ENCRYPT_FILE_WORKERS)
+    command.add_argument('--depth', type=int, default=ENCRYPT_PIPELINE_DEPTH, help='chunks encrypted ahead per file')
+    command.add_argument('--dedup', action='store_true', default=DEDUP_ENABLED,
+                         help='store chunks that already exist in Content only once')
+    command.add_argument('--compress', action='store_true', default=COMPRESSION_ENABLED,
+                         help='compress the chunks of files that compress well')
+    command.set_defaults(run=import_command)
+
+    command = commands.add_parser('export', help='decrypt files or directories from Content to the filesystem')
+    command.add_argument('source', help='file or directory in Content')
+    command.add_argument('target')
+    command.add_argument('--workers', type=int, default=ENCRYPT_FILE_WORKERS)
+    command.set_defaults(run=export_command)
+
+    command = commands.add_parser('ls', help='list a directory in Content')
+    command.add_argument('path', nargs='?', default='/')
+    command.set_defaults(run=ls_command)
+
+    command = commands.add_parser('cat', help='decrypt a file in Content to stdout')
+    command.add_argument('path')
+    command.set_defaults(run=cat_command)
+
+    command = commands.add_parser('verify', help='check every chunk of the files in Content')
+    command.add_argument('path', nargs='?', default='/')
+    command.add_argument('--workers', type=int, default=ENCRYPT_FILE_WORKERS)
+    command.set_defaults(run=verify_command)
+
+    command = commands.add_parser('scrub', help='verify every chunk and name in Content in the background')
+    command.add_argument('--workers', type=int, default=SCRUB_WORKERS, help='worker processes')
+    command.add_argument('--rate', type=float, default=SCRUB_MAX_MB_PER_SECOND, help='read limit in MB/s, 0 for none')
+    command.add_argument('--restart', action='store_true', help='ignore the checkpoint of an interrupted scrub')
+    command.set_defaults(run=scrub_command)
+
+    command = commands.add_parser('gc', help='recount chunk references and remove unreferenced deduplicated chunks')
+    command.set_defaults(run=gc_command)
+
+    command = commands.add_parser('sync', help='mirror Content to another directory, copying only changed chunks')
+    command.add_argument('target', help='directory that gets Content and Meta/key, e.g. a mounted backup disk')
+    command.add_argument('--workers', type=int, default=SYNC_WORKERS)
+    command.add_argument('--delete', action='store_true', help='remove files that no longer exist in Content')
+    command.set_defaults(run=sync_command)
+
+    args = parser.parse_args(argv)
+    return args.run(open_key(args), args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
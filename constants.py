@@ -13,3 +13,59 @@ CHUNK_SIZE = 128 * 1024
 DECRYPT_CHUNK_SIZE = NONCE_SIZE + CHUNK_SIZE + TAG_SIZE
 SLASH_REPLACER = '-'
 ENCRYPTED_FILE_PREFIX = '_'
+DIRECTORY_CACHE_SIZE = 64
+INDEX_PATH = META_PATH + '/index'
+INDEX_COMPACT_MIN_RECORDS = 1024
+SEARCH_RESULTS_LIMIT = 500
+CHUNK_CACHE_SIZE = 64 * 1024 * 1024
+CRYPTO_WORKERS = os.cpu_count() or 1
+DECRYPT_READ_AHEAD = 4
+DECRYPT_READ_AHEAD_MAX_BYTES = 64 * 1024 * 1024
+ENCRYPT_PIPELINE_DEPTH = 2 * CRYPTO_WORKERS
+ENCRYPT_FILE_WORKERS = CRYPTO_WORKERS
+MULTIPART_READ_SIZE = 64 * 1024
+MULTIPART_MAX_HEADER_SIZE = 16 * 1024
+UPLOADS_PATH = TEMP_PATH + '/uploads'
+UPLOAD_EXPIRY_SECONDS = 24 * 60 * 60
+SAVE_TEMP_PREFIX = 'upload_'
+ENCRYPT_TEMP_PREFIX = 'encrypt_'
+FILE_MAGIC = b'AESF'
+FILE_VERSION = 1
+LARGE_CHUNK_SIZE = 1024 * 1024
+MMAP_MIN_SIZE = 4 * 1024 * 1024
+TEXT_PAGE_SIZE = 256 * 1024
+SERVER_ENGINE = 'async'
+ASYNC_WORKERS = 32
+MAX_DECRYPT_STREAMS = max(4, 2 * CRYPTO_WORKERS)
+HTTP_MAX_HEADER_SIZE = 64 * 1024
+KEEP_ALIVE_TIMEOUT_SECONDS = 15
+WRITE_TIMEOUT_SECONDS = 60
+THUMBNAILS_PATH = META_PATH + '/thumbnails'
+THUMBNAIL_SIZE = 256
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_WORKERS = CRYPTO_WORKERS
+THUMBNAIL_MAX_SOURCE_SIZE = 64 * 1024 * 1024
+GALLERY_PAGE_SIZE = 100
+JOBS_PATH = META_PATH + '/jobs'
+JOB_WORKERS = 2
+CLI_PROGRESS_INTERVAL_SECONDS = 0.5
+SCRUB_CHECKPOINT_PATH = META_PATH + '/scrub_checkpoint'
+SCRUB_REPORT_PATH = META_PATH + '/scrub_report.json'
+SCRUB_WORKERS = CRYPTO_WORKERS
+SCRUB_MAX_MB_PER_SECOND = 50
+MANIFESTS_PATH = META_PATH + '/manifests'
+SYNC_WORKERS = 4
+SYNC_READ_SIZE = 1024 * 1024
+CHUNKS_DIR_NAME = '.chunks'
+CHUNKS_PATH = CONTENT_PATH + '/' + CHUNKS_DIR_NAME
+CHUNK_REFS_PATH = META_PATH + '/chunk_refs'
+DEDUP_ENABLED = False
+COMPRESSION_ENABLED = False
+COMPRESSION_LEVEL = 6
+COMPRESSION_MIN_SAVING = 0.1
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PROFILE_RATE = 0.0
+ARCHIVE_READ_AHEAD_FILES = 2 * CRYPTO_WORKERS
+ARCHIVE_SMALL_FILE_SIZE = LARGE_CHUNK_SIZE
+LISTING_PAGE_SIZE = 1000
+LISTING_FLUSH_ROWS = 100
@@ -1,41 +1,120 @@
 import base64
+import hmac
+import io
+import mimetypes
+import mmap
 import os
+import secrets
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
 from math import ceil
 from pathlib import Path
-from typing import BinaryIO, Callable
+from typing import BinaryIO, Callable, Hashable, Iterator, Optional, Tuple
 
-from Crypto import Random
 from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
 from Crypto.Hash import SHA256
 
+from cache import LRUCache
 from constants import ENCODING, NONCE_SIZE, SLASH_REPLACER, ENCRYPTED_FILE_PREFIX, CHUNK_SIZE, DECRYPT_CHUNK_SIZE, \
-    TAG_SIZE
+    TAG_SIZE, CRYPTO_WORKERS, DECRYPT_READ_AHEAD_MAX_BYTES, ENCRYPT_FILE_WORKERS, FILE_MAGIC, FILE_VERSION, \
+    LARGE_CHUNK_SIZE, TEMP_PATH, KEY_PATH, CHUNKS_PATH, COMPRESSION_LEVEL, COMPRESSION_MIN_SAVING, \
+    ENCRYPT_TEMP_PREFIX
+from metrics import METRICS
 from path_utils import map_path
 
+HEADER_STRUCT = struct.Struct('>4sBBHIQ')
+HEADER_SIZE = HEADER_STRUCT.size + NONCE_SIZE + TAG_SIZE
+
+# The body is a list of encrypted chunk ids, the chunks are stored once in the chunk store
+FLAG_DEDUP = 1
+CHUNK_ID_SIZE = 32
+CHUNK_ENTRY_SIZE = NONCE_SIZE + CHUNK_ID_SIZE + TAG_SIZE
+
+# Chunks hold a method byte and the (maybe) compressed data, an encrypted table of chunk lengths ends the file
+FLAG_COMPRESSED = 2
+KNOWN_FLAGS = FLAG_DEDUP | FLAG_COMPRESSED
+STORED = 0
+DEFLATED = 1
+CHUNK_LENGTH = struct.Struct('>I')
+TABLE_SIZE = struct.Struct('>Q')
+INCOMPRESSIBLE_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp', 'application/zip', 'application/gzip',
+                        'application/x-7z-compressed', 'application/x-rar-compressed', 'application/x-bzip2',
+                        'application/x-xz', 'application/pdf')
+
+
+class ByteBudget:
+    def __init__(self, size: int):
+        self.available = size
+        self.lock = threading.Lock()
+
+    def acquire(self, size: int) -> bool:
+        with self.lock:
+            if size > self.available:
+                return False
+            self.available -= size
+            return True
+
+    def release(self, size: int):
+        with self.lock:
+            self.available += size
+
+
+CHUNK_EXECUTOR = ThreadPoolExecutor(max_workers=CRYPTO_WORKERS, thread_name_prefix='chunk')
+READ_AHEAD_BUDGET = ByteBudget(DECRYPT_READ_AHEAD_MAX_BYTES)
+
 
 class BytesInStream:
     def read(self, size: int = -1) -> bytes:
         """read"""
         pass
 
+    def readinto(self, buf: bytearray | memoryview) -> int:
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
     def seek(self, position: int):
         """seek"""
         pass
 
+    def size(self) -> int:
+        """size"""
+        pass
+
+    def view(self, position: int, size: int) -> Optional[memoryview]:
+        return None
+
 
 class InMemoryBytesInStream(BytesInStream):
-    def __init__(self):
-        self.buf = bytes()
+    def __init__(self, buf: bytes = bytes()):
+        self.buf = buf
         self.position = 0
 
     def read(self, size: int = -1):
         if size == -1:
-            return self.buf[self.position:]
-        return self.buf[self.position:size]
+            size = len(self.buf) - self.position
+        buf = self.buf[self.position:self.position + size]
+        self.position += len(buf)
+        return buf
+
+    def readinto(self, buf: bytearray | memoryview) -> int:
+        size = min(len(buf), len(self.buf) - self.position)
+        buf[:size] = memoryview(self.buf)[self.position:self.position + size]
+        self.position += size
+        return size
 
     def seek(self, position: int):
         self.position = position
 
+    def size(self) -> int:
+        return len(self.buf)
+
 
 class BinaryIOBytesInStream(BytesInStream):
     def __init__(self, in_stream: BinaryIO):
@@ -46,22 +125,141 @@ class BinaryIOBytesInStream(BytesInStream):
             return self.in_stream.read()
         return self.in_stream.read(size)
 
+    def readinto(self, buf: bytearray | memoryview) -> int:
+        return self.in_stream.readinto(buf)
+
     def seek(self, position: int):
         self.in_stream.seek(position)
 
+    def size(self) -> int:
+        return os.fstat(self.in_stream.fileno()).st_size
+
+
+class MmapBytesInStream(BytesInStream):
+    def __init__(self, in_stream: BinaryIO):
+        self.map = mmap.mmap(in_stream.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self.map)
+        self.position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size == -1:
+            size = len(self.buf) - self.position
+        buf = self.buf[self.position:self.position + size].tobytes()
+        self.position += len(buf)
+        return buf
+
+    def readinto(self, buf: bytearray | memoryview) -> int:
+        size = min(len(buf), len(self.buf) - self.position)
+        buf[:size] = self.buf[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def seek(self, position: int):
+        self.position = position
+
+    def size(self) -> int:
+        return len(self.buf)
+
+    def view(self, position: int, size: int) -> Optional[memoryview]:
+        self.position = min(position + size, len(self.buf))
+        return self.buf[position:self.position]
+
+    def advise(self, sequential: bool):
+        advice = getattr(mmap, 'MADV_SEQUENTIAL' if sequential else 'MADV_RANDOM', None)
+        if advice is not None:
+            self.map.madvise(advice)
+
+    def close(self):
+        self.buf.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # A cancelled read-ahead task may still hold a slice, the mapping is released with it
+            pass
+
+
+# Presents a deduplicated file with the layout of a regular one, chunks are read from the chunk store
+class ChunkListBytesInStream(BytesInStream):
+    def __init__(self, key: bytes, in_stream: BytesInStream, header: 'FileHeader'):
+        self.key = key
+        self.in_stream = in_stream
+        self.header = header
+        self.position = 0
+        self.loaded: Tuple[int, Optional[memoryview]] = (-1, None)
+
+    def chunk_id(self, index: int) -> bytes:
+        self.in_stream.seek(self.header.header_size + CHUNK_ENTRY_SIZE * index)
+        entry = self.in_stream.read(CHUNK_ENTRY_SIZE)
+        if len(entry) != CHUNK_ENTRY_SIZE:
+            raise ValueError(f'Chunk {index} is missing from the chunk list')
+        try:
+            return decrypt(self.key, entry)
+        except ValueError as e:
+            raise ValueError(f'Chunk {index} failed verification: {e}') from e
+
+    def load(self, index: int) -> memoryview:
+        if self.loaded[0] != index:
+            try:
+                with open(chunk_path(self.chunk_id(index)), 'rb') as f:
+                    self.loaded = (index, memoryview(f.read()))
+            except FileNotFoundError:
+                raise ValueError(f'Chunk {index} is missing from the chunk store')
+        return self.loaded[1]
+
+    def read(self, size: int = -1) -> bytes:
+        buf = bytearray(self.size() - self.position if size == -1 else size)
+        return bytes(buf[:self.readinto(buf)])
+
+    def readinto(self, buf: bytearray | memoryview) -> int:
+        stride = self.header.chunk_size + NONCE_SIZE + TAG_SIZE
+        (index, offset) = divmod(self.position - self.header.header_size, stride)
+        if self.position < self.header.header_size or index >= self.header.chunk_count():
+            return 0
+        chunk = self.load(index)[offset:offset + len(buf)]
+        buf[:len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+    def seek(self, position: int):
+        self.position = position
+
+    def size(self) -> int:
+        return self.header.encrypted_size()
+
+    def view(self, position: int, size: int) -> Optional[memoryview]:
+        self.seek(position)
+        (index, offset) = divmod(position - self.header.header_size, self.header.chunk_size + NONCE_SIZE + TAG_SIZE)
+        if offset or position < self.header.header_size or index >= self.header.chunk_count():
+            return None
+        self.position += size
+        return self.load(index)[:size]
+
 
 class BytesOutStream:
     def write(self, buf: bytes):
         """write"""
         pass
 
+    def write_many(self, buffers: list[bytes | memoryview]):
+        for buf in buffers:
+            self.write(buf)
+
+    def seek(self, position: int):
+        """seek"""
+        pass
+
 
 class InMemoryBytesOutStream(BytesOutStream):
     def __init__(self):
-        self.buf = bytes()
+        self.buf = bytearray()
+        self.position = 0
 
     def write(self, buf: bytes):
-        self.buf += buf
+        self.buf[self.position:self.position + len(buf)] = buf
+        self.position += len(buf)
+
+    def seek(self, position: int):
+        self.position = position
 
 
 class BinaryIOBytesOutStream(BytesOutStream):
@@ -71,16 +269,111 @@ class BinaryIOBytesOutStream(BytesOutStream):
     def write(self, buf: bytes):
         self.out_stream.write(buf)
 
+    def write_many(self, buffers: list[bytes | memoryview]):
+        if not hasattr(os, 'writev') or not isinstance(self.out_stream, (io.BufferedWriter, io.FileIO)):
+            super().write_many(buffers)
+            return
+
+        self.out_stream.flush()
+        fd = self.out_stream.fileno()
+        views = [memoryview(x).cast('B') for x in buffers if len(x)]
+        while views:
+            written = os.writev(fd, views)
+            while views and written >= len(views[0]):
+                written -= len(views[0])
+                views.pop(0)
+            if views and written:
+                views[0] = views[0][written:]
+
+    def seek(self, position: int):
+        self.out_stream.seek(position)
+
+
+class FileHeader:
+    __slots__ = ('version', 'flags', 'chunk_size', 'size', 'header_size', 'offsets', 'table_size')
+
+    def __init__(self, version: int, flags: int, chunk_size: int, size: int, header_size: int):
+        self.version = version
+        self.flags = flags
+        self.chunk_size = chunk_size
+        self.size = size
+        self.header_size = header_size
+        self.offsets: Optional[list[int]] = None
+        self.table_size = 0
+
+    def chunk_count(self) -> int:
+        return ceil(self.size / self.chunk_size)
+
+    def chunk_offset(self, index: int) -> int:
+        if self.offsets is not None:
+            return self.offsets[index]
+        return self.header_size + (self.chunk_size + NONCE_SIZE + TAG_SIZE) * index
+
+    def chunk_length(self, index: int) -> int:
+        if self.offsets is not None:
+            return self.offsets[index + 1] - self.offsets[index]
+        return self.chunk_plain_length(index) + NONCE_SIZE + TAG_SIZE
+
+    def chunk_plain_length(self, index: int) -> int:
+        return min(self.chunk_size, self.size - self.chunk_size * index)
+
+    def max_chunk_length(self) -> int:
+        return self.chunk_size + NONCE_SIZE + TAG_SIZE + (1 if self.flags & FLAG_COMPRESSED else 0)
+
+    def encrypted_size(self) -> int:
+        if self.offsets is not None:
+            return self.offsets[-1] + self.table_size + TABLE_SIZE.size
+        return self.header_size + self.size + (NONCE_SIZE + TAG_SIZE) * self.chunk_count()
+
+
+def read_fully(in_stream: BytesInStream, buf: memoryview) -> int:
+    size = 0
+    while size < len(buf):
+        read = in_stream.readinto(buf[size:])
+        if not read:
+            break
+        size += read
+    return size
+
 
 def encrypt(key: str | bytes, source: bytes) -> bytes:
     if isinstance(key, str):
         key = SHA256.new(bytes(key, ENCODING)).digest()
-    nonce = Random.new().read(NONCE_SIZE)
+    nonce = get_random_bytes(NONCE_SIZE)
     encryptor = AES.new(key, AES.MODE_GCM, nonce=nonce)
     encrypted, tag = encryptor.encrypt_and_digest(source)
     return nonce + encrypted + tag
 
 
+def encrypt_into(key: bytes, source: memoryview, target: memoryview) -> memoryview:
+    size = len(source)
+    nonce = get_random_bytes(NONCE_SIZE)
+    target[:NONCE_SIZE] = nonce
+    encryptor = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    encryptor.encrypt(source, output=target[NONCE_SIZE:NONCE_SIZE + size])
+    target[NONCE_SIZE + size:NONCE_SIZE + size + TAG_SIZE] = encryptor.digest()
+    return target[:NONCE_SIZE + size + TAG_SIZE]
+
+
+def decrypt_into(key: bytes, source: memoryview, target: memoryview) -> memoryview:
+    size = len(source) - NONCE_SIZE - TAG_SIZE
+    decrypter = AES.new(key, AES.MODE_GCM, nonce=bytes(source[:NONCE_SIZE]))
+    decrypter.decrypt_and_verify(source[NONCE_SIZE:NONCE_SIZE + size], source[NONCE_SIZE + size:], output=target[:size])
+    return target[:size]
+
+
+def unlock_key(password: str, key_path: str = KEY_PATH) -> bytes:
+    with open(key_path, 'ab+') as f:
+        f.seek(0)
+        key = f.read()
+        if not key:
+            key = get_random_bytes(32)
+            key = encrypt(password, key)
+            f.write(key)
+
+        return decrypt(password, key)
+
+
 def encrypt_name(key: str | bytes, name: str) -> str:
     return (ENCRYPTED_FILE_PREFIX + base64.b64encode(encrypt(key, bytes(name, ENCODING))).decode(ENCODING)
             .replace('/', SLASH_REPLACER)
@@ -106,13 +399,184 @@ def convert_size_of_encrypted_to_real_size(size: int) -> int:
     return size - (ceil(size / DECRYPT_CHUNK_SIZE) * (NONCE_SIZE + TAG_SIZE))
 
 
-def encrypt_stream(key: str | bytes, in_stream: BytesInStream, out_stream: BytesOutStream):
-    while True:
-        buf = in_stream.read(CHUNK_SIZE)
-        if not buf:
-            break
-        buf = encrypt(key, buf)
-        out_stream.write(buf)
+def compressible(name: str) -> bool:
+    file_type = mimetypes.guess_type(name)[0] or ''
+    return not file_type.startswith(('video/', 'audio/')) and file_type not in INCOMPRESSIBLE_TYPES
+
+
+def compress_into(key: bytes, source: memoryview, target: memoryview) -> bytes:
+    compressed = zlib.compress(source, COMPRESSION_LEVEL)
+    if len(compressed) < len(source):
+        return encrypt(key, bytes((DEFLATED,)) + compressed)
+    return encrypt(key, bytes((STORED,)) + source)
+
+
+def chunk_size_for(name: str) -> int:
+    file_type = mimetypes.guess_type(name)[0]
+    if file_type and file_type.startswith('video/'):
+        return LARGE_CHUNK_SIZE
+    return CHUNK_SIZE
+
+
+def chunk_id_key(key: bytes) -> bytes:
+    return hmac.digest(key, b'chunk id', 'sha256')
+
+
+def chunk_id(id_key: bytes, buf: memoryview) -> bytes:
+    return hmac.digest(id_key, buf, 'sha256')
+
+
+def chunk_path(digest: bytes) -> str:
+    name = digest.hex()
+    return os.path.join(CHUNKS_PATH, name[:2], name)
+
+
+def make_header(key: bytes, size: int, chunk_size: int = CHUNK_SIZE, flags: int = 0) -> bytes:
+    fields = HEADER_STRUCT.pack(FILE_MAGIC, FILE_VERSION, flags, 0, chunk_size, size)
+    nonce = get_random_bytes(NONCE_SIZE)
+    encryptor = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    encryptor.update(fields)
+    return fields + nonce + encryptor.digest()
+
+
+def parse_header(key: bytes, buf: bytes) -> Optional[FileHeader]:
+    if len(buf) < HEADER_SIZE or not buf.startswith(FILE_MAGIC):
+        return None
+
+    fields = buf[:HEADER_STRUCT.size]
+    nonce = buf[HEADER_STRUCT.size:HEADER_STRUCT.size + NONCE_SIZE]
+    decrypter = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    decrypter.update(fields)
+    try:
+        decrypter.verify(buf[HEADER_STRUCT.size + NONCE_SIZE:HEADER_SIZE])
+    except ValueError:
+        return None
+
+    (_, version, flags, _, chunk_size, size) = HEADER_STRUCT.unpack(fields)
+    if version > FILE_VERSION:
+        raise ValueError(f'Unsupported file version: {version}')
+    if flags & ~KNOWN_FLAGS:
+        raise ValueError(f'Unsupported file flags: {flags}')
+    return FileHeader(version, flags, chunk_size, size, HEADER_SIZE)
+
+
+def read_chunk_table(key: bytes, in_stream: BytesInStream, header: FileHeader):
+    end = in_stream.size() - TABLE_SIZE.size
+    if end < header.header_size:
+        raise ValueError('Chunk table is missing')
+    in_stream.seek(end)
+    (table_size,) = TABLE_SIZE.unpack(in_stream.read(TABLE_SIZE.size))
+    if table_size > end - header.header_size:
+        raise ValueError('Chunk table is truncated')
+    in_stream.seek(end - table_size)
+    try:
+        table = decrypt(key, in_stream.read(table_size))
+    except ValueError as e:
+        raise ValueError(f'Chunk table failed verification: {e}') from e
+    if len(table) != CHUNK_LENGTH.size * header.chunk_count():
+        raise ValueError('Chunk table does not match the file size')
+
+    offsets = [header.header_size]
+    for (length,) in CHUNK_LENGTH.iter_unpack(table):
+        offsets.append(offsets[-1] + length)
+    header.offsets = offsets
+    header.table_size = table_size
+
+
+def legacy_header(encrypted_size: int) -> FileHeader:
+    return FileHeader(0, 0, CHUNK_SIZE, convert_size_of_encrypted_to_real_size(encrypted_size), 0)
+
+
+def read_header(key: bytes, in_stream: BytesInStream) -> FileHeader:
+    in_stream.seek(0)
+    header = parse_header(key, in_stream.read(HEADER_SIZE))
+    if header is None:
+        return legacy_header(in_stream.size())
+    if header.flags & FLAG_COMPRESSED:
+        read_chunk_table(key, in_stream, header)
+    return header
+
+
+def get_header(key: bytes, path: str | Path) -> FileHeader:
+    with open(path, 'rb') as f:
+        return read_header(key, BinaryIOBytesInStream(f))
+
+
+def encrypt_stream(key: str | bytes,
+                   in_stream: BytesInStream,
+                   out_stream: BytesOutStream,
+                   depth: int = 0,
+                   size: Optional[int] = None,
+                   chunk_size: int = CHUNK_SIZE,
+                   store=None,
+                   compress: bool = False):
+    buffers: list[Tuple[memoryview, memoryview]] = []
+    pending: deque[Future] = deque()
+    written = 0
+    flags = 0 if store is None else FLAG_DEDUP
+    writer = None if store is None else store.writer()
+    encode = encrypt_into if writer is None else writer.add
+    lengths: list[int] = []
+
+    def write_chunks(chunks: list[bytes | memoryview]):
+        lengths.extend(len(x) for x in chunks)
+        out_stream.write_many(chunks)
+
+    try:
+        while True:
+            if len(buffers) < depth + 2:
+                buffers.append((memoryview(bytearray(chunk_size)),
+                                memoryview(bytearray(chunk_size + NONCE_SIZE + TAG_SIZE))))
+            else:
+                buffers.append(buffers.pop(0))
+            (source, target) = buffers[-1]
+
+            read = read_fully(in_stream, source)
+            if not written:
+                if compress and writer is None and read and \
+                        len(zlib.compress(source[:read], 1)) <= read * (1 - COMPRESSION_MIN_SAVING):
+                    flags |= FLAG_COMPRESSED
+                    encode = compress_into
+                out_stream.write(make_header(key, size or 0, chunk_size, flags))
+            if not read:
+                break
+            written += read
+            if not depth:
+                write_chunks([measured('encrypt_seconds_total', encode, key, source[:read], target)])
+                continue
+
+            pending.append(CHUNK_EXECUTOR.submit(measured, 'encrypt_seconds_total', encode, key, source[:read],
+                                                 target))
+            if len(pending) > depth:
+                ready = [pending.popleft().result()]
+                while pending and pending[0].done():
+                    ready.append(pending.popleft().result())
+                write_chunks(ready)
+
+        write_chunks([x.result() for x in pending])
+        pending.clear()
+    except BaseException:
+        if writer is not None:
+            for future in pending:
+                future.cancel()
+            for future in pending:
+                if not future.cancelled():
+                    future.exception()
+            writer.abort()
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+
+    if flags & FLAG_COMPRESSED:
+        table = encrypt(key, b''.join(CHUNK_LENGTH.pack(x) for x in lengths))
+        out_stream.write(table + TABLE_SIZE.pack(len(table)))
+    if written != size:
+        out_stream.seek(0)
+        out_stream.write(make_header(key, written, chunk_size, flags))
+    if writer is not None:
+        writer.commit()
+    METRICS.inc('encrypted_bytes_total', written)
 
 
 def empty():
@@ -120,42 +584,211 @@ def empty():
     pass
 
 
+def measured(name: str, function: Callable, *args):
+    started = time.perf_counter()
+    try:
+        return function(*args)
+    finally:
+        METRICS.inc(name, time.perf_counter() - started)
+
+
+def decrypt_chunk(key: str | bytes, index: int, source: memoryview, target: memoryview) -> memoryview:
+    try:
+        return decrypt_into(key, source, target)
+    except ValueError as e:
+        raise ValueError(f'Chunk {index} failed verification: {e}') from e
+
+
+def decrypt_compressed_chunk(key: str | bytes, index: int, source: memoryview, target: memoryview) -> memoryview:
+    payload = decrypt_chunk(key, index, source, memoryview(bytearray(len(source) - NONCE_SIZE - TAG_SIZE)))
+    if payload[0] == STORED:
+        data = payload[1:]
+    elif payload[0] == DEFLATED:
+        try:
+            data = zlib.decompress(payload[1:], bufsize=len(target))
+        except zlib.error as e:
+            raise ValueError(f'Chunk {index} failed to decompress: {e}') from e
+    else:
+        raise ValueError(f'Chunk {index} uses an unknown compression method: {payload[0]}')
+    if len(data) != len(target):
+        raise ValueError(f'Chunk {index} has {len(data)} bytes instead of {len(target)}')
+    target[:] = data
+    return target
+
+
+def decrypt_chunks(key: str | bytes,
+                   in_stream: BytesInStream,
+                   header: FileHeader,
+                   chunk_index: int,
+                   chunk_end: Optional[int] = None,
+                   cache: Optional[LRUCache] = None,
+                   file_id: Optional[Hashable] = None,
+                   read_ahead: int = 0,
+                   generation: Optional[int] = None) -> Iterator[memoryview]:
+    if cache and generation is None:
+        generation = cache.generation
+    if header.flags & FLAG_DEDUP:
+        in_stream = ChunkListBytesInStream(key, in_stream, header)
+    decode = decrypt_compressed_chunk if header.flags & FLAG_COMPRESSED else decrypt_chunk
+    chunk_end = header.chunk_count() if chunk_end is None else min(chunk_end, header.chunk_count())
+    stream_index = -1
+    decrypted = 0
+    buffers: list[Tuple[memoryview, memoryview]] = []
+    pending: deque[tuple[int, memoryview | Future, int]] = deque()
+
+    try:
+        while True:
+            while chunk_index < chunk_end and len(pending) <= read_ahead:
+                buf = cache.get((file_id, chunk_index)) if cache else None
+                if buf is not None:
+                    pending.append((chunk_index, memoryview(buf), 0))
+                    chunk_index += 1
+                    continue
+
+                length = header.chunk_length(chunk_index)
+                mapped = in_stream.view(header.chunk_offset(chunk_index), length)
+                if len(buffers) < read_ahead + 2:
+                    source_size = 0 if mapped is not None else header.max_chunk_length()
+                    buffers.append((memoryview(bytearray(source_size)),
+                                    memoryview(bytearray(0 if cache else header.chunk_size))))
+                else:
+                    buffers.append(buffers.pop(0))
+                (source, target) = buffers[-1]
+                if cache:
+                    target = memoryview(bytearray(header.chunk_plain_length(chunk_index)))
+                else:
+                    target = target[:header.chunk_plain_length(chunk_index)]
+
+                if mapped is not None:
+                    source = mapped
+                else:
+                    if stream_index != chunk_index:
+                        in_stream.seek(header.chunk_offset(chunk_index))
+                    source = source[:read_fully(in_stream, source[:length])]
+                    stream_index = chunk_index + 1
+                if len(source) != length:
+                    raise ValueError(f'Chunk {chunk_index} is truncated')
+
+                if read_ahead and READ_AHEAD_BUDGET.acquire(length):
+                    future = CHUNK_EXECUTOR.submit(measured, 'decrypt_seconds_total', decode, key, chunk_index,
+                                                   source, target)
+                    pending.append((chunk_index, future, length))
+                else:
+                    pending.append((chunk_index, measured('decrypt_seconds_total', decode, key, chunk_index, source,
+                                                          target), 0))
+                decrypted += len(target)
+                chunk_index += 1
+
+            if not pending:
+                return
+
+            (index, buf, reserved) = pending.popleft()
+            if reserved:
+                READ_AHEAD_BUDGET.release(reserved)
+                buf = buf.result()
+            if cache and cache.peek((file_id, index)) is None:
+                cache.put((file_id, index), buf.obj, generation)
+            yield buf
+    finally:
+        METRICS.inc('decrypted_bytes_total', decrypted)
+        for (_, buf, reserved) in pending:
+            if reserved:
+                buf.cancel()
+                READ_AHEAD_BUDGET.release(reserved)
+
+
 def decrypt_stream(key: str | bytes,
                    in_stream: BytesInStream,
                    out_stream: BytesOutStream,
                    start: int = 0,
-                   iterate_callback: Callable = empty):
-    if start != 0:
-        chunk_count = start // CHUNK_SIZE
-
-        in_stream.seek(DECRYPT_CHUNK_SIZE * chunk_count)
-        buf = in_stream.read(DECRYPT_CHUNK_SIZE)
-        buf = decrypt(key, buf)
-        buf = buf[start - (CHUNK_SIZE * chunk_count):]
-
-        iterate_callback()
-        out_stream.write(buf)
-
-    while True:
-        iterate_callback()
-        buf = in_stream.read(DECRYPT_CHUNK_SIZE)
-        if not buf:
-            break
-        buf = decrypt(key, buf)
-        out_stream.write(buf)
-
-
-def encrypt_content(key: bytes, path: str, rename: bool = False):
-    path = Path(path)
+                   iterate_callback: Callable = empty,
+                   end: Optional[int] = None,
+                   cache: Optional[LRUCache] = None,
+                   file_id: Optional[Hashable] = None,
+                   read_ahead: int = 0,
+                   header: Optional[FileHeader] = None):
+    if header is None:
+        header = read_header(key, in_stream)
+
+    chunk_size = header.chunk_size
+    chunk_index = start // chunk_size
+    offset = start - chunk_size * chunk_index
+    chunk_end = None if end is None else ceil(end / chunk_size)
+
+    with closing(decrypt_chunks(key, in_stream, header, chunk_index, chunk_end, cache, file_id, read_ahead)) as chunks:
+        for buf in chunks:
+            iterate_callback()
+            if end is not None and chunk_size * (chunk_index + 1) > end:
+                buf = buf[:end - chunk_size * chunk_index]
+            if offset:
+                buf = buf[offset:]
+                offset = 0
+            out_stream.write(buf)
+            chunk_index += 1
+
+
+def encrypt_copy(key: bytes, path: Path, target: Path, depth: int = 0, store=None, compress: bool = False):
+    temp = os.path.join(TEMP_PATH, ENCRYPT_TEMP_PREFIX + secrets.token_hex(16))
+    try:
+        with open(path, 'rb') as f_in, open(temp, 'wb') as f_out:
+            encrypt_stream(key,
+                           BinaryIOBytesInStream(f_in),
+                           BinaryIOBytesOutStream(f_out),
+                           depth,
+                           os.fstat(f_in.fileno()).st_size,
+                           chunk_size_for(path.name),
+                           store,
+                           compress and compressible(path.name))
+        os.replace(temp, target)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+def encrypt_file(key: bytes,
+                 path: Path,
+                 depth: int = 0,
+                 callback: Optional[Callable[[Path, str], None]] = None,
+                 store=None,
+                 compress: bool = False):
+    target = path.parent.joinpath(encrypt_name(key, path.name))
+    encrypt_copy(key, path, target, depth, store, compress)
+    os.remove(path)
+    if callback:
+        callback(target, path.name)
+
+
+def collect_not_encrypted(key: bytes,
+                          path: Path,
+                          rename: bool,
+                          files: list[Path],
+                          callback: Optional[Callable[[Path, str], None]] = None):
+    if path == Path(CHUNKS_PATH):
+        return
     if os.path.isdir(path):
         if rename and not path.name.startswith(ENCRYPTED_FILE_PREFIX):
             temp = path.parent.joinpath(encrypt_name(key, path.name))
             path.rename(temp)
+            if callback:
+                callback(temp, path.name)
             path = temp
         for f in os.listdir(path):
-            encrypt_content(key, str(path.joinpath(f)), True)
-    else:
-        if not path.name.startswith(ENCRYPTED_FILE_PREFIX):
-            with open(path, 'rb') as f_in, open(path.parent.joinpath(encrypt_name(key, path.name)), 'wb') as f_out:
-                encrypt_stream(key, BinaryIOBytesInStream(f_in), BinaryIOBytesOutStream(f_out))
-            os.remove(path)
+            collect_not_encrypted(key, path.joinpath(f), True, files, callback)
+    elif not path.name.startswith(ENCRYPTED_FILE_PREFIX):
+        files.append(path)
+
+
+def encrypt_content(key: bytes,
+                    path: str,
+                    rename: bool = False,
+                    callback: Optional[Callable[[Path, str], None]] = None,
+                    depth: int = 0,
+                    workers: int = ENCRYPT_FILE_WORKERS,
+                    store=None,
+                    compress: bool = False):
+    files = []
+    collect_not_encrypted(key, Path(path), rename, files, callback)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='encrypt') as executor:
+        for future in [executor.submit(encrypt_file, key, x, depth, callback, store, compress) for x in files]:
+            future.result()
@@ -0,0 +1,228 @@
+import json
+import os
+import secrets
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Optional
+
+from constants import JOB_WORKERS
+from encrypter import encrypt, decrypt
+
+RECORD_HEADER = struct.Struct('>I')
+
+START = 's'
+PLAN = 'p'
+DONE = 'd'
+END = 'e'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+INTERRUPTED = 'interrupted'
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id: str, kind: str, params: dict):
+        self.job_id = job_id
+        self.kind = kind
+        self.params = params
+        self.state = QUEUED
+        self.error: Optional[str] = None
+        self.plan: Optional[list[str]] = None
+        self.done: set[str] = set()
+        self.files_total = 0
+        self.files_done = 0
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+
+    def set_total(self, files: int, size: int):
+        with self.lock:
+            self.files_total = files
+            self.bytes_total = size
+
+    def advance(self, files: int, size: int):
+        with self.lock:
+            self.files_done += files
+            self.bytes_done += size
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0
+        return (self.finished or time.monotonic()) - self.started
+
+    def throughput(self) -> float:
+        elapsed = self.elapsed()
+        return self.bytes_done / elapsed if elapsed else 0
+
+    def eta(self) -> Optional[float]:
+        throughput = self.throughput()
+        if self.state != RUNNING or not throughput:
+            return None
+        return (self.bytes_total - self.bytes_done) / throughput
+
+    def to_json(self) -> dict:
+        with self.lock:
+            return {
+                'id': self.job_id,
+                'kind': self.kind,
+                'state': self.state,
+                'error': self.error,
+                'files_done': self.files_done,
+                'files_total': self.files_total,
+                'bytes_done': self.bytes_done,
+                'bytes_total': self.bytes_total,
+                'throughput': self.throughput(),
+                'eta': self.eta(),
+            }
+
+
+class JobManager:
+    def __init__(self, key: bytes, journal_path: str, runners: dict[str, Callable[['JobManager', Job], None]],
+                 workers: int = JOB_WORKERS):
+        self.key = key
+        self.journal_path = journal_path
+        self.runners = runners
+        self.lock = threading.RLock()
+        self.jobs: dict[str, Job] = {}
+        self.journal: Optional[BinaryIO] = None
+        self.closed = False
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+
+    def open(self):
+        with self.lock:
+            unfinished = self.load()
+            self.compact(unfinished)
+            self.journal = open(self.journal_path, 'ab')
+        for job in unfinished:
+            self.jobs[job.job_id] = job
+            self.executor.submit(self.run, job)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for job in self.jobs.values():
+                job.cancel()
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def load(self) -> list[Job]:
+        jobs: dict[str, Job] = {}
+        if not os.path.exists(self.journal_path):
+            return []
+
+        with open(self.journal_path, 'rb') as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                (size,) = RECORD_HEADER.unpack(header)
+                try:
+                    record = json.loads(decrypt(self.key, f.read(size)))
+                except ValueError:
+                    break
+
+                if record['o'] == START:
+                    jobs[record['i']] = Job(record['i'], record['k'], record['a'])
+                elif record['i'] not in jobs:
+                    continue
+                elif record['o'] == PLAN:
+                    jobs[record['i']].plan = record['f']
+                elif record['o'] == DONE:
+                    jobs[record['i']].done.add(record['f'])
+                elif record['o'] == END:
+                    del jobs[record['i']]
+
+        return [x for x in jobs.values() if x.kind in self.runners]
+
+    def compact(self, jobs: list[Job]):
+        temp = self.journal_path + '_compact'
+        with open(temp, 'wb') as f:
+            for job in jobs:
+                self.write(f, {'o': START, 'i': job.job_id, 'k': job.kind, 'a': job.params})
+                if job.plan is not None:
+                    self.write(f, {'o': PLAN, 'i': job.job_id, 'f': job.plan})
+                for done in job.done:
+                    self.write(f, {'o': DONE, 'i': job.job_id, 'f': done})
+        os.replace(temp, self.journal_path)
+
+    def write(self, out: BinaryIO, record: dict):
+        body = encrypt(self.key, json.dumps(record, separators=(',', ':')).encode())
+        out.write(RECORD_HEADER.pack(len(body)) + body)
+
+    def record(self, record: dict):
+        with self.lock:
+            if self.journal:
+                self.write(self.journal, record)
+                self.journal.flush()
+
+    def submit(self, kind: str, params: dict) -> Job:
+        job = Job(secrets.token_hex(8), kind, params)
+        with self.lock:
+            self.jobs[job.job_id] = job
+            self.record({'o': START, 'i': job.job_id, 'k': kind, 'a': params})
+        self.executor.submit(self.run, job)
+        return job
+
+    def run(self, job: Job):
+        job.state = RUNNING
+        job.started = time.monotonic()
+        try:
+            job.check_cancelled()
+            self.runners[job.kind](self, job)
+            job.state = FINISHED
+        except JobCancelled:
+            job.state = INTERRUPTED if self.closed else CANCELLED
+        except Exception as e:
+            job.state = FAILED
+            job.error = str(e)
+        finally:
+            job.finished = time.monotonic()
+
+        if job.state != INTERRUPTED:
+            self.record({'o': END, 'i': job.job_id, 's': job.state})
+
+    def set_plan(self, job: Job, plan: list[str]):
+        job.plan = plan
+        self.record({'o': PLAN, 'i': job.job_id, 'f': plan})
+
+    def mark_done(self, job: Job, item: str, size: int = 0):
+        job.done.add(item)
+        job.advance(1, size)
+        self.record({'o': DONE, 'i': job.job_id, 'f': item})
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self) -> list[Job]:
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda x: x.created, reverse=True)
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        if job is None:
+            return False
+        job.cancel()
+        return True
@@ -1,25 +1,52 @@
-import cgi
+import argparse
+import codecs
 import collections.abc
 import datetime
+import html
+import json
 import os
 import shutil
+import threading
+import time
 import webbrowser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import secrets
 from http.server import SimpleHTTPRequestHandler, HTTPServer
+from math import ceil
 from pathlib import Path
 from socketserver import ThreadingMixIn
-from typing import Optional, Tuple
+from typing import Callable, Optional, Tuple
 from urllib import parse
 
-from Crypto import Random
-
+from archive import ZIP, TAR, FORMATS, archive, member_name
+from async_server import AsyncHTTPServer
+from cache import LRUCache
+from chunk_store import ChunkStore
 from constants import MAX_INACTIVE_TIME_SECONDS, PORT, CONTENT_PATH, META_PATH, KEY_PATH, ENCRYPTED_FILE_PREFIX, \
-    TEMP_PATH
-from encrypter import ENCODING, decrypt_path, decrypt, decrypt_stream, BinaryIOBytesInStream, BinaryIOBytesOutStream, \
-    InMemoryBytesOutStream, encrypt, encrypt_name, decrypt_name, convert_size_of_encrypted_to_real_size, \
-    encrypt_stream, encrypt_content
+    TEMP_PATH, DIRECTORY_CACHE_SIZE, INDEX_PATH, SEARCH_RESULTS_LIMIT, CHUNK_CACHE_SIZE, DECRYPT_READ_AHEAD, \
+    ENCRYPT_PIPELINE_DEPTH, MMAP_MIN_SIZE, TEXT_PAGE_SIZE, MAX_DECRYPT_STREAMS, SERVER_ENGINE, ASYNC_WORKERS, \
+    GALLERY_PAGE_SIZE, THUMBNAIL_SIZE, JOBS_PATH, ENCRYPT_FILE_WORKERS, CHUNKS_DIR_NAME, DEDUP_ENABLED, \
+    COMPRESSION_ENABLED, PROFILE_RATE, LISTING_PAGE_SIZE, LISTING_FLUSH_ROWS, UPLOADS_PATH, UPLOAD_EXPIRY_SECONDS, \
+    SAVE_TEMP_PREFIX, ENCRYPT_TEMP_PREFIX
+from encrypter import ENCODING, decrypt_path, decrypt_stream, BinaryIOBytesInStream, BinaryIOBytesOutStream, \
+    encrypt, encrypt_name, decrypt_name, encrypt_stream, encrypt_file, decrypt_chunks, read_header, get_header, \
+    chunk_size_for, compressible, BytesInStream, MmapBytesInStream, collect_not_encrypted, unlock_key
+from jobs import Job, JobManager, QUEUED, RUNNING
+from metrics import METRICS, PROFILER, COUNTER, GAUGE, route
+from multipart import MultipartParser
+from range_utils import parse_range, make_etag, if_range_matches
+from thumbnails import thumbnails_enabled, get_thumbnail, prepare_thumbnails, remove_thumbnail
+from tree_index import TreeIndex
+from uploads import UploadSession
 
 LAST_ACCESS_TIME = datetime.datetime.fromtimestamp(1)
 KEY: Optional[bytes] = None
+INDEX: Optional[TreeIndex] = None
+JOBS: Optional[JobManager] = None
+CHUNKS: Optional[ChunkStore] = None
+DEDUP = DEDUP_ENABLED
+COMPRESS = COMPRESSION_ENABLED
 
 FAVICON = 'favicon.ico'
 
@@ -31,17 +58,44 @@ BACK = 'back'
 LOGIN_PAGE = '/login'
 LOGOUT_PAGE = '/' + LOGOUT
 CHANGE_PASSWORD_PAGE = '/change_password'
+SEARCH_PAGE = '/search'
+UPLOAD_PAGE = '/upload'
+JOBS_PAGE = '/jobs'
+METRICS_PAGE = '/metrics'
+PROMETHEUS_PAGE = METRICS_PAGE + '/prometheus'
 
 SAVE_REQUEST = 'save'
 CREATE_REQUEST = 'create'
 PROCESS_NOT_ENCRYPTED_REQUEST = 'process_not_encrypted'
 CLEAR_TEMP_REQUEST = 'clear_temp'
 DELETE_REQUEST = 'delete'
+GALLERY_REQUEST = 'gallery'
+THUMBNAIL_REQUEST = 'thumbnail'
+UPLOAD_REQUEST = 'upload'
+FINALIZE_REQUEST = 'finalize'
+ABORT_REQUEST = 'abort'
+CANCEL_REQUEST = 'cancel'
+DOWNLOAD_REQUEST = 'download'
 
 PASSWORD_PARAM = "password"
 AGAIN_PARAM = "again"
 DIR_PARAM = "dir"
 FILE_PARAM = "file"
+QUERY_PARAM = "q"
+OFFSET_PARAM = "offset"
+PAGE_PARAM = "page"
+FORMAT_PARAM = "format"
+SORT_PARAM = "sort"
+ORDER_PARAM = "order"
+
+NAME_SORT = "name"
+SIZE_SORT = "size"
+MTIME_SORT = "mtime"
+SORTS = {NAME_SORT: 'Name', SIZE_SORT: 'Size', MTIME_SORT: 'Modified'}
+DESC_ORDER = "desc"
+
+ENCRYPT_JOB = "encrypt"
+CLEAR_TEMP_JOB = "clear_temp"
 
 LOGOUT_EL = f'<a id={LOGOUT} href="{LOGOUT_PAGE}">Logout</a>'
 # noinspection JSUnresolvedReference
@@ -81,6 +135,95 @@ window.onkeydown = (event) => {{
     }}
 }}
 </script>'''
+# noinspection JSUnresolvedReference
+# language=HTML
+UPLOAD_SCRIPT = f'''<script>
+const uploadForm = document.getElementById("upload"),
+    uploadProgress = document.getElementById("upload-progress"),
+    chunksPerRequest = 8,
+    parallelRequests = 3,
+    maxAttempts = 5;
+
+let uploadRequest = async (url, options) => {{
+    for (let attempt = 1; ; attempt++) {{
+        try {{
+            const response = await fetch(url, options);
+            if (response.ok) {{
+                return await response.json();
+            }}
+            if (response.status < 500 || attempt >= maxAttempts) {{
+                throw new Error(`${{url}}: ${{response.status}}`);
+            }}
+        }} catch (e) {{
+            if (attempt >= maxAttempts) {{
+                throw e;
+            }}
+        }}
+        await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+    }}
+}};
+
+let uploadFile = async (file) => {{
+    const storageKey = `upload:${{location.pathname}}:${{file.name}}:${{file.size}}:${{file.lastModified}}`;
+    let session = null;
+
+    if (localStorage.getItem(storageKey)) {{
+        session = await uploadRequest(`{UPLOAD_PAGE}/${{localStorage.getItem(storageKey)}}`).catch(() => null);
+    }}
+    if (!session) {{
+        session = await uploadRequest("{UPLOAD_REQUEST}", {{
+            method: "POST",
+            headers: {{"Content-Type": "application/json"}},
+            body: JSON.stringify({{name: file.name, size: file.size}})
+        }});
+        localStorage.setItem(storageKey, session.id);
+    }}
+
+    const committed = new Set(session.committed),
+        pending = [];
+    for (let i = 0; i < session.chunks; i += chunksPerRequest) {{
+        for (let j = i; j < Math.min(i + chunksPerRequest, session.chunks); j++) {{
+            if (!committed.has(j)) {{
+                pending.push(i);
+                break;
+            }}
+        }}
+    }}
+
+    const total = pending.length;
+    let finished = 0;
+    let worker = async () => {{
+        while (pending.length) {{
+            const index = pending.shift(),
+                start = index * session.chunk_size,
+                end = Math.min(start + chunksPerRequest * session.chunk_size, file.size);
+            await uploadRequest(`{UPLOAD_PAGE}/${{session.id}}/${{index}}`, {{
+                method: "PUT",
+                body: file.slice(start, end)
+            }});
+            uploadProgress.value = ++finished / total;
+        }}
+    }};
+    await Promise.all([...Array(parallelRequests)].map(worker));
+
+    await uploadRequest(`{UPLOAD_PAGE}/${{session.id}}/{FINALIZE_REQUEST}`, {{method: "POST"}});
+    localStorage.removeItem(storageKey);
+}};
+
+uploadForm.onsubmit = async (event) => {{
+    event.preventDefault();
+    uploadProgress.hidden = false;
+    try {{
+        for (const file of uploadForm.elements["{FILE_PARAM}"].files) {{
+            uploadProgress.value = 0;
+            await uploadFile(file);
+        }}
+        location.reload();
+    }} catch (e) {{
+        alert(`Upload failed, submit the same files again to resume: ${{e}}`);
+    }}
+}};
+</script>'''
 
 
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
@@ -88,64 +231,346 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
 
 
 class DirectoryEntry:
-    def __init__(self, name: str, relative_path: str):
+    __slots__ = ('name', 'relative_path', 'mtime', 'size')
+
+    def __init__(self, name: str, relative_path: str, mtime: int = 0, size: int = -1):
         self.name = name
         self.relative_path = relative_path
+        self.mtime = mtime
+        # Plaintext size, read on demand from the index or the file header
+        self.size = size
 
 
 class Directory:
-    def __init__(self, path: str | Path):
-        self.path = path
+    def __init__(self, path: str | Path, mtime: int = 0):
+        self.path = Path(path)
+        self.mtime = mtime
         self.dirs: list[DirectoryEntry] = []
         self.files: list[DirectoryEntry] = []
         self.not_encrypted: list[str] = []
+        self.file_order: Optional[Tuple[list[DirectoryEntry], dict[str, int]]] = None
+        self.orders: dict[str, Tuple[list[DirectoryEntry], list[DirectoryEntry]]] = {}
+        self.images: Optional[bool] = None
 
         self.init()
 
     def init(self):
-        for entry in os.listdir(self.path):
-            if not entry.startswith(ENCRYPTED_FILE_PREFIX):
-                self.not_encrypted.append(entry)
-                continue
-
-            name = decrypt_name(KEY, entry)
-            if os.path.isdir(os.path.join(self.path, entry)):
-                self.dirs.append(DirectoryEntry(name, entry))
+        started = time.perf_counter()
+        names = 0
+        names_time = 0.0
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name == CHUNKS_DIR_NAME and self.path == Path(CONTENT_PATH):
+                    continue
+                if not entry.name.startswith(ENCRYPTED_FILE_PREFIX):
+                    self.not_encrypted.append(entry.name)
+                    continue
+
+                name_started = time.perf_counter()
+                name = decrypt_name(KEY, entry.name)
+                names_time += time.perf_counter() - name_started
+                names += 1
+                try:
+                    mtime = entry.stat().st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                if entry.is_dir():
+                    self.dirs.append(DirectoryEntry(name, entry.name, mtime))
+                else:
+                    self.files.append(DirectoryEntry(name, entry.name, mtime))
+
+        METRICS.observe('directory_init_seconds', time.perf_counter() - started)
+        METRICS.inc('decrypt_name_seconds_total', names_time)
+        METRICS.inc('decrypt_name_calls_total', names)
+
+    def add_dir(self, name: str, relative_path: str):
+        self.dirs.append(DirectoryEntry(name, relative_path, os.stat(self.path.joinpath(relative_path)).st_mtime_ns))
+        self.orders = {}
+
+    def add_file(self, name: str, relative_path: str):
+        self.files.append(DirectoryEntry(name, relative_path, os.stat(self.path.joinpath(relative_path)).st_mtime_ns))
+        self.file_order = None
+        self.orders = {}
+        self.images = None
+
+    def remove(self, relative_path: str):
+        self.dirs = [x for x in self.dirs if x.relative_path != relative_path]
+        self.files = [x for x in self.files if x.relative_path != relative_path]
+        self.file_order = None
+        self.orders = {}
+        self.images = None
+
+    def file_size(self, entry: DirectoryEntry) -> int:
+        if entry.size < 0:
+            path = self.path.joinpath(entry.relative_path)
+            index = INDEX
+            indexed = index.get(path) if index else None
+            if indexed is not None and indexed.mtime == entry.mtime:
+                entry.size = indexed.size
+            else:
+                try:
+                    entry.size = get_header(KEY, path).size
+                except (OSError, ValueError):
+                    entry.size = 0
+        return entry.size
+
+    def sorted_entries(self, sort: str) -> Tuple[list[DirectoryEntry], list[DirectoryEntry]]:
+        order = self.orders.get(sort)
+        if order is None:
+            if sort == SIZE_SORT:
+                files = sorted(self.files, key=lambda x: (self.file_size(x), x.name))
+            elif sort == MTIME_SORT:
+                files = sorted(self.files, key=lambda x: (x.mtime, x.name))
             else:
-                self.files.append(DirectoryEntry(name, entry))
+                files = self.sorted_files()
+            # Directories have no size of their own and keep their name order when sorting by size
+            dirs = sorted(self.dirs, key=lambda x: (x.mtime, x.name) if sort == MTIME_SORT else x.name)
+            order = (dirs, files)
+            self.orders[sort] = order
+        return order
 
     def sorted_dirs(self) -> list[DirectoryEntry]:
         return sorted(self.dirs, key=lambda x: x.name)
 
     def sorted_files(self) -> list[DirectoryEntry]:
-        return sorted(self.files, key=lambda x: x.name)
+        return self.get_file_order()[0]
+
+    def get_file_order(self) -> Tuple[list[DirectoryEntry], dict[str, int]]:
+        file_order = self.file_order
+        if file_order is None:
+            files = sorted(self.files, key=lambda x: x.name)
+            file_order = (files, {x.relative_path: i for i, x in enumerate(files)})
+            self.file_order = file_order
+        return file_order
 
     def get_prev_and_next_file(
         self,
         relative_path: str
     ) -> Tuple[Optional[DirectoryEntry], Optional[DirectoryEntry]]:
-        prev_file = None
-        next_file = None
-        stop = False
+        (files, positions) = self.get_file_order()
+        position = positions.get(relative_path)
 
-        for file in self.sorted_files():
-            if os.path.isdir(self.path.joinpath(file.relative_path)):
-                continue
-            elif stop:
-                next_file = file
-                break
-            elif file.relative_path == relative_path:
-                stop = True
-            else:
-                prev_file = file
+        if position is None:
+            return (files[-1] if files else None), None
 
+        prev_file = files[position - 1] if position > 0 else None
+        next_file = files[position + 1] if position + 1 < len(files) else None
         return prev_file, next_file
 
 
+DIRECTORY_CACHE = LRUCache(DIRECTORY_CACHE_SIZE)
+CHUNK_CACHE = LRUCache(CHUNK_CACHE_SIZE, len)
+PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+DECRYPT_STREAMS = threading.BoundedSemaphore(MAX_DECRYPT_STREAMS)
+
+
+def register_metrics():
+    METRICS.register('threads', GAUGE, threading.active_count)
+    for (name, cache) in (('directory', DIRECTORY_CACHE), ('chunk', CHUNK_CACHE)):
+        METRICS.register('cache_hits_total', COUNTER, lambda c=cache: c.hits, cache=name)
+        METRICS.register('cache_misses_total', COUNTER, lambda c=cache: c.misses, cache=name)
+        METRICS.register('cache_hit_ratio', GAUGE, lambda c=cache: c.hits / ((c.hits + c.misses) or 1), cache=name)
+        METRICS.register('cache_entries', GAUGE, lambda c=cache: c.stats()['entries'], cache=name)
+
+
+register_metrics()
+
+
+def get_directory(path: str | Path) -> Directory:
+    path = Path(path)
+    mtime = os.stat(path).st_mtime_ns
+    directory = DIRECTORY_CACHE.get(str(path))
+    if directory is None or directory.mtime != mtime:
+        # Names decrypted with a key from before a logout or password change must not be cached after it
+        generation = DIRECTORY_CACHE.generation
+        directory = Directory(path, mtime)
+        DIRECTORY_CACHE.put(str(path), directory, generation)
+    return directory
+
+
+def modify_directory(path: str | Path, modify: Callable[[], str], update: Callable[[Directory, str], None]):
+    path = Path(path)
+    mtime = os.stat(path).st_mtime_ns
+    relative_path = modify()
+    directory = DIRECTORY_CACHE.peek(str(path))
+    if directory is None:
+        return
+    if directory.mtime != mtime:
+        DIRECTORY_CACHE.pop(str(path))
+        return
+    update(directory, relative_path)
+    directory.mtime = os.stat(path).st_mtime_ns
+
+
+def open_index():
+    global INDEX
+    if INDEX:
+        return
+    INDEX = TreeIndex(KEY, CONTENT_PATH, INDEX_PATH)
+
+    def load(index: TreeIndex):
+        index.open()
+        index.reconcile()
+
+    threading.Thread(target=load, args=(INDEX,), daemon=True).start()
+
+
+def run_encrypt_job(manager: JobManager, job: Job):
+    key = manager.key
+    if job.plan is None:
+        files = []
+        collect_not_encrypted(key, Path(job.params['path']), False, files, index_add)
+        manager.set_plan(job, [str(x) for x in files])
+
+    remaining = [x for x in job.plan if x not in job.done and os.path.exists(x)]
+    job.set_total(len(job.plan), sum(os.path.getsize(x) for x in remaining))
+    job.advance(len(job.plan) - len(remaining), 0)
+
+    def encrypt_one(path: str):
+        job.check_cancelled()
+        size = os.path.getsize(path)
+        encrypt_file(key, Path(path), ENCRYPT_PIPELINE_DEPTH, index_add, dedup_store(), COMPRESS)
+        manager.mark_done(job, path, size)
+
+    with ThreadPoolExecutor(max_workers=ENCRYPT_FILE_WORKERS, thread_name_prefix='encrypt') as executor:
+        for future in [executor.submit(encrypt_one, x) for x in remaining]:
+            future.result()
+
+
+def last_modified(path: str) -> float:
+    mtime = os.lstat(path).st_mtime
+    if os.path.isdir(path) and not os.path.islink(path):
+        with os.scandir(path) as it:
+            for entry in it:
+                mtime = max(mtime, entry.stat(follow_symlinks=False).st_mtime)
+    return mtime
+
+
+def run_clear_temp_job(_: JobManager, job: Job):
+    # Saves and encrypts (from this server or the CLI) remove their temp file when they fail, one that is still there
+    # is either being written or left by a crash. Those and resumable upload sessions are only removed once they have
+    # been idle past the upload expiry, everything else (profiles, other leftovers) goes right away.
+    paths = [os.path.join(TEMP_PATH, x) for x in os.listdir(TEMP_PATH) if x != os.path.basename(UPLOADS_PATH)]
+    sessions = [os.path.join(UPLOADS_PATH, x) for x in os.listdir(UPLOADS_PATH)] if os.path.isdir(UPLOADS_PATH) else []
+    expired = time.time() - UPLOAD_EXPIRY_SECONDS
+    job.set_total(len(paths) + len(sessions), 0)
+    for path in paths + sessions:
+        job.check_cancelled()
+        try:
+            name = os.path.basename(path)
+            owned = os.path.dirname(path) == UPLOADS_PATH or name.startswith((SAVE_TEMP_PREFIX, ENCRYPT_TEMP_PREFIX))
+            if not owned or last_modified(path) < expired:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+        except FileNotFoundError:
+            pass
+        job.advance(1, 0)
+
+
+JOB_RUNNERS = {
+    ENCRYPT_JOB: run_encrypt_job,
+    CLEAR_TEMP_JOB: run_clear_temp_job,
+}
+
+
+def open_jobs():
+    global JOBS
+    if JOBS:
+        return
+    JOBS = JobManager(KEY, JOBS_PATH, JOB_RUNNERS)
+    JOBS.open()
+
+
+def open_chunks():
+    global CHUNKS
+    if CHUNKS:
+        return
+    CHUNKS = ChunkStore(KEY)
+    CHUNKS.open()
+
+
+def dedup_store() -> Optional[ChunkStore]:
+    return CHUNKS if DEDUP else None
+
+
+def index_add(path: str | Path, name: str):
+    index = INDEX
+    if index:
+        index.add(path, name)
+
+
+def index_remove(path: str | Path):
+    index = INDEX
+    if index:
+        index.remove(path)
+
+
+def format_size(size: int) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TB'
+
+
+def format_metric_labels(labels: tuple) -> str:
+    return ', '.join(f'{k}={v}' for (k, v) in labels)
+
+
+def is_binary(buf: bytes) -> bool:
+    if b'\0' in buf:
+        return True
+    try:
+        codecs.getincrementaldecoder(ENCODING)().decode(buf)
+    except UnicodeDecodeError:
+        return True
+    return False
+
+
+def get_file_id(stat: os.stat_result) -> Tuple[int, int, int]:
+    return stat.st_dev, stat.st_ino, stat.st_mtime_ns
+
+
+def prefetch_file(path: str | Path):
+    key = KEY
+    generation = CHUNK_CACHE.generation
+
+    def prefetch():
+        try:
+            with open(path, 'rb') as f:
+                file_id = get_file_id(os.fstat(f.fileno()))
+                if CHUNK_CACHE.peek((file_id, 0)) is None:
+                    in_stream = BinaryIOBytesInStream(f)
+                    for _ in decrypt_chunks(key, in_stream, read_header(key, in_stream), 0, 1, CHUNK_CACHE, file_id,
+                                            generation=generation):
+                        pass
+        except (OSError, ValueError):
+            pass
+
+    PREFETCH_EXECUTOR.submit(prefetch)
+
+
+def clear_key():
+    global KEY, INDEX, JOBS, CHUNKS
+    KEY = None
+    DIRECTORY_CACHE.clear()
+    CHUNK_CACHE.clear()
+    if INDEX:
+        INDEX.close()
+        INDEX = None
+    if JOBS:
+        JOBS.close()
+        JOBS = None
+    if CHUNKS:
+        CHUNKS.close()
+        CHUNKS = None
+
+
 def validate_timeout():
-    global KEY
     if (datetime.datetime.now() - LAST_ACCESS_TIME).seconds >= MAX_INACTIVE_TIME_SECONDS:
-        KEY = None
+        clear_key()
     update_last_access_time()
 
 
@@ -160,7 +585,16 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
         self._headers_buffer = []
 
     def get_content_length(self) -> int:
-        return int(self.headers['Content-Length'])
+        # Bodies are read to exactly this length, without a valid one the request is answered and the connection dropped
+        length = self.headers['Content-Length']
+        if length is None:
+            self.send_error(411)
+            raise ValueError('Content-Length is required')
+        length = length.strip()
+        if not length.isascii() or not length.isdigit():
+            self.send_error(400)
+            raise ValueError(f'Invalid Content-Length: {length}')
+        return int(length)
 
     def get_form_data(self):
         data = self.rfile.read(self.get_content_length())
@@ -215,35 +649,93 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
 
         self.wfile.write(resp)
 
-    def send_reload(self):
-        self.send_response(302)
+    def send_json(self, data, code: int = 200):
+        resp = json.dumps(data).encode(ENCODING)
+
+        self.send_response(code)
         self.add_default_headers()
-        self.send_header('Location', self.path)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(resp)))
         self.end_headers()
 
-    def send_preview_page(self):
-        location = self.path.rsplit('/', 1)[0] + '/'
+        self.wfile.write(resp)
+
+    def send_redirect(self, location: str):
         self.send_response(302)
         self.add_default_headers()
         self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
+    def send_reload(self):
+        self.send_redirect(self.path)
+
+    def send_chunked_response(self, code: int):
+        self.chunked = self.request_version != 'HTTP/1.0'
+        if self.chunked:
+            self.protocol_version = 'HTTP/1.1'
+        self.send_response(code)
+        if self.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        if not self.chunked or self.close_connection:
+            self.send_header('Connection', 'close')
+
+    def write_chunk(self, data: bytes):
+        if not data:
+            return
+        if self.chunked:
+            self.wfile.write(f'{len(data):X}\r\n'.encode(ENCODING) + data + b'\r\n')
+        else:
+            self.wfile.write(data)
+
+    def end_chunked(self):
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def send_preview_page(self):
+        self.send_redirect(self.path.rsplit('/', 1)[0] + '/')
+
     def send_redirect_login(self):
-        self.send_response(302)
-        self.add_default_headers()
-        self.send_header('Location', LOGIN_PAGE)
-        self.end_headers()
+        self.send_redirect(LOGIN_PAGE)
 
     def send_main_page(self):
-        self.send_response(302)
+        self.send_redirect('/')
+
+    @staticmethod
+    def format_stats(path: str | Path) -> str:
+        index = INDEX
+        stats = index.stats(path) if index else None
+        if not stats:
+            return ''
+        return f'{stats[1]} files, {format_size(stats[0])}{" (indexing)" if index.reconciling else ""}'
+
+    def has_images(self, directory: Directory) -> bool:
+        if directory.images is None:
+            directory.images = thumbnails_enabled() and any(self.guess_type(x.name).startswith('image/')
+                                                            for x in directory.files)
+        return directory.images
+
+    @route('listing')
+    def send_directory(self):
+        url_path = parse.urlsplit(self.path).path
+        query = parse.parse_qs(parse.urlsplit(self.path).query)
+        path = self.translate_path(url_path)
+        sort = query.get(SORT_PARAM, [NAME_SORT])[0]
+        sort = sort if sort in SORTS else NAME_SORT
+        descending = query.get(ORDER_PARAM, [''])[0] == DESC_ORDER
+        try:
+            page = max(int(query.get(PAGE_PARAM, ['0'])[0]), 0)
+        except ValueError:
+            page = 0
+
+        self.send_chunked_response(200)
         self.add_default_headers()
-        self.send_header('Location', '/')
+        self.send_header('Content-type', f'text/html; charset={ENCODING}')
         self.end_headers()
 
-    def send_directory(self):
         # noinspection HtmlUnknownTarget
         # language=HTML
-        resp = [f'''
+        head = f'''
         <!DOCTYPE html>
         <html lang="en">
         <head>
@@ -251,17 +743,29 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
         </head>
         <body>
             {LOGOUT_EL}
-            {'' if self.path == '/' else f'<a id="{BACK}" style="margin-left: 5px" href="..">Back</a>'}
+            {'' if url_path == '/' else f'<a id="{BACK}" style="margin-left: 5px" href="..">Back</a>'}
             <a href="{PROCESS_NOT_ENCRYPTED_REQUEST}" style="margin-left: 5px">Process not encrypted</a>
             <a href="{CHANGE_PASSWORD_PAGE}" style="margin-left: 5px">Change password</a>
-            <a href="{CLEAR_TEMP_REQUEST}" style="margin-left: 5px">Clear temp</a>
+            <a href="{CLEAR_TEMP_REQUEST}" style="margin-left: 5px"
+               title="Keeps uploads and saves that were active in the last day">Clear temp</a>
+            <a href="{JOBS_PAGE}" style="margin-left: 5px">Jobs</a>
+            <a href="{METRICS_PAGE}" style="margin-left: 5px">Metrics</a>
             <br/>
             <br/><a href="{DELETE_REQUEST}">Delete</a>
-            <h2>Current Directory: {decrypt_path(KEY, self.path)}</h2>
+            <a href="{DOWNLOAD_REQUEST}?{FORMAT_PARAM}={ZIP}" style="margin-left: 5px">Download folder (zip)</a>
+            <a href="{DOWNLOAD_REQUEST}?{FORMAT_PARAM}={TAR}" style="margin-left: 5px">Download folder (tar)</a>
+            <h2>Current Directory: {decrypt_path(KEY, url_path)}</h2>
+            {self.format_stats(path)}
+
+            <form method="GET" action="{SEARCH_PAGE}">
+                <input required name="{QUERY_PARAM}" placeholder="Search" type="text"/>
+                <input type="submit" value="Search"/>
+            </form>
 
-            <form method="POST" action="{SAVE_REQUEST}" enctype=multipart/form-data>
+            <form id="upload" method="POST" action="{SAVE_REQUEST}" enctype=multipart/form-data>
                 <input required name="{FILE_PARAM}" type="file" multiple/>
                 <input type="submit" value="Add"/>
+                <progress id="upload-progress" hidden></progress>
             </form>
             <form  method="POST" action="{CREATE_REQUEST}" style="margin-top: 5px">
                 <input required name="{DIR_PARAM}" placeholder="Directory" type="text"/>
@@ -269,16 +773,167 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
             </form>
             <br/>
             {COMMON_SCRIPT}
+            {UPLOAD_SCRIPT}
+        '''
+
+        try:
+            # The page head goes out before the names of a large directory are decrypted and sorted
+            self.write_chunk(head.encode(ENCODING))
+
+            directory = get_directory(path)
+            (dirs, files) = directory.sorted_entries(sort)
+            total = len(dirs) + len(files)
+            pages = max(ceil(total / LISTING_PAGE_SIZE), 1)
+            page = min(page, pages - 1)
+
+            resp = []
+            if self.has_images(directory):
+                resp.append(f'<a href="{GALLERY_REQUEST}">Gallery</a><br/>')
+            links = []
+            for (key, label) in SORTS.items():
+                order = '' if key != sort or descending else f'&{ORDER_PARAM}={DESC_ORDER}'
+                arrow = (' &darr;' if descending else ' &uarr;') if key == sort else ''
+                links.append(f'<a href="?{SORT_PARAM}={key}{order}">{label}{arrow}</a>')
+            resp.append(f'Sort: {" | ".join(links)}')
+            resp.append('<ul>')
+
+            start = page * LISTING_PAGE_SIZE
+            for i in range(start, min(start + LISTING_PAGE_SIZE, total)):
+                # Directories stay before files in both orders
+                if i < len(dirs):
+                    e = dirs[len(dirs) - 1 - i if descending else i]
+                    stats = self.format_stats(directory.path.joinpath(e.relative_path))
+                    resp.append(f'<li><a href="{e.relative_path}/">[Dir] {e.name}</a>'
+                                f'{" - " + stats if stats else ""}</li>')
+                else:
+                    e = files[total - 1 - i if descending else i - len(dirs)]
+                    modified = datetime.datetime.fromtimestamp(e.mtime / 1e9).strftime('%Y-%m-%d %H:%M')
+                    resp.append(f'<li><a href="{e.relative_path}">{e.name}</a> - '
+                                f'{format_size(directory.file_size(e))} - {modified}</li>')
+                if len(resp) >= LISTING_FLUSH_ROWS:
+                    self.write_chunk('\n'.join(resp).encode(ENCODING))
+                    resp = []
+            if page == 0:
+                for e in directory.not_encrypted:
+                    resp.append(f'<li>[Not encrypted] {e}</li>')
+            resp.append('</ul>')
+
+            params = f'{SORT_PARAM}={sort}' + (f'&{ORDER_PARAM}={DESC_ORDER}' if descending else '')
+            if page > 0:
+                resp.append(f'<a href="?{params}&{PAGE_PARAM}={page - 1}">Previous page</a>')
+            if page + 1 < pages:
+                resp.append(f'<a style="margin-left: 5px" href="?{params}&{PAGE_PARAM}={page + 1}">Next page</a>')
+            if pages > 1:
+                resp.append(f'<p>Page {page + 1} of {pages}</p>')
+            resp.append('''
+        </body>
+        </html>
+        ''')
+            self.write_chunk('\n'.join(resp).encode(ENCODING))
+            self.end_chunked()
+        except ConnectionError:
+            pass
+
+    @route('gallery')
+    def send_gallery(self):
+        path = Path(self.translate_path(self.path)).parent
+        query = parse.parse_qs(parse.urlsplit(self.path).query)
+        directory = get_directory(path)
+        images = [x for x in directory.sorted_files() if self.guess_type(x.name).startswith('image/')]
+        pages = max(ceil(len(images) / GALLERY_PAGE_SIZE), 1)
+        try:
+            page = min(max(int(query.get(PAGE_PARAM, ['0'])[0]), 0), pages - 1)
+        except ValueError:
+            page = 0
+        images = images[page * GALLERY_PAGE_SIZE:(page + 1) * GALLERY_PAGE_SIZE]
+        prepare_thumbnails(KEY, [path.joinpath(x.relative_path) for x in images])
+
+        # noinspection HtmlUnknownTarget
+        # language=HTML
+        resp = [f'''
+        <!DOCTYPE html>
+        <html lang="en">
+        <head>
+            <title>Gallery</title>
+        </head>
+        <body>
+            {LOGOUT_EL}
+            <a id="{BACK}" style="margin-left: 5px" href=".">Back</a>
+            <h2>Gallery: {decrypt_path(KEY, parse.urlsplit(self.path).path.rsplit('/', 1)[0] or '/')}</h2>
+            {COMMON_SCRIPT}
+            <div>
         ''']
 
-        directory = Directory(self.translate_path(self.path))
+        for e in images:
+            resp.append(f'<a href="{e.relative_path}" title="{html.escape(e.name)}">'
+                        f'<img loading="lazy" src="{e.relative_path}/{THUMBNAIL_REQUEST}" alt="{html.escape(e.name)}" '
+                        f'style="max-width: {THUMBNAIL_SIZE}px; max-height: {THUMBNAIL_SIZE}px; margin: 2px"/></a>')
+
+        resp.append('</div>')
+        if page > 0:
+            resp.append(f'<a href="{GALLERY_REQUEST}?{PAGE_PARAM}={page - 1}">Previous page</a>')
+        if page + 1 < pages:
+            resp.append(f'<a style="margin-left: 5px" href="{GALLERY_REQUEST}?{PAGE_PARAM}={page + 1}">Next page</a>')
+        resp.append(f'''
+            <p>Page {page + 1} of {pages}</p>
+        </body>
+        </html>
+        ''')
+
+        self.send_text(resp)
+
+    @route('thumbnail')
+    def send_thumbnail(self):
+        path = self.translate_path(self.path.rsplit('/', 1)[0])
+        try:
+            image = self.guess_type(decrypt_name(KEY, os.path.basename(path))).startswith('image/')
+        except ValueError:
+            image = False
+        data = get_thumbnail(KEY, path) if image and os.path.isfile(path) else None
+        if data is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.add_default_headers()
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_jobs(self):
+        jobs = JOBS.list() if JOBS else []
+        active = any(x.state in (QUEUED, RUNNING) for x in jobs)
+
+        # noinspection HtmlUnknownTarget
+        # language=HTML
+        resp = [f'''
+        <!DOCTYPE html>
+        <html lang="en">
+        <head>
+            <title>Jobs</title>
+            {'<meta http-equiv="refresh" content="2">' if active else ''}
+        </head>
+        <body>
+            {LOGOUT_EL}
+            <a id="{BACK}" style="margin-left: 5px" href="/">Back</a>
+            {COMMON_SCRIPT}
+            <ul>
+        ''']
 
-        for e in directory.sorted_dirs():
-            resp.append(f'<li><a href="{e.relative_path}/">[Dir] {e.name}</a></li>')
-        for e in directory.sorted_files():
-            resp.append(f'<li><a href="{e.relative_path}">{e.name}</a></li>')
-        for e in directory.not_encrypted:
-            resp.append(f'<li>[Not encrypted] {e}</li>')
+        for job in jobs:
+            info = job.to_json()
+            line = (f'{html.escape(job.kind)} - {info["state"]} - {info["files_done"]}/{info["files_total"]} files, '
+                    f'{format_size(info["bytes_done"])}/{format_size(info["bytes_total"])}')
+            if info['throughput']:
+                line += f', {format_size(info["throughput"])}/s'
+            if info['eta'] is not None:
+                line += f', {datetime.timedelta(seconds=round(info["eta"]))} left'
+            if info['error']:
+                line += f' - {html.escape(info["error"])}'
+            if job.state in (QUEUED, RUNNING):
+                line += f' <a href="{JOBS_PAGE}/{job.job_id}/{CANCEL_REQUEST}">Cancel</a>'
+            resp.append(f'<li>{line}</li>')
 
         resp.append('''
             </ul>
@@ -288,45 +943,221 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
 
         self.send_text(resp)
 
+    @route('archive')
+    def send_archive(self):
+        url_path = parse.urlsplit(self.path).path.rsplit('/', 1)[0] + '/'
+        query = parse.parse_qs(parse.urlsplit(self.path).query)
+        archive_format = query.get(FORMAT_PARAM, [ZIP])[0]
+        path = self.translate_path(url_path)
+        if archive_format not in FORMATS or not os.path.isdir(path):
+            self.send_error(404)
+            return
+
+        name = member_name(decrypt_path(KEY, url_path).strip('/').rsplit('/', 1)[-1]) or os.path.basename(CONTENT_PATH)
+        self.send_chunked_response(200)
+        self.add_default_headers()
+        self.send_header('Content-Type', 'application/zip' if archive_format == ZIP else 'application/x-tar')
+        self.send_header('Content-Disposition', f'attachment; filename="{name}.{archive_format}"')
+        self.end_headers()
+
+        try:
+            with DECRYPT_STREAMS, METRICS.active('decrypt_streams_active'), \
+                    closing(archive(KEY, path, name, archive_format, update_last_access_time)) as data:
+                for buf in data:
+                    self.write_chunk(buf)
+            self.end_chunked()
+        except ConnectionError:
+            pass
+
+    def send_metrics(self):
+        (values, histograms) = METRICS.samples()
+
+        # noinspection HtmlUnknownTarget
+        # language=HTML
+        resp = [f'''
+        <!DOCTYPE html>
+        <html lang="en">
+        <head>
+            <title>Metrics</title>
+        </head>
+        <body>
+            {LOGOUT_EL}
+            <a id="{BACK}" style="margin-left: 5px" href="/">Back</a>
+            <a href="{PROMETHEUS_PAGE}" style="margin-left: 5px">Prometheus</a>
+            {COMMON_SCRIPT}
+            <table>
+                <tr><th align="left">Metric</th><th align="left">Labels</th><th align="right">Value</th></tr>
+        ''']
+
+        for (name, labels, value) in values:
+            text = format_size(value) if name.endswith('_bytes_total') else f'{value:.4g}'
+            resp.append(f'<tr><td>{name}</td><td>{html.escape(format_metric_labels(labels))}</td>'
+                        f'<td align="right">{text}</td></tr>')
+
+        resp.append('''
+            </table>
+            <table>
+                <tr><th align="left">Timing</th><th align="left">Labels</th><th align="right">Count</th>
+                <th align="right">Avg ms</th><th align="right">p50 ms</th><th align="right">p99 ms</th></tr>
+        ''')
+        for (name, labels, histogram) in histograms:
+            average = histogram.sum / histogram.count * 1000 if histogram.count else 0
+            resp.append(f'<tr><td>{name}</td><td>{html.escape(format_metric_labels(labels))}</td>'
+                        f'<td align="right">{histogram.count}</td><td align="right">{average:.1f}</td>'
+                        f'<td align="right">&le;{histogram.quantile(0.5) * 1000:g}</td>'
+                        f'<td align="right">&le;{histogram.quantile(0.99) * 1000:g}</td></tr>')
+
+        resp.append('''
+            </table>
+        </body>
+        </html>
+        ''')
+
+        self.send_text(resp)
+
+    def send_prometheus(self):
+        resp = METRICS.prometheus().encode(ENCODING)
+
+        self.send_response(200)
+        self.add_default_headers()
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(resp)))
+        self.end_headers()
+
+        self.wfile.write(resp)
+
+    @route('search')
+    def send_search(self):
+        query = parse.parse_qs(parse.urlsplit(self.path).query).get(QUERY_PARAM, [''])[0]
+        index = INDEX
+        entries = index.search(query, SEARCH_RESULTS_LIMIT) if index and query else []
+
+        # noinspection HtmlUnknownTarget
+        # language=HTML
+        resp = [f'''
+        <!DOCTYPE html>
+        <html lang="en">
+        <head>
+            <title>Search</title>
+        </head>
+        <body>
+            {LOGOUT_EL}
+            <a id="{BACK}" style="margin-left: 5px" href="/">Back</a>
+            <form method="GET" action="{SEARCH_PAGE}">
+                <input required name="{QUERY_PARAM}" placeholder="Search" type="text" value="{html.escape(query)}"/>
+                <input type="submit" value="Search"/>
+            </form>
+            {'<p>Indexing is in progress, results may be incomplete</p>' if index and index.reconciling else ''}
+            {COMMON_SCRIPT}
+            <ul>
+        ''']
+
+        for e in entries:
+            if e.is_dir:
+                resp.append(f'<li><a href="/{e.path}/">[Dir] {html.escape(e.name)}</a></li>')
+            else:
+                resp.append(f'<li><a href="/{e.path}">{html.escape(e.name)}</a> - {format_size(e.size)}</li>')
+
+        resp.append('''
+            </ul>
+        </body>
+        </html>
+        ''')
+
+        self.send_text(resp)
+
+    @route('range_stream')
     def send_file(self):
         path = self.translate_path(self.path)
 
-        file_size = convert_size_of_encrypted_to_real_size(os.path.getsize(path))
-
-        range_header = self.headers['Range']
-        download_range = self.headers['Range']
-        start = int(download_range.replace('bytes=', '').split('-')[0]) if download_range else 0
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size < MMAP_MIN_SIZE:
+                self.send_file_stream(path, BinaryIOBytesInStream(f), stat)
+                return
+            with closing(MmapBytesInStream(f)) as in_stream:
+                self.send_file_stream(path, in_stream, stat)
+
+    def send_file_stream(self, path: str, in_stream: BytesInStream, stat: os.stat_result):
+        header = read_header(KEY, in_stream)
+        file_size = header.size
+        content_type = self.guess_type(path)
+        etag = make_etag(stat)
+
+        ranges = None
+        if if_range_matches(self.headers['If-Range'], etag, stat.st_mtime):
+            ranges = parse_range(self.headers['Range'], file_size)
+
+        if ranges is not None and not ranges:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{file_size}')
+            self.send_header('Content-Length', '0')
+            self.add_default_headers()
+            self.end_headers()
+            return
 
-        if range_header:
-            self.send_response(206)
-            self.send_header('Accept-Ranges', 'bytes')
-            self.send_header('Content-Range', f'bytes {start}-{file_size - 1}/{file_size}')
-        else:
+        parts = []
+        if ranges is None:
             self.send_response(200)
             self.send_header(
                 'Content-Disposition',
                 f'attachment; filename="{decrypt_name(KEY, Path(self.path).name)}"'
             )
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(file_size))
+            parts.append((b'', 0, file_size))
+        elif len(ranges) == 1:
+            (start, end) = ranges[0]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{file_size}')
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(end - start))
+            parts.append((b'', start, end))
+        else:
+            boundary = secrets.token_hex(16)
+            for (start, end) in ranges:
+                prefix = (f'\r\n--{boundary}\r\n'
+                          f'Content-Type: {content_type}\r\n'
+                          f'Content-Range: bytes {start}-{end - 1}/{file_size}\r\n\r\n')
+                parts.append((prefix.encode(ENCODING), start, end))
+            parts.append((f'\r\n--{boundary}--\r\n'.encode(ENCODING), 0, 0))
+            self.send_response(206)
+            self.send_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
+            self.send_header('Content-Length', str(sum(len(x[0]) + x[2] - x[1] for x in parts)))
 
-        self.send_header('Content-Type', self.guess_type(path))
-        self.send_header('Content-Length', str(file_size - start))
+        if isinstance(in_stream, MmapBytesInStream):
+            in_stream.advise(ranges is None or (len(ranges) == 1 and ranges[0][1] == file_size))
+
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(stat.st_mtime))
         self.add_default_headers()
         self.end_headers()
 
         try:
-            with open(path, 'rb') as f:
-                decrypt_stream(KEY,
-                               BinaryIOBytesInStream(f),
-                               BinaryIOBytesOutStream(self.wfile),
-                               start,
-                               update_last_access_time)
+            with DECRYPT_STREAMS, METRICS.active('decrypt_streams_active'), METRICS.timed('decrypt_stream_seconds'):
+                for (prefix, start, end) in parts:
+                    self.wfile.write(prefix)
+                    if start < end:
+                        decrypt_stream(KEY,
+                                       in_stream,
+                                       BinaryIOBytesOutStream(self.wfile),
+                                       start,
+                                       update_last_access_time,
+                                       end,
+                                       CHUNK_CACHE,
+                                       get_file_id(stat),
+                                       DECRYPT_READ_AHEAD,
+                                       header)
         except ConnectionError:
             pass
 
+    @route('file_page')
     def send_page(self):
         path = Path(self.translate_path(self.path))
+        url_path = parse.urlsplit(self.path).path
         relative_path = path.name
-        directory = Directory(path.parent)
+        directory = get_directory(path.parent)
 
         (prev_file, next_file) = directory.get_prev_and_next_file(relative_path)
 
@@ -344,8 +1175,9 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
             resp.append(f'<a id="{PREV}" style="margin-left: 5px" href="{prev_file.relative_path}">Prev</a>')
         if next_file:
             resp.append(f'<a id="{NEXT}" style="margin-left: 5px" href="{next_file.relative_path}">Next</a>')
-        resp.append(f'<br/><a href="{self.path + "/" + DELETE_REQUEST}">Delete</a>')
-        resp.append(f'<h2>Current file: {decrypt_path(KEY, self.path)}</h2>')
+            prefetch_file(directory.path.joinpath(next_file.relative_path))
+        resp.append(f'<br/><a href="{url_path + "/" + DELETE_REQUEST}">Delete</a>')
+        resp.append(f'<h2>Current file: {decrypt_path(KEY, url_path)}</h2>')
 
         fyle_type = self.guess_type(decrypt_name(KEY, relative_path))[0]
 
@@ -383,14 +1215,8 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
                 }
                 </script>''')
         else:
-            resp.append('<pre>')
-
-            buf = InMemoryBytesOutStream()
-            with open(path, 'rb') as f:
-                decrypt_stream(KEY, BinaryIOBytesInStream(f), buf)
-
-            resp.append(buf.buf.decode(ENCODING).replace('<', '&lt;').replace('>', '&gt;'))
-            resp.append('</pre>')
+            self.send_text_page(path, resp)
+            return
 
         resp.append(f'''
             {COMMON_SCRIPT}
@@ -400,6 +1226,78 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
 
         self.send_text(resp)
 
+    def send_text_page(self, path: Path, resp: list[str]):
+        query = parse.parse_qs(parse.urlsplit(self.path).query)
+        try:
+            offset = max(int(query.get(OFFSET_PARAM, ['0'])[0]), 0)
+        except ValueError:
+            offset = 0
+
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            in_stream = BinaryIOBytesInStream(f)
+            header = read_header(KEY, in_stream)
+            offset = min(offset, header.size)
+            end = min(offset + TEXT_PAGE_SIZE, header.size)
+
+            self.send_chunked_response(200)
+            self.add_default_headers()
+            self.send_header('Content-type', f'text/html; charset={ENCODING}')
+            self.end_headers()
+
+            decoder = codecs.getincrementaldecoder(ENCODING)('replace')
+            chunk_index = offset // header.chunk_size
+            position = chunk_index * header.chunk_size
+            first = True
+            binary = False
+            chunks = decrypt_chunks(KEY, in_stream, header, chunk_index, ceil(end / header.chunk_size), CHUNK_CACHE,
+                                    get_file_id(stat), DECRYPT_READ_AHEAD)
+            try:
+                self.write_chunk('\n'.join(resp).encode(ENCODING) + b'<pre>')
+
+                with DECRYPT_STREAMS, METRICS.active('decrypt_streams_active'), closing(chunks):
+                    for buf in chunks:
+                        update_last_access_time()
+                        chunk_start = position
+                        position += len(buf)
+                        buf = bytes(buf[max(offset - chunk_start, 0):len(buf) - max(position - end, 0)])
+                        if first:
+                            first = False
+                            if offset:
+                                # Skip the tail of a multibyte character cut by the page start
+                                skip = 0
+                                while skip < min(3, len(buf)) and buf[skip] & 0xC0 == 0x80:
+                                    skip += 1
+                                buf = buf[skip:]
+                            if is_binary(buf):
+                                binary = True
+                                break
+                        final = end == header.size and position >= end
+                        self.write_chunk(html.escape(decoder.decode(buf, final), False).encode(ENCODING))
+
+                (pending, _) = decoder.getstate()
+                next_offset = end - len(pending)
+                tail = ['</pre>']
+                if binary:
+                    tail.append(f'<p>Binary content, preview stopped. <a href="{path.name}" download>Download</a></p>')
+                else:
+                    tail.append(f'<p>Bytes {offset}-{next_offset} of {header.size}</p>')
+                    if offset > 0:
+                        previous_offset = max(offset - TEXT_PAGE_SIZE, 0)
+                        tail.append(f'<a href="{path.name}?{OFFSET_PARAM}={previous_offset}">Previous page</a>')
+                    if next_offset < header.size:
+                        tail.append(f'<a style="margin-left: 5px" href="{path.name}?{OFFSET_PARAM}={next_offset}">'
+                                    f'Next page</a>')
+                tail.append(f'''
+                    {COMMON_SCRIPT}
+                </body>
+                </html>
+                ''')
+                self.write_chunk('\n'.join(tail).encode(ENCODING))
+                self.end_chunked()
+            except ConnectionError:
+                pass
+
     def send_login(self):
         # noinspection HtmlUnknownTarget
         # language=HTML
@@ -426,18 +1324,11 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
     def process_login(self):
         global KEY
 
-        password = self.get_form_data()['password']
-
-        with open(KEY_PATH, 'ab+') as f:
-            f.seek(0)
-            key = f.read()
-            if not key:
-                key = Random.new().read(32)
-                key = encrypt(password, key)
-                f.write(key)
-
-            KEY = decrypt(password, key)
+        KEY = unlock_key(self.get_form_data()['password'])
 
+        open_chunks()
+        open_index()
+        open_jobs()
         self.send_main_page()
 
     def send_change_password(self):
@@ -490,45 +1381,164 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
 
         self.send_main_page()
 
+    @route('save')
     def process_save(self):
-        form = cgi.FieldStorage(fp=self.rfile,
-                                headers=self.headers,
-                                environ={'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': self.headers['Content-Type']})
-
-        files = form[FILE_PARAM]
-        if not isinstance(files, list):
-            files = [files]
-
-        for record in files:
-            with open(Path(self.translate_path(self.path)).parent.joinpath(encrypt_name(KEY, record.filename)),
-                      'wb') as f_out:
-                encrypt_stream(KEY, BinaryIOBytesInStream(record.file), BinaryIOBytesOutStream(f_out))
+        parser = MultipartParser(self.rfile, self.headers['Content-Type'], self.get_content_length())
+        parent = Path(self.translate_path(self.path)).parent
+
+        for part in parser.parts():
+            if part.name != FILE_PARAM or not part.filename:
+                continue
+
+            def save() -> str:
+                relative_path = encrypt_name(KEY, part.filename)
+                temp = os.path.join(TEMP_PATH, SAVE_TEMP_PREFIX + secrets.token_hex(16))
+                try:
+                    with open(temp, 'wb') as f_out:
+                        encrypt_stream(KEY,
+                                       part,
+                                       BinaryIOBytesOutStream(f_out),
+                                       ENCRYPT_PIPELINE_DEPTH,
+                                       chunk_size=chunk_size_for(part.filename),
+                                       store=dedup_store(),
+                                       compress=COMPRESS and compressible(part.filename))
+                    os.replace(temp, parent.joinpath(relative_path))
+                except BaseException:
+                    if os.path.exists(temp):
+                        os.remove(temp)
+                    raise
+                index_add(parent.joinpath(relative_path), part.filename)
+                return relative_path
+
+            modify_directory(parent, save, lambda d, x: d.add_file(part.filename, x))
         self.send_preview_page()
 
+    def get_upload_session(self) -> Tuple[Optional[UploadSession], list[str]]:
+        parts = parse.urlsplit(self.path).path[len(UPLOAD_PAGE) + 1:].split('/')
+        return UploadSession.load(parts[0]), parts[1:]
+
+    def process_upload_create(self):
+        data = json.loads(self.rfile.read(self.get_content_length()))
+        if not isinstance(data.get('name'), str) or not data['name'] or not isinstance(data.get('size'), int):
+            self.send_json({'error': 'name and size are required'}, 400)
+            return
+
+        session = UploadSession.create(KEY, Path(self.translate_path(self.path)).parent, data['name'], data['size'])
+        self.send_json(session.to_json())
+
+    def send_upload_status(self):
+        (session, _) = self.get_upload_session()
+        if not session:
+            self.send_json({'error': 'Unknown upload'}, 404)
+            return
+        self.send_json(session.to_json())
+
+    @route('upload')
+    def process_upload_chunks(self):
+        (session, args) = self.get_upload_session()
+        if not session or len(args) != 1 or not args[0].isdigit():
+            self.send_json({'error': 'Unknown upload'}, 404)
+            return
+
+        length = self.get_content_length()
+        try:
+            written = session.write_chunks(KEY, int(args[0]), BinaryIOBytesInStream(self.rfile), length)
+        except ValueError as e:
+            self.send_json({'error': str(e)}, 400)
+            return
+        except OSError as e:
+            # The session was removed underneath (abort, Clear temp) or the disk is full, the rest of the body is unread
+            print(e)
+            self.close_connection = True
+            self.send_json({'error': 'Upload could not be stored'}, 409 if isinstance(e, FileNotFoundError) else 500)
+            return
+        self.send_json({'written': written})
+
+    def process_upload_action(self):
+        (session, args) = self.get_upload_session()
+        if not session or len(args) != 1:
+            self.send_json({'error': 'Unknown upload'}, 404)
+            return
+
+        if args[0] == ABORT_REQUEST:
+            session.abort()
+            self.send_json({})
+            return
+
+        if args[0] != FINALIZE_REQUEST:
+            self.send_json({'error': 'Unknown action'}, 404)
+            return
+
+        name = decrypt_name(KEY, session.name)
+        target = session.target()
+
+        def finalize() -> str:
+            session.finalize()
+            index_add(target, name)
+            return target.name
+
+        try:
+            modify_directory(target.parent, finalize, lambda d, x: d.add_file(name, x))
+        except ValueError as e:
+            self.send_json({'error': str(e)}, 409)
+            return
+        except OSError as e:
+            # A session removed before it was finalized is a conflict, anything else (disk full) is a server error
+            print(e)
+            self.send_json({'error': 'Upload could not be stored'}, 409 if isinstance(e, FileNotFoundError) else 500)
+            return
+        self.send_json({'location': target.name})
+
     def process_not_encrypted(self):
-        encrypt_content(KEY, self.translate_path(self.path.rsplit('/', 1)[0]))
-        self.send_preview_page()
+        JOBS.submit(ENCRYPT_JOB, {'path': self.translate_path(self.path.rsplit('/', 1)[0])})
+        self.send_redirect(JOBS_PAGE)
 
     def process_clear_temp(self):
-        shutil.rmtree(TEMP_PATH)
-        os.makedirs(TEMP_PATH, exist_ok=True)
-        self.send_preview_page()
+        JOBS.submit(CLEAR_TEMP_JOB, {})
+        self.send_redirect(JOBS_PAGE)
+
+    def process_job_request(self):
+        parts = parse.urlsplit(self.path).path[len(JOBS_PAGE):].strip('/').split('/')
+        job = JOBS.get(parts[0])
+        if job is None:
+            self.send_json({'error': 'Not found'}, 404)
+        elif len(parts) > 1 and parts[1] == CANCEL_REQUEST:
+            job.cancel()
+            self.send_redirect(JOBS_PAGE)
+        else:
+            self.send_json(job.to_json())
 
     def process_create(self):
-        directory = self.get_form_data()[DIR_PARAM]
-        directory = encrypt_name(KEY, directory)
-        os.makedirs(Path(self.translate_path(self.path)).parent.joinpath(directory),
-                    exist_ok=True)
+        name = self.get_form_data()[DIR_PARAM]
+        parent = Path(self.translate_path(self.path)).parent
+
+        def create() -> str:
+            relative_path = encrypt_name(KEY, name)
+            os.makedirs(parent.joinpath(relative_path), exist_ok=True)
+            index_add(parent.joinpath(relative_path), name)
+            return relative_path
+
+        modify_directory(parent, create, lambda d, x: d.add_dir(name, x))
         self.send_preview_page()
 
+    @route('delete')
     def process_delete(self):
         path = self.path.replace('/' + DELETE_REQUEST, '')
         path = self.translate_path(path)
         path = Path(path)
 
-        (prev_file, next_file) = Directory(path.parent).get_prev_and_next_file(path.name)
+        (prev_file, next_file) = get_directory(path.parent).get_prev_and_next_file(path.name)
+
+        def delete() -> str:
+            if CHUNKS:
+                CHUNKS.remove_file(path)
+            else:
+                os.remove(path)
+            index_remove(path)
+            remove_thumbnail(KEY, path)
+            return path.name
 
-        os.remove(path)
+        modify_directory(path.parent, delete, lambda d, x: d.remove(x))
 
         location = '..'
 
@@ -537,14 +1547,9 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
         elif prev_file:
             location += '/' + prev_file.relative_path
 
-        self.send_response(302)
-        self.add_default_headers()
-        self.send_header('Location', location)
-        self.end_headers()
+        self.send_redirect(location)
 
     def do_POST(self):
-        global KEY
-
         try:
             validate_timeout()
 
@@ -556,6 +1561,14 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
                 self.send_redirect_login()
                 return
 
+            if self.path.startswith(UPLOAD_PAGE + '/'):
+                self.process_upload_action()
+                return
+
+            if self.path.endswith('/' + UPLOAD_REQUEST):
+                self.process_upload_create()
+                return
+
             if self.path.endswith(SAVE_REQUEST):
                 self.process_save()
                 return
@@ -568,13 +1581,31 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
                 self.process_change_password()
                 return
 
-            self.send_response(404)
+            self.send_error(404)
         except ValueError as e:
             print(e)
+            METRICS.inc('http_errors_total', method=self.command)
+            self.close_connection = True
 
-    def do_GET(self):
-        global KEY
+    def do_PUT(self):
+        try:
+            validate_timeout()
+
+            if not KEY:
+                self.send_json({'error': 'Unauthorized'}, 401)
+                return
+
+            if self.path.startswith(UPLOAD_PAGE + '/'):
+                self.process_upload_chunks()
+                return
 
+            self.send_json({'error': 'Not found'}, 404)
+        except ValueError as e:
+            print(e)
+            METRICS.inc('http_errors_total', method=self.command)
+            self.close_connection = True
+
+    def do_GET(self):
         try:
             validate_timeout()
 
@@ -583,12 +1614,41 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
                 return
 
             if self.path.endswith(LOGOUT_PAGE):
-                KEY = None
+                clear_key()
+
+            if parse.urlsplit(self.path).path == PROMETHEUS_PAGE and not KEY:
+                # Scrapers get a status instead of the login page, metrics are only served while logged in
+                self.send_error(401)
+                return
 
             if self.path.endswith(LOGIN_PAGE) or not KEY:
                 self.send_login()
                 return
 
+            if parse.urlsplit(self.path).path == METRICS_PAGE:
+                self.send_metrics()
+                return
+
+            if parse.urlsplit(self.path).path == PROMETHEUS_PAGE:
+                self.send_prometheus()
+                return
+
+            if parse.urlsplit(self.path).path == SEARCH_PAGE:
+                self.send_search()
+                return
+
+            if self.path.startswith(UPLOAD_PAGE + '/'):
+                self.send_upload_status()
+                return
+
+            if self.path == JOBS_PAGE:
+                self.send_jobs()
+                return
+
+            if self.path.startswith(JOBS_PAGE + '/'):
+                self.process_job_request()
+                return
+
             if self.path.endswith(PROCESS_NOT_ENCRYPTED_REQUEST):
                 self.process_not_encrypted()
                 return
@@ -605,10 +1665,22 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
                 self.process_delete()
                 return
 
+            if parse.urlsplit(self.path).path.endswith('/' + GALLERY_REQUEST):
+                self.send_gallery()
+                return
+
+            if self.path.endswith('/' + THUMBNAIL_REQUEST):
+                self.send_thumbnail()
+                return
+
+            if parse.urlsplit(self.path).path.endswith('/' + DOWNLOAD_REQUEST):
+                self.send_archive()
+                return
+
             path = self.translate_path(self.path)
 
             if not os.path.exists(path):
-                self.send_response(404)
+                self.send_error(404)
                 return
 
             if os.path.isdir(path):
@@ -623,9 +1695,28 @@ class CustomRequestHandler(SimpleHTTPRequestHandler):
             self.send_page()
         except ValueError as e:
             print(e)
+            METRICS.inc('http_errors_total', method=self.command)
+            self.close_connection = True
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', choices=('async', 'threaded'), default=SERVER_ENGINE)
+    parser.add_argument('--workers', type=int, default=ASYNC_WORKERS, help='request threads of the async server')
+    parser.add_argument('--decrypt-streams', type=int, default=MAX_DECRYPT_STREAMS,
+                        help='files decrypted to clients at the same time')
+    parser.add_argument('--dedup', action='store_true', default=DEDUP_ENABLED,
+                        help='store identical chunks of new files once')
+    parser.add_argument('--compress', action='store_true', default=COMPRESSION_ENABLED,
+                        help='compress the chunks of new files that compress well')
+    parser.add_argument('--profile', type=float, default=PROFILE_RATE, metavar='RATE',
+                        help='share of requests profiled with cProfile into Temp, 1 profiles every request')
+    args = parser.parse_args()
+    DECRYPT_STREAMS = threading.BoundedSemaphore(args.decrypt_streams)
+    DEDUP = args.dedup
+    COMPRESS = args.compress
+    PROFILER.rate = args.profile
+
     httpd = None
     try:
         if not os.path.exists(KEY_PATH) and os.path.exists(CONTENT_PATH) and len(os.listdir(CONTENT_PATH)) > 0:
@@ -634,8 +1725,12 @@ if __name__ == '__main__':
 
         os.makedirs(META_PATH, exist_ok=True)
         os.makedirs(CONTENT_PATH, exist_ok=True)
+        os.makedirs(TEMP_PATH, exist_ok=True)
 
-        httpd = ThreadedHTTPServer(('', PORT), CustomRequestHandler)
+        if args.server == 'async':
+            httpd = AsyncHTTPServer(('', PORT), CustomRequestHandler, args.workers)
+        else:
+            httpd = ThreadedHTTPServer(('', PORT), CustomRequestHandler)
         print(f'Serving on port {PORT}')
 
         webbrowser.open(f'http://localhost:{PORT}', new=0, autoraise=True)
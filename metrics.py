@@ -0,0 +1,198 @@
+import cProfile
+import functools
+import os
+import random
+import secrets
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Iterator, Tuple
+
+from constants import METRICS_BUCKETS, PROFILE_RATE, TEMP_PATH
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the quantile, the last bucket is unbounded
+        rank = q * self.count
+        seen = 0
+        for (i, count) in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return 0.0
+
+
+class Metrics:
+    def __init__(self, buckets: Tuple[float, ...] = METRICS_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.kinds: dict[str, str] = {}
+        self.values: dict[Tuple[str, Labels], float] = {}
+        self.histograms: dict[Tuple[str, Labels], Histogram] = {}
+        self.callbacks: dict[Tuple[str, Labels], Callable[[], float]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.kinds.setdefault(name, COUNTER)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def add(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.kinds.setdefault(name, GAUGE)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.kinds.setdefault(name, HISTOGRAM)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def register(self, name: str, kind: str, callback: Callable[[], float], **labels: str):
+        # Values owned by other objects (cache hits, thread count) are read when the metrics are rendered
+        with self.lock:
+            self.kinds[name] = kind
+            self.callbacks[(name, tuple(sorted(labels.items())))] = callback
+
+    @contextmanager
+    def timed(self, name: str, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @contextmanager
+    def active(self, name: str, **labels: str) -> Iterator[None]:
+        self.add(name, 1, **labels)
+        try:
+            yield
+        finally:
+            self.add(name, -1, **labels)
+
+    def samples(self) -> Tuple[list[Tuple[str, Labels, float]], list[Tuple[str, Labels, Histogram]]]:
+        with self.lock:
+            values = list(self.values.items())
+            callbacks = list(self.callbacks.items())
+            histograms = [(name, labels, self.copy(x)) for ((name, labels), x) in self.histograms.items()]
+        values += [(key, callback()) for (key, callback) in callbacks]
+        return sorted((name, labels, value) for ((name, labels), value) in values), sorted(histograms)
+
+    @staticmethod
+    def copy(histogram: Histogram) -> Histogram:
+        result = Histogram(histogram.buckets)
+        result.counts = list(histogram.counts)
+        result.count = histogram.count
+        result.sum = histogram.sum
+        return result
+
+    def prometheus(self) -> str:
+        (values, histograms) = self.samples()
+        lines = []
+        typed = set()
+
+        def type_line(name: str):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {self.kinds[name]}')
+
+        for (name, labels, value) in values:
+            type_line(name)
+            lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        for (name, labels, histogram) in histograms:
+            type_line(name)
+            cumulative = 0
+            for (i, count) in enumerate(histogram.counts):
+                cumulative += count
+                bound = format_value(histogram.buckets[i]) if i < len(histogram.buckets) else '+Inf'
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {format_value(histogram.sum)}')
+            lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for (_, v) in labels)
+    return '{' + ','.join(f'{k}="{v}"' for ((k, _), v) in zip(labels, escaped)) + '}'
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Profiler:
+    def __init__(self, path: str = TEMP_PATH, rate: float = PROFILE_RATE):
+        self.path = path
+        self.rate = rate
+        # cProfile can't run in two threads at once, requests that overlap a profiled one are skipped
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def profile(self, name: str) -> Iterator[None]:
+        if not self.rate or random.random() >= self.rate or not self.lock.acquire(blocking=False):
+            yield
+            return
+
+        try:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                os.makedirs(self.path, exist_ok=True)
+                profile.dump_stats(os.path.join(
+                    self.path, f'profile_{name}_{time.strftime("%Y%m%d_%H%M%S")}_{secrets.token_hex(4)}.prof'))
+        finally:
+            self.lock.release()
+
+
+METRICS = Metrics()
+PROFILER = Profiler()
+
+
+def route(name: str) -> Callable:
+    def decorator(handler: Callable) -> Callable:
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            METRICS.inc('http_requests_total', route=name)
+            started = time.perf_counter()
+            try:
+                with METRICS.active('http_requests_active', route=name), PROFILER.profile(name):
+                    return handler(*args, **kwargs)
+            except BaseException:
+                METRICS.inc('http_request_errors_total', route=name)
+                raise
+            finally:
+                METRICS.observe('http_request_duration_seconds', time.perf_counter() - started, route=name)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,151 @@
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from constants import ENCODING, MULTIPART_READ_SIZE, MULTIPART_MAX_HEADER_SIZE
+from encrypter import BytesInStream
+
+
+def parse_header(value: str) -> Tuple[str, dict[str, str]]:
+    main, _, rest = value.partition(';')
+    params = {}
+
+    while rest:
+        rest = rest.lstrip(' \t;')
+        name, separator, rest = rest.partition('=')
+        if not separator:
+            break
+        name = name.strip().lower()
+        rest = rest.lstrip()
+
+        if rest.startswith('"'):
+            chars = []
+            i = 1
+            while i < len(rest) and rest[i] != '"':
+                if rest[i] == '\\' and i + 1 < len(rest):
+                    i += 1
+                chars.append(rest[i])
+                i += 1
+            params[name] = ''.join(chars)
+            rest = rest[i + 1:]
+        else:
+            param, _, rest = rest.partition(';')
+            params[name] = param.strip()
+
+    return main.strip().lower(), params
+
+
+class MultipartPart(BytesInStream):
+    def __init__(self, parser: 'MultipartParser', headers: dict[str, str]):
+        self.parser = parser
+        self.headers = headers
+        self.done = False
+
+        (_, params) = parse_header(headers.get('content-disposition', ''))
+        self.name: Optional[str] = params.get('name')
+        self.filename: Optional[str] = params.get('filename')
+
+    def read(self, size: int = -1) -> bytes:
+        if self.done:
+            return b''
+        if size < 0:
+            return b''.join(iter(lambda: self.read(MULTIPART_READ_SIZE), b''))
+
+        (buf, self.done) = self.parser.read_body(size)
+        return buf
+
+    def drain(self):
+        while self.read(MULTIPART_READ_SIZE):
+            pass
+
+
+class MultipartParser:
+    def __init__(self, in_stream: BinaryIO, content_type: str, content_length: int):
+        (main, params) = parse_header(content_type or '')
+        if main != 'multipart/form-data' or not params.get('boundary'):
+            raise ValueError(f'Unsupported content type: {content_type}')
+
+        self.in_stream = in_stream
+        self.remaining = content_length
+        self.delimiter = b'\r\n--' + params['boundary'].encode(ENCODING)
+        self.buf = bytearray(b'\r\n')
+        self.finished = False
+
+    def fill(self, size: int) -> bool:
+        while len(self.buf) < size and self.remaining > 0:
+            data = self.in_stream.read(min(MULTIPART_READ_SIZE, self.remaining))
+            if not data:
+                raise ValueError('Unexpected end of multipart body')
+            self.remaining -= len(data)
+            self.buf += data
+        return len(self.buf) >= size
+
+    def read_body(self, size: int) -> Tuple[bytes, bool]:
+        self.fill(size + len(self.delimiter))
+        position = self.buf.find(self.delimiter)
+
+        if position == -1:
+            if self.remaining <= 0:
+                raise ValueError('Unexpected end of multipart body')
+            size = min(size, len(self.buf) - len(self.delimiter) + 1)
+            buf = bytes(self.buf[:size])
+            del self.buf[:size]
+            return buf, False
+
+        size = min(size, position)
+        buf = bytes(self.buf[:size])
+        del self.buf[:size]
+        if size < position:
+            return buf, False
+
+        self.skip_delimiter()
+        return buf, True
+
+    def skip_delimiter(self):
+        self.fill(len(self.delimiter) + 2)
+        if not self.buf.startswith(self.delimiter):
+            raise ValueError('Malformed multipart body')
+        del self.buf[:len(self.delimiter)]
+
+        if self.buf.startswith(b'--'):
+            self.finished = True
+            self.buf.clear()
+            while self.remaining > 0 and self.fill(1):
+                self.buf.clear()
+            return
+
+        position = self.find(b'\r\n', MULTIPART_MAX_HEADER_SIZE)
+        del self.buf[:position + 2]
+
+    def find(self, separator: bytes, limit: int) -> int:
+        while True:
+            # Only the first limit bytes are searched, headers already buffered in a large read count too
+            position = self.buf.find(separator, 0, limit + len(separator))
+            if position != -1:
+                return position
+            if len(self.buf) > limit or not self.fill(len(self.buf) + 1):
+                raise ValueError('Malformed multipart headers')
+
+    def read_headers(self) -> dict[str, str]:
+        self.fill(2)
+        if self.buf.startswith(b'\r\n'):
+            del self.buf[:2]
+            return {}
+
+        position = self.find(b'\r\n\r\n', MULTIPART_MAX_HEADER_SIZE)
+        lines = self.buf[:position].decode(ENCODING, 'replace').split('\r\n')
+        del self.buf[:position + 4]
+
+        headers = {}
+        for line in lines:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return headers
+
+    def parts(self) -> Iterator[MultipartPart]:
+        (_, done) = self.read_body(MULTIPART_READ_SIZE)
+        while not done:
+            (_, done) = self.read_body(MULTIPART_READ_SIZE)
+
+        while not self.finished:
+            part = MultipartPart(self, self.read_headers())
+            yield part
+            part.drain()
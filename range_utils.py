@@ -0,0 +1,72 @@
+import email.utils
+import os
+from typing import Optional, Tuple
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[list[Tuple[int, int]]]:
+    if not header:
+        return None
+
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+
+    ranges = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+
+        first, separator, last = item.partition('-')
+        first = first.strip()
+        last = last.strip()
+        if not separator or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+
+        if not first:
+            if not last:
+                return None
+            length = int(last)
+            if length > 0 and size > 0:
+                ranges.append((max(size - length, 0), size))
+            continue
+
+        start = int(first)
+        end = int(last) + 1 if last else size
+        if last and end <= start:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size)))
+
+    return merge_ranges(ranges)
+
+
+def merge_ranges(ranges: list[Tuple[int, int]]) -> list[Tuple[int, int]]:
+    result = []
+    for start, end in sorted(ranges):
+        if result and start <= result[-1][1]:
+            result[-1] = (result[-1][0], max(result[-1][1], end))
+        else:
+            result.append((start, end))
+    return result
+
+
+def make_etag(stat: os.stat_result) -> str:
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def if_range_matches(header: Optional[str], etag: str, mtime: float) -> bool:
+    if not header:
+        return True
+
+    header = header.strip()
+    if header.startswith('W/'):
+        return False
+    if header.startswith('"'):
+        return header == etag
+
+    try:
+        date = email.utils.parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    return int(date.timestamp()) == int(mtime)
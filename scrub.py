@@ -0,0 +1,167 @@
+import json
+import multiprocessing
+import os
+import time
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+from constants import CONTENT_PATH, ENCRYPTED_FILE_PREFIX, SCRUB_CHECKPOINT_PATH, SCRUB_REPORT_PATH
+from encrypter import FLAG_DEDUP, FLAG_COMPRESSED, CHUNK_ENTRY_SIZE, BinaryIOBytesInStream, ChunkListBytesInStream, \
+    decrypt_name, decrypt_chunk, decrypt_compressed_chunk, read_fully, read_header, chunk_id, chunk_id_key
+
+WORKER_KEY: Optional[bytes] = None
+WORKER_RATE = 0.0
+
+
+class Throttle:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.size = 0
+
+    def consume(self, size: int):
+        if self.rate <= 0:
+            return
+        self.size += size
+        delay = self.started + self.size / self.rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def scrub_file(key: bytes, path: str | Path, throttle: Throttle) -> list[dict]:
+    errors = []
+    with open(path, 'rb') as f:
+        in_stream = BinaryIOBytesInStream(f)
+        try:
+            header = read_header(key, in_stream)
+        except ValueError as e:
+            return [{'chunk': None, 'offset': 0, 'error': f'Header: {e}'}]
+
+        chunks = None
+        encrypted_size = header.encrypted_size()
+        if header.flags & FLAG_DEDUP:
+            chunks = ChunkListBytesInStream(key, in_stream, header)
+            encrypted_size = header.header_size + CHUNK_ENTRY_SIZE * header.chunk_count()
+            id_key = chunk_id_key(key)
+
+        decode = decrypt_compressed_chunk if header.flags & FLAG_COMPRESSED else decrypt_chunk
+        source = memoryview(bytearray(header.max_chunk_length()))
+        target = memoryview(bytearray(header.chunk_size))
+        for index in range(header.chunk_count()):
+            offset = header.chunk_offset(index)
+            length = header.chunk_length(index)
+            try:
+                if chunks:
+                    chunks.seek(offset)
+                    read = read_fully(chunks, source[:length])
+                else:
+                    in_stream.seek(offset)
+                    read = read_fully(in_stream, source[:length])
+            except ValueError as e:
+                errors.append({'chunk': index, 'offset': offset, 'error': str(e)})
+                continue
+            throttle.consume(read)
+            if read != length:
+                errors.append({'chunk': index, 'offset': offset, 'error': f'Truncated, {read} of {length} bytes'})
+                break
+            try:
+                plain = decode(key, index, source[:length], target[:header.chunk_plain_length(index)])
+                if chunks and chunk_id(id_key, plain) != chunks.chunk_id(index):
+                    raise ValueError('Chunk does not match its id')
+            except ValueError as e:
+                errors.append({'chunk': index, 'offset': offset, 'error': str(e)})
+
+        if os.fstat(f.fileno()).st_size > encrypted_size:
+            errors.append({'chunk': None, 'offset': encrypted_size, 'error': 'Unexpected trailing data'})
+    return errors
+
+
+def init_worker(key: bytes, rate: float):
+    global WORKER_KEY, WORKER_RATE
+    WORKER_KEY = key
+    WORKER_RATE = rate
+
+
+def scrub_worker(relative_path: str) -> Tuple[str, int, list[dict]]:
+    path = os.path.join(CONTENT_PATH, relative_path)
+    try:
+        size = os.path.getsize(path)
+        return relative_path, size, scrub_file(WORKER_KEY, path, Throttle(WORKER_RATE))
+    except OSError as e:
+        return relative_path, 0, [{'chunk': None, 'offset': 0, 'error': str(e)}]
+
+
+def collect(key: bytes, root: str) -> Tuple[list[Tuple[str, int]], list[str]]:
+    files = []
+    damaged_names = []
+    stack = ['']
+    while stack:
+        directory = stack.pop()
+        with os.scandir(os.path.join(root, directory)) as it:
+            for entry in it:
+                if not entry.name.startswith(ENCRYPTED_FILE_PREFIX):
+                    continue
+                relative_path = directory + '/' + entry.name if directory else entry.name
+                try:
+                    decrypt_name(key, entry.name)
+                except ValueError:
+                    damaged_names.append(relative_path)
+                if entry.is_dir():
+                    stack.append(relative_path)
+                else:
+                    files.append((relative_path, entry.stat().st_size))
+    return sorted(files), sorted(damaged_names)
+
+
+def load_checkpoint() -> dict[str, list[dict]]:
+    done = {}
+    if not os.path.exists(SCRUB_CHECKPOINT_PATH):
+        return done
+    with open(SCRUB_CHECKPOINT_PATH) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            done[record['path']] = record['errors']
+    return done
+
+
+def scrub(key: bytes,
+          workers: int,
+          rate: float,
+          callback: Callable[[str, int, list[dict]], None],
+          restart: bool = False,
+          planned: Optional[Callable[[int, int], None]] = None) -> dict:
+    if restart and os.path.exists(SCRUB_CHECKPOINT_PATH):
+        os.remove(SCRUB_CHECKPOINT_PATH)
+
+    done = load_checkpoint()
+    (files, damaged_names) = collect(key, CONTENT_PATH)
+    remaining = [x for (x, _) in files if x not in done]
+    if planned:
+        planned(len(remaining), sum(size for (x, size) in files if x not in done))
+
+    # Spawned workers do not inherit the threads and open files of the parent process
+    context = multiprocessing.get_context('spawn')
+    with open(SCRUB_CHECKPOINT_PATH, 'a') as checkpoint, \
+            context.Pool(workers, init_worker, (key, rate / workers if rate else 0)) as pool:
+        for (relative_path, size, errors) in pool.imap_unordered(scrub_worker, remaining):
+            checkpoint.write(json.dumps({'path': relative_path, 'errors': errors}) + '\n')
+            checkpoint.flush()
+            done[relative_path] = errors
+            callback(relative_path, size, errors)
+
+    report = {
+        'finished': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'files': len(files),
+        'bytes': sum(size for (_, size) in files),
+        'damaged_files': [{'path': x, 'errors': done[x]} for (x, _) in files if done.get(x)],
+        'damaged_names': damaged_names,
+    }
+    temp = SCRUB_REPORT_PATH + '_tmp'
+    with open(temp, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(temp, SCRUB_REPORT_PATH)
+    os.remove(SCRUB_CHECKPOINT_PATH)
+    return report
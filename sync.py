@@ -0,0 +1,275 @@
+import hashlib
+import os
+import shutil
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+from constants import CONTENT_PATH, META_PATH, KEY_PATH, MANIFESTS_PATH, ENCRYPTED_FILE_PREFIX, SYNC_READ_SIZE, \
+    CHUNKS_DIR_NAME
+from encrypter import BinaryIOBytesInStream, read_header
+
+MANIFEST_HEADER = struct.Struct('>QQI')
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+# Content and Meta sit next to each other, the target mirrors them under the same names
+SOURCE_ROOT = os.path.dirname(CONTENT_PATH)
+
+COPIED = 'copied'
+PATCHED = 'patched'
+UNCHANGED = 'unchanged'
+
+
+class Manifest:
+    __slots__ = ('size', 'mtime', 'digests')
+
+    def __init__(self, size: int, mtime: int, digests: list[bytes]):
+        self.size = size
+        self.mtime = mtime
+        self.digests = digests
+
+    def matches(self, stat: os.stat_result) -> bool:
+        return self.size == stat.st_size and self.mtime == stat.st_mtime_ns
+
+
+def mirror_path(root: str | Path, path: str) -> str:
+    return os.path.join(root, os.path.relpath(path, SOURCE_ROOT))
+
+
+def manifest_path(manifests: str, relative_path: str) -> str:
+    # Stored names are already ciphertext, the hash only keeps the manifest names short and flat
+    return os.path.join(manifests, hashlib.sha256(relative_path.encode()).hexdigest())
+
+
+def read_manifest(manifests: str, relative_path: str) -> Optional[Manifest]:
+    try:
+        with open(manifest_path(manifests, relative_path), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    if len(data) < MANIFEST_HEADER.size:
+        return None
+    (size, mtime, count) = MANIFEST_HEADER.unpack_from(data)
+    if len(data) != MANIFEST_HEADER.size + count * DIGEST_SIZE:
+        return None
+    digests = [data[MANIFEST_HEADER.size + i * DIGEST_SIZE:MANIFEST_HEADER.size + (i + 1) * DIGEST_SIZE]
+               for i in range(count)]
+    return Manifest(size, mtime, digests)
+
+
+def write_manifest(manifests: str, relative_path: str, manifest: Manifest):
+    os.makedirs(manifests, exist_ok=True)
+    target = manifest_path(manifests, relative_path)
+    temp = target + '_tmp'
+    with open(temp, 'wb') as f:
+        f.write(MANIFEST_HEADER.pack(manifest.size, manifest.mtime, len(manifest.digests)))
+        f.write(b''.join(manifest.digests))
+    os.replace(temp, target)
+
+
+def spans(key: bytes, f) -> list[Tuple[int, int]]:
+    in_stream = BinaryIOBytesInStream(f)
+    header = read_header(key, in_stream)
+    size = in_stream.size()
+    result = [(0, header.header_size)] if header.header_size else []
+    for index in range(header.chunk_count()):
+        offset = header.chunk_offset(index)
+        if offset >= size:
+            break
+        result.append((offset, min(header.chunk_length(index), size - offset)))
+    end = result[-1][0] + result[-1][1] if result else 0
+    if size > end:
+        result.append((end, size - end))
+    return result
+
+
+def hash_span(f, offset: int, length: int, buf: memoryview) -> bytes:
+    digest = hashlib.sha256()
+    f.seek(offset)
+    while length:
+        read = f.readinto(buf[:min(length, len(buf))])
+        if not read:
+            break
+        digest.update(buf[:read])
+        length -= read
+    return digest.digest()
+
+
+def read_layout(key: bytes, path: str) -> list[Tuple[int, int]]:
+    with open(path, 'rb') as f:
+        return spans(key, f)
+
+
+def build_manifest(key: bytes, path: str) -> Manifest:
+    buf = memoryview(bytearray(SYNC_READ_SIZE))
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        digests = [hash_span(f, offset, length, buf) for (offset, length) in spans(key, f)]
+    return Manifest(stat.st_size, stat.st_mtime_ns, digests)
+
+
+def load_manifest(key: bytes, manifests: str, root: str, relative_path: str) -> Manifest:
+    path = os.path.join(root, relative_path)
+    manifest = read_manifest(manifests, relative_path)
+    if manifest is None or not manifest.matches(os.stat(path)):
+        manifest = build_manifest(key, path)
+        write_manifest(manifests, relative_path, manifest)
+    return manifest
+
+
+def copy_spans(source: str, target: str, layout: list[Tuple[int, int]], indexes: list[int]):
+    buf = memoryview(bytearray(SYNC_READ_SIZE))
+    with open(source, 'rb') as f_in, open(target, 'r+b') as f_out:
+        for index in indexes:
+            (offset, length) = layout[index]
+            f_in.seek(offset)
+            f_out.seek(offset)
+            while length:
+                read = f_in.readinto(buf[:min(length, len(buf))])
+                if not read:
+                    raise ValueError('Source changed during sync')
+                f_out.write(buf[:read])
+                length -= read
+        f_out.truncate(layout[-1][0] + layout[-1][1] if layout else 0)
+        f_out.flush()
+        os.fsync(f_out.fileno())
+
+
+def verify_copy(key: bytes, path: str, expected: Manifest, indexes: Optional[list[int]]) -> Manifest:
+    buf = memoryview(bytearray(SYNC_READ_SIZE))
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        layout = spans(key, f)
+        if stat.st_size != expected.size or len(layout) != len(expected.digests):
+            raise ValueError('Copy does not match the source manifest')
+        for index in range(len(layout)) if indexes is None else indexes:
+            if hash_span(f, *layout[index], buf) != expected.digests[index]:
+                raise ValueError(f'Chunk {index} does not match the source manifest after copying')
+    return Manifest(stat.st_size, stat.st_mtime_ns, expected.digests)
+
+
+def sync_file(key: bytes, target: str, relative_path: str) -> Tuple[str, int]:
+    source_path = os.path.join(CONTENT_PATH, relative_path)
+    target_path = os.path.join(mirror_path(target, CONTENT_PATH), relative_path)
+    target_manifests = mirror_path(target, MANIFESTS_PATH)
+
+    source = load_manifest(key, MANIFESTS_PATH, CONTENT_PATH, relative_path)
+    existing = None
+    if os.path.exists(target_path):
+        existing = load_manifest(key, target_manifests, mirror_path(target, CONTENT_PATH), relative_path)
+        if existing.digests == source.digests and existing.size == source.size:
+            return UNCHANGED, 0
+
+    if existing is not None and existing.size == source.size and len(existing.digests) == len(source.digests):
+        # Same layout, only the chunks with a different ciphertext hash are rewritten in place
+        layout = read_layout(key, source_path)
+        indexes = [i for (i, digest) in enumerate(source.digests) if existing.digests[i] != digest]
+        copy_spans(source_path, target_path, layout, indexes)
+        write_manifest(target_manifests, relative_path, verify_copy(key, target_path, source, indexes))
+        return PATCHED, sum(layout[i][1] for i in indexes)
+
+    temp = target_path + '_sync'
+    shutil.copyfile(source_path, temp)
+    try:
+        manifest = verify_copy(key, temp, source, None)
+    except (OSError, ValueError):
+        os.remove(temp)
+        raise
+    os.replace(temp, target_path)
+    write_manifest(target_manifests, relative_path, manifest)
+    return COPIED, source.size
+
+
+def prune_manifests(manifests: str, files: list[str]):
+    names = {os.path.basename(manifest_path(manifests, x)) for x in files}
+    if not os.path.isdir(manifests):
+        return
+    for name in os.listdir(manifests):
+        if name not in names:
+            os.remove(os.path.join(manifests, name))
+
+
+def collect(root: str) -> Tuple[list[str], list[str]]:
+    files = []
+    directories = []
+    stack = ['']
+    while stack:
+        directory = stack.pop()
+        try:
+            it = os.scandir(os.path.join(root, directory))
+        except FileNotFoundError:
+            continue
+        with it:
+            for entry in it:
+                relative_path = directory + '/' + entry.name if directory else entry.name
+                # The chunk store of deduplicated files is mirrored with the files that reference it
+                in_chunks = relative_path.split('/', 1)[0] == CHUNKS_DIR_NAME
+                if not entry.name.startswith(ENCRYPTED_FILE_PREFIX) and not in_chunks:
+                    continue
+                if entry.is_dir():
+                    directories.append(relative_path)
+                    stack.append(relative_path)
+                else:
+                    files.append(relative_path)
+    return sorted(files), sorted(directories)
+
+
+def remove_deleted(target: str, files: list[str], directories: list[str]) -> int:
+    root = mirror_path(target, CONTENT_PATH)
+    (target_files, target_directories) = collect(root)
+    keep_files = set(files)
+    keep_directories = set(directories)
+    removed = 0
+    for relative_path in target_files:
+        if relative_path not in keep_files:
+            os.remove(os.path.join(root, relative_path))
+            removed += 1
+    for relative_path in sorted(target_directories, reverse=True):
+        if relative_path not in keep_directories:
+            shutil.rmtree(os.path.join(root, relative_path), ignore_errors=True)
+    return removed
+
+
+def sync(key: bytes,
+         target: str,
+         workers: int,
+         callback: Callable[[str, int, Optional[str], Optional[Exception]], None],
+         delete: bool = False,
+         planned: Optional[Callable[[int, int], None]] = None) -> dict:
+    (files, directories) = collect(CONTENT_PATH)
+    if planned:
+        planned(len(files), sum(os.path.getsize(os.path.join(CONTENT_PATH, x)) for x in files))
+
+    os.makedirs(mirror_path(target, CONTENT_PATH), exist_ok=True)
+    os.makedirs(mirror_path(target, META_PATH), exist_ok=True)
+    key_target = mirror_path(target, KEY_PATH)
+    if not os.path.exists(key_target) or Path(key_target).read_bytes() != Path(KEY_PATH).read_bytes():
+        shutil.copyfile(KEY_PATH, key_target)
+    for relative_path in directories:
+        os.makedirs(os.path.join(mirror_path(target, CONTENT_PATH), relative_path), exist_ok=True)
+
+    report = {'files': len(files), COPIED: 0, PATCHED: 0, UNCHANGED: 0, 'failed': 0, 'bytes_copied': 0,
+              'removed': 0}
+
+    def run(relative_path: str):
+        size = os.path.getsize(os.path.join(CONTENT_PATH, relative_path))
+        try:
+            (state, copied) = sync_file(key, target, relative_path)
+        except (OSError, ValueError) as e:
+            callback(relative_path, size, None, e)
+            return None, 0
+        callback(relative_path, size, state, None)
+        return state, copied
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sync') as executor:
+        for (state, copied) in executor.map(run, files):
+            report[state or 'failed'] += 1
+            report['bytes_copied'] += copied
+
+    prune_manifests(MANIFESTS_PATH, files)
+    if delete and not report['failed']:
+        report['removed'] = remove_deleted(target, files, directories)
+        prune_manifests(mirror_path(target, MANIFESTS_PATH), files)
+    return report
@@ -0,0 +1,82 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from archive import ZIP, TAR, ERRORS_NAME, archive
+from constants import CHUNK_SIZE
+from encrypter import BinaryIOBytesInStream, BinaryIOBytesOutStream, encrypt_name, encrypt_stream
+
+KEY = os.urandom(32)
+
+
+def write_file(directory, name: str, data: bytes) -> str:
+    path = os.path.join(directory, encrypt_name(KEY, name))
+    with open(path, 'wb') as f:
+        encrypt_stream(KEY, BinaryIOBytesInStream(io.BytesIO(data)), BinaryIOBytesOutStream(f), size=len(data),
+                       chunk_size=CHUNK_SIZE)
+    return path
+
+
+def read_archive(path, archive_format: str) -> dict[str, bytes]:
+    # Copy every piece as it is produced, the writer may hand out views of reused buffers
+    data = b''.join(bytes(x) for x in archive(KEY, path, 'folder', archive_format))
+    if archive_format == ZIP:
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            return {x.filename: z.read(x) for x in z.infolist() if not x.is_dir()}
+    with tarfile.open(fileobj=io.BytesIO(data)) as t:
+        return {x.name: t.extractfile(x).read() for x in t.getmembers() if x.isfile()}
+
+
+@pytest.mark.parametrize('archive_format', [ZIP, TAR])
+def test_small_multi_chunk_file(tmp_path, archive_format):
+    # Small enough to be decrypted ahead of the writer, but spread over several chunks
+    data = os.urandom(3 * CHUNK_SIZE + 17)
+    write_file(tmp_path, 'small.bin', data)
+    write_file(tmp_path, 'empty.txt', b'')
+    assert read_archive(tmp_path, archive_format) == {'folder/small.bin': data, 'folder/empty.txt': b''}
+
+
+@pytest.mark.parametrize('archive_format', [ZIP, TAR])
+def test_large_file(tmp_path, archive_format):
+    data = os.urandom(12 * CHUNK_SIZE + 5)
+    write_file(tmp_path, 'large.bin', data)
+    assert read_archive(tmp_path, archive_format) == {'folder/large.bin': data}
+
+
+@pytest.mark.parametrize('archive_format', [ZIP, TAR])
+def test_names_stay_inside_folder(tmp_path, archive_format):
+    write_file(tmp_path, '../../evil.txt', b'a')
+    write_file(tmp_path, 'sub/dir.txt', b'b')
+    write_file(tmp_path, '..', b'c')
+    write_file(tmp_path, '.', b'd')
+    assert read_archive(tmp_path, archive_format) == {'folder/.._.._evil.txt': b'a', 'folder/sub_dir.txt': b'b'}
+
+
+def corrupt(path: str, position: int):
+    with open(path, 'r+b') as f:
+        f.seek(position)
+        byte = f.read(1)
+        f.seek(position)
+        f.write(bytes([byte[0] ^ 1]))
+
+
+@pytest.mark.parametrize('archive_format', [ZIP, TAR])
+def test_corrupt_files(tmp_path, archive_format):
+    good = os.urandom(100)
+    small = os.urandom(2 * CHUNK_SIZE)
+    large = os.urandom(12 * CHUNK_SIZE)
+    write_file(tmp_path, 'good.bin', good)
+    corrupt(write_file(tmp_path, 'small.bin', small), CHUNK_SIZE)
+    corrupt(write_file(tmp_path, 'large.bin', large), 6 * CHUNK_SIZE)
+
+    members = read_archive(tmp_path, archive_format)
+    # The small file is left out, the large one was already started and is zero filled from the bad chunk on
+    assert members.keys() == {'folder/good.bin', 'folder/large.bin', 'folder/' + ERRORS_NAME}
+    assert members['folder/good.bin'] == good
+    assert members['folder/large.bin'][:5 * CHUNK_SIZE] == large[:5 * CHUNK_SIZE]
+    assert members['folder/large.bin'][-CHUNK_SIZE:] == bytes(CHUNK_SIZE)
+    assert members['folder/' + ERRORS_NAME].decode().splitlines() == ['folder/large.bin (zero filled)',
+                                                                      'folder/small.bin']
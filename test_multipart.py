@@ -0,0 +1,75 @@
+import io
+
+import pytest
+
+from constants import MULTIPART_READ_SIZE, MULTIPART_MAX_HEADER_SIZE
+from multipart import MultipartParser, parse_header
+
+BOUNDARY = 'XBOUNDARYX'
+CONTENT_TYPE = f'multipart/form-data; boundary={BOUNDARY}'
+
+
+class TrickleStream(io.RawIOBase):
+    # Hands out at most step bytes per read, so delimiters and headers get split across reads
+    def __init__(self, data: bytes, step: int):
+        self.data = io.BytesIO(data)
+        self.step = step
+
+    def read(self, size: int = -1) -> bytes:
+        return self.data.read(self.step if size < 0 else min(size, self.step))
+
+
+def make_body(parts: list[tuple[str, str, bytes]]) -> bytes:
+    body = b'preamble'
+    for (name, filename, data) in parts:
+        body += (f'\r\n--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n').encode() + data
+    return body + f'\r\n--{BOUNDARY}--\r\nepilogue'.encode()
+
+
+def read_parts(body: bytes, step: int) -> list[tuple[str, str, bytes]]:
+    parser = MultipartParser(TrickleStream(body, step), CONTENT_TYPE, len(body))
+    return [(x.name, x.filename, x.read()) for x in parser.parts()]
+
+
+@pytest.mark.parametrize('step', [1, 3, len(BOUNDARY) + 3, MULTIPART_READ_SIZE])
+def test_parts_split_across_reads(step):
+    parts = [
+        ('file', 'a.txt', b'hello'),
+        ('file', 'empty.bin', b''),
+        # Data that looks like the start of a delimiter must stay in the part
+        ('file', 'b.bin', b'\r\n--XBOUNDARY\r\n--XBOUND' + b'x' * 100 + b'\r\n-'),
+    ]
+    assert read_parts(make_body(parts), step) == parts
+
+
+@pytest.mark.parametrize('step', [MULTIPART_READ_SIZE - 1, MULTIPART_READ_SIZE + 5])
+def test_part_larger_than_read_size(step):
+    data = bytes(range(256)) * (3 * MULTIPART_READ_SIZE // 256) + b'tail'
+    parts = [('file', 'big.bin', data), ('file', 'small.txt', b'small')]
+    assert read_parts(make_body(parts), step) == parts
+
+
+def test_parse_header_quoted_params():
+    (main, params) = parse_header('form-data; name="file"; filename="a \\"b\\"; c.txt"; size=10')
+    assert main == 'form-data'
+    assert params == {'name': 'file', 'filename': 'a "b"; c.txt', 'size': '10'}
+
+
+@pytest.mark.parametrize('content_type', [None, 'text/plain', 'multipart/form-data', 'multipart/form-data; boundary='])
+def test_unsupported_content_type(content_type):
+    with pytest.raises(ValueError):
+        MultipartParser(io.BytesIO(b''), content_type, 0)
+
+
+def test_truncated_body():
+    body = make_body([('file', 'a.txt', b'hello world')])
+    body = body[:body.index(b'world')]
+    with pytest.raises(ValueError):
+        read_parts(body, 7)
+
+
+def test_headers_too_large():
+    body = f'\r\n--{BOUNDARY}\r\nX-Long: '.encode() + b'a' * (2 * MULTIPART_MAX_HEADER_SIZE)
+    with pytest.raises(ValueError):
+        read_parts(body + f'\r\n\r\ndata\r\n--{BOUNDARY}--\r\n'.encode(), 1024)
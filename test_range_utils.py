@@ -0,0 +1,84 @@
+import email.utils
+
+import pytest
+
+from range_utils import parse_range, merge_ranges, if_range_matches
+
+SIZE = 1000
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-0', [(0, 1)]),
+    ('bytes=5-9', [(5, 10)]),
+    ('bytes=990-', [(990, 1000)]),
+    ('bytes=990-5000', [(990, 1000)]),
+    ('BYTES = 1-2', [(1, 3)]),
+])
+def test_single_range(header, expected):
+    assert parse_range(header, SIZE) == expected
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=-100', [(900, 1000)]),
+    ('bytes=-1000', [(0, 1000)]),
+    ('bytes=-5000', [(0, 1000)]),
+    ('bytes=-0', []),
+])
+def test_suffix_range(header, expected):
+    assert parse_range(header, SIZE) == expected
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-1,200-204', [(0, 2), (200, 205)]),
+    ('bytes=200-204, 0-1', [(0, 2), (200, 205)]),
+    ('bytes=0-10,5-20,21-30', [(0, 31)]),
+    ('bytes=0-1,,-10', [(0, 2), (990, 1000)]),
+    ('bytes=0-1,5000-6000', [(0, 2)]),
+])
+def test_multiple_ranges(header, expected):
+    assert parse_range(header, SIZE) == expected
+
+
+@pytest.mark.parametrize('header, size', [
+    ('bytes=1000-', SIZE),
+    ('bytes=5000-6000', SIZE),
+    ('bytes=0-', 0),
+    ('bytes=-10', 0),
+])
+def test_unsatisfiable_range(header, size):
+    assert parse_range(header, size) == []
+
+
+@pytest.mark.parametrize('header', [
+    None,
+    '',
+    'bytes',
+    'bytes=',
+    'items=0-1',
+    'bytes=a-b',
+    'bytes=1-a',
+    'bytes=5',
+    'bytes=-',
+    'bytes=9-5',
+    'bytes=1-2-3',
+    'bytes=0-1,x',
+    'bytes=+1-2',
+])
+def test_malformed_range(header):
+    assert parse_range(header, SIZE) is None
+
+
+def test_merge_ranges():
+    assert merge_ranges([(10, 20), (0, 5), (5, 8), (15, 30)]) == [(0, 8), (10, 30)]
+
+
+def test_if_range():
+    etag = '"abc-10"'
+    mtime = 1700000000
+    assert if_range_matches(None, etag, mtime)
+    assert if_range_matches(etag, etag, mtime)
+    assert not if_range_matches('"other"', etag, mtime)
+    assert not if_range_matches('W/' + etag, etag, mtime)
+    assert if_range_matches(email.utils.formatdate(mtime, usegmt=True), etag, mtime + 0.5)
+    assert not if_range_matches(email.utils.formatdate(mtime - 1, usegmt=True), etag, mtime)
+    assert not if_range_matches('not a date', etag, mtime)
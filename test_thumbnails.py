@@ -0,0 +1,46 @@
+import io
+import os
+
+import pytest
+
+from constants import CHUNK_SIZE
+from encrypter import BinaryIOBytesInStream, BinaryIOBytesOutStream, encrypt_stream, read_header
+from thumbnails import DecryptedReader, render_thumbnail
+
+Image = pytest.importorskip('PIL.Image')
+
+KEY = os.urandom(32)
+
+
+def encrypted_reader(data: bytes) -> DecryptedReader:
+    out = io.BytesIO()
+    encrypt_stream(KEY, BinaryIOBytesInStream(io.BytesIO(data)), BinaryIOBytesOutStream(out), size=len(data),
+                   chunk_size=CHUNK_SIZE)
+    in_stream = BinaryIOBytesInStream(io.BytesIO(out.getvalue()))
+    return DecryptedReader(KEY, in_stream, read_header(KEY, in_stream))
+
+
+def test_reader_seeks_across_chunks():
+    data = os.urandom(3 * CHUNK_SIZE + 17)
+    reader = encrypted_reader(data)
+    assert reader.read(10) == data[:10]
+    reader.seek(CHUNK_SIZE - 5)
+    assert reader.read(10) == data[CHUNK_SIZE - 5:CHUNK_SIZE + 5]
+    reader.seek(-20, io.SEEK_END)
+    assert reader.read() == data[-20:]
+    reader.seek(5, io.SEEK_CUR)
+    assert reader.read(10) == b''
+    reader.seek(0)
+    assert reader.read() == data
+
+
+def test_thumbnail_of_multi_chunk_image():
+    out = io.BytesIO()
+    Image.frombytes('RGB', (512, 512), os.urandom(512 * 512 * 3)).save(out, 'PNG')
+    assert len(out.getvalue()) > CHUNK_SIZE
+    with Image.open(io.BytesIO(render_thumbnail(encrypted_reader(out.getvalue())))) as thumbnail:
+        assert thumbnail.format == 'JPEG' and max(thumbnail.size) == 256
+
+
+def test_thumbnail_of_non_image():
+    assert render_thumbnail(encrypted_reader(b'not an image' * 1000)) == b''
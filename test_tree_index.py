@@ -0,0 +1,50 @@
+import os
+
+from tree_index import IndexEntry, TreeIndex
+
+KEY = os.urandom(32)
+
+
+def make_index(tmp_path) -> TreeIndex:
+    os.makedirs(tmp_path / 'content')
+    index = TreeIndex(KEY, str(tmp_path / 'content'), str(tmp_path / 'index'))
+    index.open()
+    return index
+
+
+def test_search_returns_first_names(tmp_path):
+    index = make_index(tmp_path)
+    for i in reversed(range(20)):
+        index.put(IndexEntry(f'_{i}', f'file{i:02}.txt', False, 1, 0))
+    index.put(IndexEntry('_x', 'other.txt', False, 1, 0))
+    assert [x.name for x in index.search('FILE', 3)] == ['file00.txt', 'file01.txt', 'file02.txt']
+    index.close()
+
+
+def test_same_name_entries(tmp_path):
+    # Encrypted names are random, two on-disk entries can decrypt to the same name
+    index = make_index(tmp_path)
+    index.put(IndexEntry('_a', 'same.txt', False, 1, 0))
+    index.put(IndexEntry('_b', 'same.txt', False, 2, 0))
+    index.delete('_a')
+    assert [x.path for x in index.search('same', 10)] == ['_b']
+    assert index.stats(tmp_path / 'content') == (2, 1)
+    index.close()
+
+
+def test_changes_before_open_are_kept(tmp_path):
+    index = make_index(tmp_path)
+    index.put(IndexEntry('_a', 'a.txt', False, 1, 0))
+    index.put(IndexEntry('_b', 'b.txt', False, 1, 0))
+    index.close()
+
+    index = TreeIndex(KEY, str(tmp_path / 'content'), str(tmp_path / 'index'))
+    index.remove(tmp_path / 'content' / '_a')
+    index.open()
+    assert [x.name for x in index.search('', 10)] == ['b.txt']
+    index.close()
+
+    index = TreeIndex(KEY, str(tmp_path / 'content'), str(tmp_path / 'index'))
+    index.open()
+    assert [x.name for x in index.search('', 10)] == ['b.txt']
+    index.close()
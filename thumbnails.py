@@ -0,0 +1,168 @@
+import io
+import os
+import struct
+import threading
+from contextlib import closing
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from Crypto.Hash import HMAC, SHA256
+
+from constants import CONTENT_PATH, THUMBNAILS_PATH, THUMBNAIL_SIZE, THUMBNAIL_QUALITY, THUMBNAIL_WORKERS, ENCODING, \
+    THUMBNAIL_MAX_SOURCE_SIZE
+from encrypter import BinaryIOBytesInStream, BytesInStream, FileHeader, encrypt, decrypt, decrypt_chunks, read_header
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+MTIME = struct.Struct('>Q')
+
+THUMBNAIL_EXECUTOR = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix='thumbnail')
+PENDING: dict[str, Future] = {}
+PENDING_LOCK = threading.Lock()
+
+
+class DecryptedReader(io.RawIOBase):
+    # Seekable plaintext of an encrypted file, decrypted a chunk at a time as the image decoder asks for it
+    def __init__(self, key: bytes, in_stream: BytesInStream, header: FileHeader):
+        self.key = key
+        self.in_stream = in_stream
+        self.header = header
+        self.position = 0
+        self.index = -1
+        self.chunk = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.header.size}[whence]
+        self.position = max(base + offset, 0)
+        return self.position
+
+    def readinto(self, buf: bytearray | memoryview) -> int:
+        # Fills the whole buffer across chunk boundaries, decoders treat a short read as the end of the file
+        view = memoryview(buf).cast('B')
+        written = 0
+        while written < len(view) and self.position < self.header.size:
+            index = self.position // self.header.chunk_size
+            if index != self.index:
+                with closing(decrypt_chunks(self.key, self.in_stream, self.header, index, index + 1)) as chunks:
+                    self.chunk = bytes(next(chunks))
+                self.index = index
+            offset = self.position - self.header.chunk_size * index
+            size = min(len(view) - written, len(self.chunk) - offset)
+            view[written:written + size] = self.chunk[offset:offset + size]
+            written += size
+            self.position += size
+        return written
+
+
+def thumbnails_enabled() -> bool:
+    return Image is not None
+
+
+def thumbnail_path(key: bytes, path: str | Path) -> str:
+    relative_path = os.path.relpath(path, CONTENT_PATH).replace(os.sep, '/')
+    return os.path.join(THUMBNAILS_PATH, HMAC.new(key, relative_path.encode(ENCODING), SHA256).hexdigest())
+
+
+def read_thumbnail(key: bytes, path: str | Path) -> Optional[bytes]:
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        with open(thumbnail_path(key, path), 'rb') as f:
+            data = decrypt(key, f.read())
+    except (OSError, ValueError):
+        return None
+
+    (thumbnail_mtime,) = MTIME.unpack_from(data)
+    return data[MTIME.size:] if thumbnail_mtime == mtime else None
+
+
+def render_thumbnail(source: DecryptedReader) -> bytes:
+    try:
+        with Image.open(source) as image:
+            image.draft('RGB', (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            out = io.BytesIO()
+            image.convert('RGB').save(out, 'JPEG', quality=THUMBNAIL_QUALITY)
+            return out.getvalue()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return b''
+
+
+def make_thumbnail(key: bytes, path: str | Path) -> Optional[bytes]:
+    with open(path, 'rb') as f:
+        mtime = os.fstat(f.fileno()).st_mtime_ns
+        in_stream = BinaryIOBytesInStream(f)
+        header = read_header(key, in_stream)
+        # An empty thumbnail stops retrying files that are too large or not decodable images until they change
+        data = b''
+        if header.size <= THUMBNAIL_MAX_SOURCE_SIZE:
+            data = render_thumbnail(DecryptedReader(key, in_stream, header))
+
+    target = thumbnail_path(key, path)
+    os.makedirs(THUMBNAILS_PATH, exist_ok=True)
+    temp = target + '_tmp'
+    with open(temp, 'wb') as f:
+        f.write(encrypt(key, MTIME.pack(mtime) + data))
+    os.replace(temp, target)
+    return data
+
+
+def schedule_thumbnail(key: bytes, path: str | Path) -> Future:
+    target = thumbnail_path(key, path)
+    with PENDING_LOCK:
+        future = PENDING.get(target)
+        if future is not None:
+            return future
+        future = THUMBNAIL_EXECUTOR.submit(make_thumbnail, key, path)
+        PENDING[target] = future
+    future.add_done_callback(lambda x: remove_pending(target, x))
+    return future
+
+
+def remove_pending(target: str, future: Future):
+    with PENDING_LOCK:
+        if PENDING.get(target) is future:
+            del PENDING[target]
+
+
+def get_thumbnail(key: bytes, path: str | Path) -> Optional[bytes]:
+    if not thumbnails_enabled():
+        return None
+    data = read_thumbnail(key, path)
+    if data is None:
+        try:
+            data = schedule_thumbnail(key, path).result()
+        except (OSError, ValueError):
+            return None
+    return data or None
+
+
+def prepare_thumbnails(key: bytes, paths: list[Path]):
+    if not thumbnails_enabled():
+        return
+
+    def prepare():
+        for path in paths:
+            if read_thumbnail(key, path) is None:
+                schedule_thumbnail(key, path)
+
+    THUMBNAIL_EXECUTOR.submit(prepare)
+
+
+def remove_thumbnail(key: bytes, path: str | Path):
+    try:
+        os.remove(thumbnail_path(key, path))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,295 @@
+import heapq
+import json
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple
+
+from constants import ENCRYPTED_FILE_PREFIX, INDEX_COMPACT_MIN_RECORDS
+from encrypter import encrypt, decrypt, decrypt_name, get_header
+
+RECORD_HEADER = struct.Struct('>I')
+
+PUT = 'p'
+DELETE = 'd'
+
+
+class IndexEntry:
+    __slots__ = ('path', 'name', 'is_dir', 'size', 'mtime')
+
+    def __init__(self, path: str, name: str, is_dir: bool, size: int = 0, mtime: int = 0):
+        self.path = path
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+
+
+def parent_of(path: str) -> str:
+    return path.rsplit('/', 1)[0] if '/' in path else ''
+
+
+def join_path(parent: str, name: str) -> str:
+    return parent + '/' + name if parent else name
+
+
+def ancestors_of(path: str) -> list[str]:
+    result = []
+    while path:
+        path = parent_of(path)
+        result.append(path)
+    return result
+
+
+class TreeIndex:
+    def __init__(self, key: bytes, content_path: str, index_path: str):
+        self.key = key
+        self.content_path = content_path
+        self.index_path = index_path
+        self.lock = threading.RLock()
+        self.entries: dict[str, IndexEntry] = {'': IndexEntry('', '', True)}
+        self.children: dict[str, set[str]] = {'': set()}
+        self.totals: dict[str, list[int]] = {'': [0, 0]}
+        self.records = 0
+        self.log: Optional[BinaryIO] = None
+        # Adds and removes made while the log is still loading, replayed once it is open
+        self.pending: Optional[list[Tuple[str | Path, Optional[str]]]] = []
+        self.reconciling = False
+
+    def open(self):
+        # A large log takes a while to decrypt, it is loaded into a separate index so listings aren't blocked
+        loaded = TreeIndex(self.key, self.content_path, self.index_path)
+        loaded.load()
+        with self.lock:
+            self.entries = loaded.entries
+            self.children = loaded.children
+            self.totals = loaded.totals
+            self.records = loaded.records
+            self.log = open(self.index_path, 'ab')
+            pending = self.pending or []
+            self.pending = None
+            for (path, name) in pending:
+                try:
+                    if name is None:
+                        self.remove(path)
+                    else:
+                        self.add(path, name)
+                except OSError:
+                    continue
+            self.compact_if_needed()
+
+    def close(self):
+        with self.lock:
+            if self.log:
+                self.log.close()
+                self.log = None
+
+    def load(self):
+        if not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path, 'rb+') as f:
+            position = 0
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if not header:
+                    break
+                if len(header) < RECORD_HEADER.size:
+                    f.truncate(position)
+                    break
+                (size,) = RECORD_HEADER.unpack(header)
+                body = f.read(size)
+                try:
+                    record = json.loads(decrypt(self.key, body))
+                except ValueError:
+                    f.truncate(position)
+                    break
+                self.apply(record)
+                position = f.tell()
+
+    def apply(self, record: dict):
+        self.records += 1
+        if record['o'] == PUT:
+            self._put(IndexEntry(record['p'], record['n'], bool(record['d']), record['s'], record['m']))
+        elif record['o'] == DELETE:
+            self._delete(record['p'])
+
+    def write(self, out: BinaryIO, record: dict):
+        body = encrypt(self.key, json.dumps(record, separators=(',', ':')).encode())
+        out.write(RECORD_HEADER.pack(len(body)) + body)
+
+    def append(self, record: dict):
+        if not self.log:
+            return
+        self.write(self.log, record)
+        self.log.flush()
+        self.records += 1
+
+    def compact_if_needed(self):
+        with self.lock:
+            if self.log and self.records > max(INDEX_COMPACT_MIN_RECORDS, 2 * len(self.entries)):
+                self.compact()
+
+    def compact(self):
+        temp = self.index_path + '_compact'
+        with open(temp, 'wb') as f:
+            for entry in self.entries.values():
+                self.write(f, self.put_record(entry))
+        self.log.close()
+        os.replace(temp, self.index_path)
+        self.log = open(self.index_path, 'ab')
+        self.records = len(self.entries)
+
+    @staticmethod
+    def put_record(entry: IndexEntry) -> dict:
+        return {'o': PUT, 'p': entry.path, 'n': entry.name, 'd': int(entry.is_dir), 's': entry.size, 'm': entry.mtime}
+
+    def _put(self, entry: IndexEntry):
+        old = self.entries.get(entry.path)
+        if old and not old.is_dir:
+            self._add_totals(old.path, -old.size, -1)
+
+        self.entries[entry.path] = entry
+        if entry.path:
+            self.children.setdefault(parent_of(entry.path), set()).add(entry.path)
+        if entry.is_dir:
+            self.children.setdefault(entry.path, set())
+            self.totals.setdefault(entry.path, [0, 0])
+        else:
+            self._add_totals(entry.path, entry.size, 1)
+
+    def _delete(self, path: str):
+        entry = self.entries.get(path)
+        if not entry or not path:
+            return
+
+        for child in list(self.children.get(path, ())):
+            self._delete(child)
+
+        del self.entries[path]
+        self.children.get(parent_of(path), set()).discard(path)
+        if entry.is_dir:
+            self.children.pop(path, None)
+            self.totals.pop(path, None)
+        else:
+            self._add_totals(path, -entry.size, -1)
+
+    def _add_totals(self, path: str, size: int, count: int):
+        for ancestor in ancestors_of(path):
+            totals = self.totals.setdefault(ancestor, [0, 0])
+            totals[0] += size
+            totals[1] += count
+
+    def put(self, entry: IndexEntry):
+        with self.lock:
+            self._put(entry)
+            self.append(self.put_record(entry))
+
+    def delete(self, path: str):
+        with self.lock:
+            if path in self.entries:
+                self._delete(path)
+                self.append({'o': DELETE, 'p': path})
+
+    def relative(self, path: str | Path) -> str:
+        path = os.path.relpath(path, self.content_path).replace(os.sep, '/')
+        return '' if path == '.' else path
+
+    def make_entry(self, path: str, name: str, stat: os.stat_result, is_dir: bool) -> IndexEntry:
+        parent = self.entries.get(parent_of(path))
+        name = join_path(parent.name if parent else '', name)
+        if is_dir:
+            return IndexEntry(path, name, True, 0, 0)
+        size = get_header(self.key, os.path.join(self.content_path, path)).size
+        return IndexEntry(path, name, False, size, stat.st_mtime_ns)
+
+    def add(self, path: str | Path, name: str):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((path, name))
+                return
+        stat = os.stat(path)
+        relative_path = self.relative(path)
+        with self.lock:
+            self.put(self.make_entry(relative_path, name, stat, os.path.isdir(path)))
+
+    def remove(self, path: str | Path):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((path, None))
+                return
+        self.delete(self.relative(path))
+
+    def get(self, path: str | Path) -> Optional[IndexEntry]:
+        relative_path = self.relative(path)
+        with self.lock:
+            return self.entries.get(relative_path)
+
+    def search(self, query: str, limit: int) -> list[IndexEntry]:
+        query = query.lower()
+        with self.lock:
+            matches = [x for x in self.entries.values() if x.path and query in x.name.rsplit('/', 1)[-1].lower()]
+        # The first names in order, not whichever matches come first in the dict
+        return heapq.nsmallest(limit, matches, key=lambda x: x.name)
+
+    def stats(self, path: str | Path) -> Optional[Tuple[int, int]]:
+        with self.lock:
+            totals = self.totals.get(self.relative(path))
+            return None if totals is None else (totals[0], totals[1])
+
+    def reconcile(self):
+        self.reconciling = True
+        try:
+            stack = ['']
+            while stack and self.log:
+                stack.extend(self.reconcile_dir(stack.pop()))
+            self.compact_if_needed()
+        finally:
+            self.reconciling = False
+
+    def reconcile_dir(self, path: str) -> list[str]:
+        try:
+            mtime = os.stat(os.path.join(self.content_path, path)).st_mtime_ns
+        except FileNotFoundError:
+            self.delete(path)
+            return []
+
+        with self.lock:
+            entry = self.entries.get(path)
+            known = {x.rsplit('/', 1)[-1]: x for x in self.children.get(path, ())}
+            if entry and entry.mtime == mtime:
+                return [x for x in known.values() if self.entries[x].is_dir]
+
+        with os.scandir(os.path.join(self.content_path, path)) as it:
+            on_disk = {x.name: x for x in it if x.name.startswith(ENCRYPTED_FILE_PREFIX)}
+
+        for name in known.keys() - on_disk.keys():
+            self.delete(known[name])
+
+        dirs = []
+        for name, dir_entry in on_disk.items():
+            child_path = join_path(path, name)
+            is_dir = dir_entry.is_dir()
+            if is_dir:
+                dirs.append(child_path)
+
+            old = self.entries.get(child_path)
+            if old and is_dir:
+                continue
+            stat = dir_entry.stat()
+            if old and old.mtime == stat.st_mtime_ns and not old.is_dir:
+                continue
+
+            try:
+                plain_name = old.name.rsplit('/', 1)[-1] if old else decrypt_name(self.key, name)
+            except ValueError:
+                continue
+            self.put(self.make_entry(child_path, plain_name, stat, is_dir))
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry:
+                self.put(IndexEntry(path, entry.name, True, 0, mtime))
+
+        return dirs
@@ -0,0 +1,132 @@
+import json
+import os
+import re
+import secrets
+import shutil
+import struct
+from pathlib import Path
+from typing import Optional
+
+from constants import CHUNK_SIZE, CONTENT_PATH, UPLOADS_PATH, NONCE_SIZE, TAG_SIZE
+from encrypter import BytesInStream, FileHeader, HEADER_SIZE, encrypt, encrypt_name, chunk_size_for, make_header
+
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+CHUNK_RECORD = struct.Struct('>I')
+
+STATE_FILE = 'state'
+DATA_FILE = 'data'
+CHUNKS_FILE = 'chunks'
+
+
+class UploadSession:
+    def __init__(self, upload_id: str, state: dict):
+        self.upload_id = upload_id
+        self.path = os.path.join(UPLOADS_PATH, upload_id)
+        self.directory: str = state['directory']
+        self.name: str = state['name']
+        self.size: int = state['size']
+        if state.get('header'):
+            self.header = FileHeader(1, 0, state['chunk_size'], self.size, HEADER_SIZE)
+        else:
+            self.header = FileHeader(0, 0, CHUNK_SIZE, self.size, 0)
+        self.chunk_size = self.header.chunk_size
+        self.chunk_count = self.header.chunk_count()
+
+    @staticmethod
+    def create(key: bytes, directory: str | Path, name: str, size: int) -> 'UploadSession':
+        if size < 0:
+            raise ValueError(f'Invalid upload size: {size}')
+
+        upload_id = secrets.token_hex(16)
+        state = {
+            'directory': os.path.relpath(directory, CONTENT_PATH),
+            'name': encrypt_name(key, name),
+            'size': size,
+            'chunk_size': chunk_size_for(name),
+            'header': True,
+        }
+
+        path = os.path.join(UPLOADS_PATH, upload_id)
+        os.makedirs(path)
+        with open(os.path.join(path, STATE_FILE), 'w') as f:
+            json.dump(state, f)
+        with open(os.path.join(path, DATA_FILE), 'wb') as f:
+            f.write(make_header(key, size, state['chunk_size']))
+        open(os.path.join(path, CHUNKS_FILE), 'wb').close()
+
+        return UploadSession(upload_id, state)
+
+    @staticmethod
+    def load(upload_id: str) -> Optional['UploadSession']:
+        if not UPLOAD_ID_PATTERN.match(upload_id):
+            return None
+        try:
+            with open(os.path.join(UPLOADS_PATH, upload_id, STATE_FILE)) as f:
+                return UploadSession(upload_id, json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def target(self) -> Path:
+        return Path(CONTENT_PATH).joinpath(self.directory, self.name)
+
+    def committed(self) -> set[int]:
+        with open(os.path.join(self.path, CHUNKS_FILE), 'rb') as f:
+            data = f.read()
+        size = len(data) - len(data) % CHUNK_RECORD.size
+        return {x for (x,) in CHUNK_RECORD.iter_unpack(data[:size])}
+
+    def to_json(self) -> dict:
+        return {
+            'id': self.upload_id,
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'chunks': self.chunk_count,
+            'committed': sorted(self.committed()),
+        }
+
+    def write_chunks(self, key: bytes, index: int, in_stream: BytesInStream, length: int) -> list[int]:
+        if index < 0 or index >= self.chunk_count:
+            raise ValueError(f'Invalid chunk index: {index}')
+        expected = min(length, self.size - self.chunk_size * index)
+        if length != expected or (length % self.chunk_size and self.chunk_size * index + length != self.size):
+            raise ValueError(f'Chunk range must be chunk aligned, got {length} bytes at chunk {index}')
+
+        written = []
+        data = os.open(os.path.join(self.path, DATA_FILE), os.O_WRONLY)
+        try:
+            while length > 0:
+                size = self.header.chunk_length(index) - NONCE_SIZE - TAG_SIZE
+                buf = in_stream.read(size)
+                if len(buf) != size:
+                    raise ValueError(f'Unexpected end of chunk {index}')
+                os.pwrite(data, encrypt(key, buf), self.header.chunk_offset(index))
+                written.append(index)
+                length -= size
+                index += 1
+            os.fsync(data)
+        finally:
+            os.close(data)
+
+        # The record is what marks the chunks committed, it has to reach the disk after the data does
+        with open(os.path.join(self.path, CHUNKS_FILE), 'ab') as f:
+            f.write(b''.join(CHUNK_RECORD.pack(x) for x in written))
+            f.flush()
+            os.fsync(f.fileno())
+        return written
+
+    def missing(self) -> list[int]:
+        committed = self.committed()
+        return [x for x in range(self.chunk_count) if x not in committed]
+
+    def finalize(self) -> Path:
+        missing = self.missing()
+        if missing:
+            raise ValueError(f'Upload {self.upload_id} is missing {len(missing)} chunks')
+
+        target = self.target()
+        os.replace(os.path.join(self.path, DATA_FILE), target)
+        self.abort()
+        return target
+
+    def abort(self):
+        shutil.rmtree(self.path, ignore_errors=True)